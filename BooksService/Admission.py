@@ -0,0 +1,320 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import g, request
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Resources never limited, so monitoring keeps working while the service sheds load
+EXEMPT_RULES = frozenset(["/stats", "/metrics"])
+
+
+def admission_options(environ=os.environ):
+    """
+    Build the AdmissionControl limits and token bucket options from the environment.
+
+    BOOKS_CONCURRENCY_LIMITS maps "METHOD /rule" to [max concurrency, max queued], e.g.
+    '{"POST /books": [2, 2], "POST /books/bulk": [1, 0]}'. BOOKS_RATE_LIMIT is the requests per second of each
+    client, 0 or unset for no rate limiting, and BOOKS_RATE_LIMIT_BURST the size of its bucket.
+
+    Args:
+        environ (dict): The environment to read, os.environ by default.
+
+    Returns:
+        tuple: The ConcurrencyLimiter of each endpoint, and the token bucket rate and capacity, None if unset.
+    """
+    queue_timeout = float(environ.get("BOOKS_QUEUE_TIMEOUT", ConcurrencyLimiter.QUEUE_TIMEOUT))
+    limits = {endpoint: ConcurrencyLimiter(max_concurrency, max_queued, queue_timeout)
+              for endpoint, (max_concurrency, max_queued)
+              in json.loads(environ.get("BOOKS_CONCURRENCY_LIMITS") or "{}").items()}
+    rate = float(environ.get("BOOKS_RATE_LIMIT") or 0)
+    if not rate:
+        return limits, None
+    return limits, {"rate": rate, "capacity": float(environ.get("BOOKS_RATE_LIMIT_BURST") or max(rate, 1))}
+
+
+class ConcurrencyLimiter:
+    """
+    Bounds the concurrent requests to an endpoint. Requests over the limit wait for a slot in a bounded queue,
+    in arrival order, and are rejected when the queue is full or their wait times out.
+    """
+
+    QUEUE_TIMEOUT = 2.0
+
+    def __init__(self, max_concurrency: int, max_queued: int = 0, queue_timeout: float = QUEUE_TIMEOUT):
+        """
+        Args:
+            max_concurrency (int): The maximum number of requests handled at once.
+            max_queued (int): The maximum number of requests waiting for a slot, 0 to reject right away.
+            queue_timeout (float): Seconds a request waits for a slot before it is rejected.
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiting = []  # the tickets of the queued requests, oldest first
+        self._condition = threading.Condition()
+        self.counters = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+        self.max_queue_depth = 0
+
+    def acquire(self):
+        """
+        Take a slot, waiting in the queue if every slot is taken.
+
+        Returns:
+            bool: True if a slot was taken and must be released, False if the request is rejected.
+        """
+        with self._condition:
+            if self.in_flight < self.max_concurrency and not self._waiting:
+                return self._admit()
+            if len(self._waiting) >= self.max_queued:
+                self.counters["rejected_queue_full"] += 1
+                return False
+            ticket = object()
+            self._waiting.append(ticket)
+            self.counters["queued"] += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self._waiting))
+            admitted = self._condition.wait_for(
+                lambda: self.in_flight < self.max_concurrency and self._waiting[0] is ticket, self.queue_timeout)
+            self._waiting.remove(ticket)
+            if not admitted:
+                self.counters["rejected_timeout"] += 1
+                self._condition.notify_all()  # the next request in line may be at the head now
+                return False
+            return self._admit()
+
+    def _admit(self):
+        self.in_flight += 1
+        self.counters["admitted"] += 1
+        return True
+
+    def release(self):
+        """
+        Free a slot taken by acquire, waking up the queued requests.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        """
+        Report the load of the endpoint in this process.
+
+        Returns:
+            dict: The requests in flight and queued, the limits, and the admission counters.
+        """
+        with self._condition:
+            return dict(self.counters, in_flight=self.in_flight, queue_depth=len(self._waiting),
+                        max_queue_depth=self.max_queue_depth, max_concurrency=self.max_concurrency,
+                        max_queued=self.max_queued)
+
+
+class TokenBuckets(ABC):
+    """
+    Per-client token buckets: every client may make 'capacity' requests in a burst, then 'rate' requests per second.
+    Subclasses store the buckets.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        Args:
+            rate (float): The tokens added to a bucket per second.
+            capacity (float): The maximum tokens of a bucket, the largest burst.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self.counters = {"allowed": 0, "limited": 0}
+
+    @abstractmethod
+    def take(self, client: str):
+        """
+        Take a token from the bucket of a client.
+
+        Args:
+            client (str): The client key.
+
+        Returns:
+            tuple: Whether the request is allowed, and the seconds until the bucket has a token again.
+        """
+
+    def refill(self, tokens: float, updated_at: float, now: float):
+        """
+        Returns:
+            float: The tokens of a bucket that had 'tokens' at 'updated_at', at 'now'.
+        """
+        return min(self.capacity, tokens + max(now - updated_at, 0) * self.rate)
+
+    def _outcome(self, tokens: float):
+        """
+        Count the outcome of a take from a bucket that had 'tokens' after its refill.
+        """
+        allowed = tokens >= 1
+        with self._lock:
+            self.counters["allowed" if allowed else "limited"] += 1
+        return allowed, 0.0 if allowed else (1 - tokens) / self.rate
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, rate=self.rate, capacity=self.capacity)
+
+
+class MemoryTokenBuckets(TokenBuckets):
+    """
+    Token buckets in process memory, each process limits its clients on its own.
+    The least recently seen clients are forgotten beyond 'max_clients', their next bucket starts full.
+    """
+
+    def __init__(self, rate: float, capacity: float, max_clients: int = 10000):
+        super().__init__(rate, capacity)
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()  # client -> (tokens, updated at), least recently seen first
+
+    def take(self, client: str):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(client, (self.capacity, now))
+            tokens = self.refill(tokens, updated_at, now)
+            self._buckets[client] = (tokens - 1 if tokens >= 1 else tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return self._outcome(tokens)
+
+    def stats(self):
+        return dict(super().stats(), clients=len(self._buckets))
+
+
+class MongoTokenBuckets(TokenBuckets):
+    """
+    Token buckets in a Mongo collection, shared by every worker and replica. A take reads the bucket and writes it
+    back only if no other take wrote it since, retrying otherwise. Buckets of idle clients are dropped by a TTL index.
+    When Mongo is unavailable requests are allowed, so rate limiting never takes the service down.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, collection, rate: float, capacity: float):
+        super().__init__(rate, capacity)
+        self.collection = collection
+        self.counters.update(conflicts=0, errors=0)
+        # a bucket idle for that long is full again, it can be dropped
+        self.idle_ttl = timedelta(seconds=math.ceil(capacity / rate) + 60)
+
+    def ensure_indexes(self):
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def take(self, client: str):
+        try:
+            for _ in range(self.MAX_ATTEMPTS):
+                now = time.time()  # shared by the processes, unlike the monotonic clock
+                bucket = self.collection.find_one({"_id": client})
+                tokens = self.capacity if bucket is None else self.refill(bucket["tokens"], bucket["at"], now)
+                if tokens < 1:  # the bucket is only written when a token is taken
+                    return self._outcome(tokens)
+                update = {"tokens": tokens - 1, "at": now, "expires_at": datetime.utcnow() + self.idle_ttl}
+                try:
+                    if bucket is None:
+                        self.collection.insert_one(dict(update, _id=client))
+                        return self._outcome(tokens)
+                    if self.collection.update_one({"_id": client, "at": bucket["at"]}, {"$set": update}).matched_count:
+                        return self._outcome(tokens)
+                except DuplicateKeyError:
+                    pass  # another process created the bucket first
+                self._count("conflicts")
+        except PyMongoError as e:
+            logger.warning("Rate limit store unavailable, allowing the request: %s", e)
+            self._count("errors")
+        return self._outcome(self.capacity)  # too contended to decide or no store, let the request through
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+
+class AdmissionControl:
+    """
+    Admission control of a Flask app, before any work is done for a request. Each client is rate limited with a
+    token bucket and gets a 429 once it is empty. Endpoints with a concurrency limit, typically those waiting on
+    Google Books, get a 503 once their slots and queue are full, so they cannot hold every worker thread and the
+    cheap reads keep being served. Both responses tell the client when to retry in Retry-After.
+    Limits apply to each process, keep the slots and queues of an endpoint below the threads of a worker.
+    """
+
+    def __init__(self, limits: dict = None, buckets: TokenBuckets = None, client_header: str = None,
+                 retry_after: int = 1):
+        """
+        Args:
+            limits (dict): The ConcurrencyLimiter of each limited endpoint, by "METHOD /rule", e.g. "POST /books".
+            buckets (TokenBuckets): The per-client token buckets, None for no rate limiting.
+            client_header (str): The request header identifying the client, e.g. X-Forwarded-For behind a proxy.
+                The first address of the header is used, the remote address when it is missing or not set.
+            retry_after (int): The Retry-After seconds of a 503.
+        """
+        self.limits = limits or {}
+        self.buckets = buckets
+        self.client_header = client_header
+        self.retry_after = retry_after
+
+    def install(self, app):
+        """
+        Check every request of an app before it is handled, and free its slot once it is done.
+
+        Args:
+            app (Flask): The app.
+        """
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def client(self):
+        """
+        Returns:
+            str: The key of the client of the current request.
+        """
+        forwarded = request.headers.get(self.client_header) if self.client_header else None
+        return forwarded.split(",")[0].strip() if forwarded else request.remote_addr or "unknown"
+
+    def admit(self):
+        """
+        Rate limit the client of the current request and take a slot of its endpoint.
+
+        Returns:
+            tuple: A 429 or 503 error response, or None if the request is admitted.
+        """
+        rule = request.url_rule.rule if request.url_rule else None
+        if rule in EXEMPT_RULES:
+            return None
+        if self.buckets is not None:
+            allowed, retry_after = self.buckets.take(self.client())
+            if not allowed:
+                return ({"message": "Too many requests"}, 429,
+                        {"Retry-After": str(max(math.ceil(retry_after), 1))})
+        limiter = self.limits.get(f"{request.method} {rule}")
+        if limiter is not None:
+            if not limiter.acquire():
+                return {"message": "Service busy, retry later"}, 503, {"Retry-After": str(self.retry_after)}
+            g.admission_limiter = limiter
+        return None
+
+    def release(self, exception=None):
+        limiter = g.pop("admission_limiter", None)
+        if limiter is not None:
+            limiter.release()
+
+    def stats(self):
+        """
+        Report the queue depths and rejections of every limited endpoint, and the rate limiting counters.
+
+        Returns:
+            dict: The stats of each endpoint, by "METHOD /rule", and of the token buckets.
+        """
+        stats = {"endpoints": {endpoint: limiter.stats() for endpoint, limiter in self.limits.items()}}
+        if self.buckets is not None:
+            stats["rate_limit"] = self.buckets.stats()
+        return stats
@@ -1,5 +1,61 @@
-from flask import request
-from flask_restful import Resource, reqparse
+import json
+import zlib
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, urlencode
+from flask import Response, request, stream_with_context
+from flask_restful import Resource
+import JsonEncoding
+from Instrumentation import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from Validation import BOOK_SCHEMA, BOOK_UPDATE_SCHEMA, RATING_SCHEMA, json_body
+
+PAGE_ARGS = ('limit', 'after', 'fields')
+MAX_PAGE_SIZE = 1000
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def split_page_args(args):
+    """
+    Separate the pagination and projection parameters of a GET request from its query filters.
+
+    Args:
+        args: The request query arguments.
+
+    Returns:
+        tuple: The query filters dict and a dict with the 'limit', 'after' and 'fields' options,
+        or None instead of the options if they are malformed.
+    """
+    query = {field: value for field, value in args.items() if field not in PAGE_ARGS}
+    options = {'limit': None, 'after': args.get('after'), 'fields': None}
+    if 'limit' in args:
+        try:
+            options['limit'] = int(args['limit'])
+        except ValueError:
+            return query, None
+        if not 0 < options['limit'] <= MAX_PAGE_SIZE:
+            return query, None
+    if 'fields' in args:
+        options['fields'] = [field for field in args['fields'].split(',') if field]
+    return query, options
+
+
+def next_page_headers(books_collection, page, limit):
+    """
+    Build the Link header pointing to the page following the current one.
+
+    Args:
+        books_collection (BooksCollection): The collection the page was read from.
+        page (list): The documents of the current page.
+        limit (int): The limit the page was requested with.
+
+    Returns:
+        dict: The response headers, empty if this is the last page.
+    """
+    cursor = books_collection.next_cursor(page, limit)
+    if cursor is None:
+        return {}
+    args = request.args.to_dict()
+    args['after'] = cursor
+    return {'Link': f'<{request.base_url}?{urlencode(args)}>; rel="next"'}
 
 
 class Books(Resource):
@@ -17,23 +73,11 @@ class Books(Resource):
         Returns:
             Tuple of message and response status code.
         """
-        content_type = request.headers.get('Content-Type')
-        if content_type != 'application/json':
-            return {'message': 'Content-Type must be application/json'}, 415
+        args, error = BOOK_SCHEMA.parse()
+        if error:
+            return error  # not JSON, or at least one of the fields is missing
 
-        parser = reqparse.RequestParser()
-        parser.add_argument('title', type=str, required=True, location='json')
-        parser.add_argument('ISBN', type=str, required=True, location='json')
-        parser.add_argument('genre', type=str, required=True, location='json')
-        args = parser.parse_args()
-        try:
-            title = args['title']
-            isbn = args['ISBN']
-            genre = args['genre']
-        except KeyError:
-            return {'message': 'Bad query POST format'}, 422  # at least one of the fields is missing
-
-        book_id, status = self.books_collection.insert_book(title, isbn, genre)
+        book_id, status = self.books_collection.insert_book(args['title'], args['ISBN'], args['genre'])
         if status == 201:
             return {'ID': book_id, 'message': 'Book created successfully'}, 201
         return {'message': 'Error creating book'}, status  # problem with data validation
@@ -41,17 +85,299 @@ class Books(Resource):
     def get(self):
         """
         Handles GET request to retrieve books based on query parameters.
+        Supports '?limit=' and '?after=' pagination, the Link header points to the next page,
+        and '?fields=' projection of a comma separated list of fields.
+        Like every read resource, responds 304 without querying the db if If-None-Match holds the current ETag.
 
         Returns:
             JSON list of books and response status code.
         """
-        query = request.args
-        content, status = self.books_collection.get_book(dict(query))
+        tag = listing_etag(self.books_collection, 'books')
+        response = not_modified(tag)
+        if response:
+            return response
+        query, options = split_page_args(request.args)
+        if options is None:
+            return {'message': 'Bad query format'}, 422
+        content, status = self.books_collection.get_book(query, **options)
         if status == 422:
             return {'message': 'Bad query format'}, status
+        if status == 200:
+            return content, status, dict(etag_headers(tag),
+                                         **next_page_headers(self.books_collection, content, options['limit']))
         return content, status
 
 
+class BooksBulk(Resource):
+    """
+    Resource for creating many books in one request.
+    """
+
+    MAX_ENTRIES = 10000
+
+    def __init__(self, books_collection):
+        self.books_collection = books_collection
+
+    def post(self):
+        """
+        Handles POST request to create many books. The body is either a JSON array or NDJSON,
+        one book object per line.
+
+        Returns:
+            Per-entry results and response status code: 201 if every book was created, 207 otherwise.
+        """
+        entries, error = bulk_entries(self.MAX_ENTRIES)
+        if error:
+            return error
+
+        results, created = self.books_collection.insert_books(entries)
+        status = 201 if created == len(entries) else 207
+        return {'created': created, 'failed': len(entries) - created, 'results': results}, status
+
+
+def bulk_entries(max_entries):
+    """
+    Parse the body of a bulk request, either a JSON array or NDJSON, one object per line.
+
+    Args:
+        max_entries (int): The maximum number of entries of a request.
+
+    Returns:
+        tuple: The list of entries and None, or None and the error response, 415 for another content type
+        and 422 for a malformed, empty or too large body.
+    """
+    if request.mimetype == 'application/json':
+        entries = request.get_json(silent=True)
+    elif request.mimetype == 'application/x-ndjson':
+        try:
+            entries = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        except ValueError:
+            entries = None
+    else:
+        return None, ({'message': 'Content-Type must be application/json or application/x-ndjson'}, 415)
+
+    if not isinstance(entries, list) or not entries or len(entries) > max_entries:
+        return None, ({'message': 'Bad query POST format'}, 422)
+    return entries, None
+
+
+def etag_headers(tag):
+    """
+    Build the ETag response header of an entity tag.
+
+    Args:
+        tag (str): The unquoted entity tag, None when entity tags are disabled.
+
+    Returns:
+        dict: The response headers.
+    """
+    return {'ETag': f'"{tag}"'} if tag else {}
+
+
+def not_modified(tag):
+    """
+    Check the request's If-None-Match header against the current entity tag of the resource.
+
+    Args:
+        tag (str): The unquoted entity tag, None when entity tags are disabled.
+
+    Returns:
+        Response: A 304 response if the client's copy is current, None otherwise.
+    """
+    if tag and request.if_none_match.contains_weak(tag):
+        return Response(status=304, headers=etag_headers(tag))
+    return None
+
+
+def listing_etag(books_collection, collection):
+    """
+    Get the entity tag of a listing request, the collection version combined with the request's query string.
+
+    Args:
+        books_collection (BooksCollection): The collection the listing is read from.
+        collection (str): The versioned collection name, 'books' or 'ratings'.
+
+    Returns:
+        str: The unquoted entity tag, None when entity tags are disabled.
+    """
+    tag = books_collection.versions.etag(collection)
+    return tag and f"{tag}-{zlib.crc32(request.query_string):08x}"
+
+
+def ndjson_export_response(documents):
+    """
+    Stream documents as NDJSON, gzip-compressed if the client accepts it.
+    Lines are sent in chunks of about EXPORT_CHUNK_SIZE bytes so memory use does not depend on the number of documents.
+
+    Args:
+        documents: An iterable of documents, typically a Mongo cursor.
+
+    Returns:
+        Response: The streaming response.
+    """
+    use_gzip = request.accept_encodings.quality('gzip') > 0  # 'gzip;q=0' lists gzip but refuses it
+
+    def generate():
+        compressor = zlib.compressobj(wbits=31) if use_gzip else None  # wbits=31 writes a gzip container
+        chunk, chunk_size = [], 0
+        for document in documents:
+            line = JsonEncoding.dumps(document) + b'\n'
+            chunk.append(line)
+            chunk_size += len(line)
+            if chunk_size >= EXPORT_CHUNK_SIZE:
+                data = b''.join(chunk)
+                chunk, chunk_size = [], 0
+                data = compressor.compress(data) if compressor else data
+                if data:
+                    yield data
+        data = b''.join(chunk)
+        if compressor:
+            data = compressor.compress(data) + compressor.flush()
+        if data:
+            yield data
+
+    headers = {'Vary': 'Accept-Encoding'}
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers=headers)
+
+
+def parse_since(args):
+    """
+    Parse the optional 'since' export parameter, an ISO 8601 date or datetime (UTC unless an offset is given).
+
+    Args:
+        args: The request query arguments.
+
+    Returns:
+        tuple: The parsed datetime, or None if not given, and whether the parameter is valid.
+    """
+    if 'since' not in args:
+        return None, True
+    try:
+        since = datetime.fromisoformat(args['since'])
+    except ValueError:
+        return None, False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return since, True
+
+
+class BooksExport(Resource):
+    """
+    Resource for streaming the whole books catalog as NDJSON.
+    """
+    def __init__(self, books_collection):
+        self.books_collection = books_collection
+
+    def get(self):
+        """
+        Streams every book, or only those created since the '?since=' date, one JSON document per line.
+
+        Returns:
+            Streaming NDJSON response, or error message and response status code.
+        """
+        since, valid = parse_since(request.args)
+        if not valid:
+            return {'message': 'Bad query format'}, 422
+        return ndjson_export_response(self.books_collection.export_books(since))
+
+
+class BooksQueryBatch(Resource):
+    """
+    Resource for running many book queries in one request.
+    """
+
+    MAX_QUERIES = 100
+
+    def __init__(self, books_collection):
+        self.books_collection = books_collection
+
+    def post(self):
+        """
+        Handles POST request to run a batch of book queries. The body is a JSON list, or an object with a 'queries'
+        list, of query-strings such as '?genre=Fiction' or of filter objects such as {"genre": "Fiction"}.
+
+        Returns:
+            The results keyed by query and response status code. Query-strings are their own key, filter objects
+            are keyed by their compact JSON with sorted keys.
+        """
+        body, error = json_body()
+        if error:
+            return error
+        queries = body.get('queries') if isinstance(body, dict) else body
+        if not isinstance(queries, list) or not queries or len(queries) > self.MAX_QUERIES:
+            return {'message': 'Bad query POST format'}, 422
+
+        keys, filters = [], []
+        for query in queries:
+            if isinstance(query, str):
+                keys.append(query)
+                filters.append(dict(reversed(parse_qsl(query.lstrip('?')))))  # first value wins, as in GET /books
+            elif isinstance(query, dict) and all(isinstance(value, str) for value in query.values()):
+                keys.append(json.dumps(query, sort_keys=True, separators=(',', ':')))
+                filters.append(query)
+            else:
+                return {'message': 'Bad query POST format'}, 422
+
+        results = {}
+        for key, (content, status) in zip(keys, self.books_collection.get_books_batch(filters)):
+            if status == 200:
+                results[key] = {'status': 200, 'books': content}
+            elif status == 404:
+                results[key] = {'status': 404, 'message': content}
+            else:
+                results[key] = {'status': status, 'message': 'Bad query format'}
+        return {'results': results}, 200
+
+
+class BooksSearch(Resource):
+    """
+    Resource for searching books by words of their title and authors.
+    """
+
+    MAX_LIMIT = 100
+
+    def __init__(self, books_collection):
+        self.books_collection = books_collection
+
+    def get(self):
+        """
+        Handles GET request to search books. '?q=' is the search text, '?limit=' the maximum number of results
+        and '?prefix=false' turns off prefix matching of the last word.
+
+        Returns:
+            JSON list of matching books, best match first, and response status code.
+        """
+        text = request.args.get('q', '').strip()
+        try:
+            limit = int(request.args.get('limit', self.books_collection.SEARCH_DEFAULT_LIMIT))
+        except ValueError:
+            return {'message': 'Bad query format'}, 422
+        if not text or not 0 < limit <= self.MAX_LIMIT:
+            return {'message': 'Bad query format'}, 422
+        prefix = request.args.get('prefix', 'true').lower() != 'false'
+        return self.books_collection.search_books(text, limit, prefix)
+
+
+class BooksFacets(Resource):
+    """
+    Resource for the book counts per genre, publication year and publisher.
+    """
+    def __init__(self, books_collection):
+        self.books_collection = books_collection
+
+    def get(self):
+        """
+        Retrieves the number of books per genre, publication year and publisher,
+        and the average rating of the books of each genre.
+
+        Returns:
+            JSON object of facets and response status code.
+        """
+        return self.books_collection.get_facets()
+
+
 class Ratings(Resource):
     """
     Resource for handling retrieval of ratings for all books.
@@ -61,16 +387,44 @@ class Ratings(Resource):
 
     def get(self):
         """
-        Retrieves ratings for all books.
+        Retrieves ratings for all books, with the same pagination and projection parameters as GET /books.
 
         Returns:
             JSON list of ratings and response status code.
         """
-        query = request.args
-        content, status = self.books_collection.get_book_ratings(dict(query))
+        tag = listing_etag(self.books_collection, 'ratings')
+        response = not_modified(tag)
+        if response:
+            return response
+        query, options = split_page_args(request.args)
+        if options is None:
+            return {'message': 'Bad query format'}, 422
+        content, status = self.books_collection.get_book_ratings(query, **options)
         if status == 422:
             return {'message': 'Bad query format'}, 422
-        return content, status
+        return content, status, dict(etag_headers(tag),
+                                     **next_page_headers(self.books_collection, content, options['limit']))
+
+
+class RatingsExport(Resource):
+    """
+    Resource for streaming the ratings of every book as NDJSON.
+    """
+    def __init__(self, books_collection):
+        self.books_collection = books_collection
+
+    def get(self):
+        """
+        Streams the ratings of every book, or only of books created since the '?since=' date,
+        one JSON document per line.
+
+        Returns:
+            Streaming NDJSON response, or error message and response status code.
+        """
+        since, valid = parse_since(request.args)
+        if not valid:
+            return {'message': 'Bad query format'}, 422
+        return ndjson_export_response(self.books_collection.export_ratings(since))
 
 
 class RatingsIdValues(Resource):
@@ -90,18 +444,11 @@ class RatingsIdValues(Resource):
         Returns:
             Message indicating the result and response status code.
         """
-        content_type = request.headers.get('Content-Type')
-        if content_type != 'application/json':
-            return {'message': 'Content-Type must be application/json'}, 415  # unsupported media type
+        args, error = RATING_SCHEMA.parse()
+        if error:
+            return error  # not JSON, or the value is missing or not a number
 
-        parser = reqparse.RequestParser()
-        parser.add_argument('value', type=float, required=True, location='json')
-        args = parser.parse_args()
-        try:
-            value = args['value']
-        except KeyError:
-            return {'message': 'Bad query POST format'}, 422 # at least one of the fields is missing
-        _, avg, status = self.books_collection.rate_book(book_id, value)
+        _, avg, status = self.books_collection.rate_book(book_id, args['value'])
         if status == 201:
             return {'ID': book_id, 'message': f'Rating updated, new average: {avg}'}, 201
         elif status == 404:
@@ -109,6 +456,33 @@ class RatingsIdValues(Resource):
         return {'message': 'Error updating rating'}, 422 # problem with data validation
 
 
+class RatingsBulk(Resource):
+    """
+    Resource for posting many ratings of many books in one request.
+    """
+
+    MAX_ENTRIES = 10000
+
+    def __init__(self, books_collection):
+        self.books_collection = books_collection
+
+    def post(self):
+        """
+        Handles POST request to add many ratings. The body is either a JSON array or NDJSON,
+        one {"book_id": ..., "value": ...} object per line.
+
+        Returns:
+            Per-entry results and response status code: 201 if every rating was added, 207 otherwise.
+        """
+        entries, error = bulk_entries(self.MAX_ENTRIES)
+        if error:
+            return error
+
+        results, rated = self.books_collection.rate_books(entries)
+        status = 201 if rated == len(entries) else 207
+        return {'rated': rated, 'failed': len(entries) - rated, 'results': results}, status
+
+
 class Top(Resource):
     """
     Resource for retrieving the top-rated books.
@@ -116,15 +490,29 @@ class Top(Resource):
     def __init__(self, books_collection):
         self.books_collection = books_collection
 
+    MAX_K = 100
+
     def get(self):
         """
-        Retrieves the top-rated books in the db.
+        Retrieves the top-rated books in the db. The number of books is set by the optional 'k' query parameter.
 
         Returns:
             JSON list of top-rated books and response status code.
         """
-        content, status = self.books_collection.get_top()
-        return content, status
+        k = request.args.get('k', self.books_collection.TOP_DEFAULT_K)
+        try:
+            k = int(k)
+        except ValueError:
+            return {'message': 'Bad query format'}, 422
+        if not 0 < k <= self.MAX_K:
+            return {'message': 'Bad query format'}, 422
+        tag = self.books_collection.versions.etag('ratings')
+        tag = tag and f"{tag}-top{k}"
+        response = not_modified(tag)
+        if response:
+            return response
+        content, status = self.books_collection.get_top(k)
+        return content, status, etag_headers(tag)
 
 
 class RatingsId(Resource):
@@ -144,10 +532,14 @@ class RatingsId(Resource):
         Returns:
             JSON representation of ratings or error message and response status code.
         """
+        tag = self.books_collection.versions.etag('ratings', book_id)
+        response = not_modified(tag)
+        if response:
+            return response
         content, status = self.books_collection.get_book_ratings_by_id(book_id)
         if status == 404:
             return {'message': 'Book ID not recognized'}, 404
-        return content, status
+        return content, status, etag_headers(tag)
 
 
 class BooksId(Resource):
@@ -167,35 +559,10 @@ class BooksId(Resource):
         Returns:
             Message indicating the result and response status code.
         """
-        content_type = request.headers.get('Content-Type')
-        if content_type != 'application/json':
-            return {'message': 'Content-Type must be application/json'}, 415  # unsupported media type
-
-        parser = reqparse.RequestParser()
-        parser.add_argument('title', type=str, required=True, location='json')
-        parser.add_argument('authors', type=str, required=True, location='json')
-        parser.add_argument('ISBN', type=str, required=True, location='json')
-        parser.add_argument('publisher', type=str, required=True, location='json')
-        parser.add_argument('publishedDate', type=str, required=True, location='json')
-        parser.add_argument('genre', type=str, required=True, location='json')
-        args = parser.parse_args()
-
-        try:
-            title = args["title"]
-            authors = args["authors"]
-            isbn = args["ISBN"]
-            publisher = args["publisher"]
-            published_date = args["publishedDate"]
-            genre = args["genre"]
-        except KeyError:
-            return {'message': 'Incorrect PUT format'}, 422  # at least one of the fields is missing
-        put_values = {"title": title,
-                      "authors": authors,
-                      "ISBN": isbn,
-                      "publisher": publisher,
-                      "publishedDate": published_date,
-                      "genre": genre,
-                      "id": book_id}
+        put_values, error = BOOK_UPDATE_SCHEMA.parse()
+        if error:
+            return error  # not JSON, or at least one of the fields is missing
+        put_values["id"] = book_id
         book_id, status = self.books_collection.update_book(put_values)
         if status == 200:
             return {'ID': book_id, 'message': 'Book updated successfully'}, 200
@@ -216,10 +583,14 @@ class BooksId(Resource):
         """
         if len(book_id) != 24:
             return {'message': 'Book ID format incorrect'}, 404
+        tag = self.books_collection.versions.etag('books', book_id)
+        response = not_modified(tag)
+        if response:
+            return response
         content, status = self.books_collection.get_book_by_id(book_id)
         if status == 404:
             return {'message': 'Book ID not recognized'}, 404
-        return content, status
+        return content, status, etag_headers(tag)
 
     def delete(self, book_id: str):
         """
@@ -235,3 +606,38 @@ class BooksId(Resource):
         if status == 404:
             return {'message': 'Book ID not recognized'}, 404
         return {'ID': book_id, 'message': 'Book deleted successfully'}, 200
+
+
+class Stats(Resource):
+    """
+    Resource for exposing internal service counters, such as cache hit ratios.
+    """
+    def __init__(self, stats_sources):
+        self.stats_sources = stats_sources
+
+    def get(self):
+        """
+        Retrieves the current counters of every registered stats source.
+
+        Returns:
+            JSON object keyed by source name and response status code.
+        """
+        return {name: source() for name, source in self.stats_sources.items()}, 200
+
+
+class Metrics(Resource):
+    """
+    Resource for exposing request, method and Mongo command metrics in the Prometheus text format.
+    """
+    def __init__(self, registry, stats_sources):
+        self.registry = registry
+        self.stats_sources = stats_sources
+
+    def get(self):
+        """
+        Renders the metrics of every worker, and the stats sources of the scraped worker as gauges.
+
+        Returns:
+            Text response in the Prometheus exposition format.
+        """
+        return Response(self.registry.render(self.stats_sources), content_type=METRICS_CONTENT_TYPE)
@@ -1,6 +1,22 @@
-import requests
-import re
+import base64
+import logging
+import os
+import socket
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from bson import ObjectId
+from bson.errors import InvalidId
+from Cache import IsbnCache, ResponseCache, VersionTracker
+from Enrichment import EnrichmentQueue
+from GoogleBooksClient import GoogleBooksClient
+from SearchIndex import SearchIndex
+from Storage import DuplicateIsbnError
+from Validation import BOOK_QUERY_FIELDS, validate_genre, validate_isbn_format, validate_publish_date, validate_rating, \
+    validate_title
+
+logger = logging.getLogger(__name__)
 
 
 class BooksCollection:
@@ -8,56 +24,64 @@ class BooksCollection:
     A collection class for managing books and their ratings, leveraging external API data for enrichment.
     """
 
-    BOOK_FIELDS = ["title", "authors", "ISBN", "publisher", "publishDate", "genre", "id", "_id"]
-
-    def __init__(self, db):
-        self.books_collection = db.books
-        self.ratings_collection = db.ratings
-
-    @staticmethod
-    def validate_title(title):
-        """
-        Validate that the title is a string and not empty.
-
-        Args:
-            title (str): The title of the book to validate.
-
-        Returns:
-            bool: True if valid, False otherwise.
-        """
-        return isinstance(title, str) and len(title) > 0
-
-    @staticmethod
-    def validate_genre(genre):
-        """
-        Validate genre against a preset list of valid genres.
-
-        Args:
-            genre (str): The genre to validate.
-
-        Returns:
-            bool: True if the genre is valid, False otherwise.
-        """
-        valid_genres = ["Fiction", "Children", "Biography", "Science", "Science Fiction", "Fantasy", "Other"]
-        return genre in valid_genres
-
-    @staticmethod
-    def validate_publish_date(date):
+    BOOK_FIELDS = BOOK_QUERY_FIELDS
+    BOOK_PROJECTION_FIELDS = frozenset(["title", "authors", "ISBN", "publisher", "publishedDate", "genre",
+                                        "enrichment"])
+    RATING_PROJECTION_FIELDS = frozenset(["title", "values", "average", "count", "sum", "histogram"])
+    BULK_ENRICH_WORKERS = 8  # upper bound on concurrent Google Books lookups in a bulk insert
+    ENRICHMENT_WORKERS = 4  # threads filling in the Google Books data of books stored with asynchronous enrichment
+    ENRICHMENT_LEASE = 10 * 60  # seconds a worker resuming the enrichment of a pending book keeps it to itself
+    MAX_RATING_VALUES = 100  # number of most recent rating values kept in a ratings document
+    SEARCH_DEFAULT_LIMIT = 10
+    TOP_MIN_RATINGS = 3  # number of ratings a book needs to be eligible for /top
+    TOP_DEFAULT_K = 3
+    GOOGLE_NO_ITEMS_ERROR = GoogleBooksClient.NO_ITEMS_ERROR
+
+    def __init__(self, storage, max_rating_values=MAX_RATING_VALUES, default_page_size=None, response_cache=None,
+                 facet_counters=False, google_books=None, async_enrichment=False, enrichment_workers=ENRICHMENT_WORKERS,
+                 entity_tags=True, search_index=True):
         """
-        Validate publish date against the pattern yyyy-mm-dd or yyyy.
-
         Args:
-            date (str): The publishing date string to validate.
-
-        Returns:
-            bool: True if the date matches the pattern, False otherwise.
+            storage (Storage): The storage backend holding the books and ratings.
+            max_rating_values (int): How many of the most recent rating values to keep in each ratings document,
+                0 to keep none and None to keep all of them. The average is always computed over every rating.
+            default_page_size (int): The number of documents returned by GET /books and GET /ratings when no limit
+                is requested, None to return every matching document.
+            response_cache (ResponseCache): The cache of read results, a default-sized one if None.
+            facet_counters (bool): Whether to maintain the facet counts of GET /books/facets incrementally on every
+                write, instead of aggregating over the whole catalog on every read.
+            google_books (GoogleBooksClient): The client of the Google Books API, a default one if None.
+            async_enrichment (bool): Whether to store new books right away with their enrichment 'pending', and fill
+                in their Google Books data in the background, instead of waiting for Google Books before inserting.
+            enrichment_workers (int): The number of background enrichment threads.
+            entity_tags (bool): Whether the read resources issue ETags and answer If-None-Match with 304.
+            search_index (bool): Whether to keep the search index built by the first search, updated by every write,
+                instead of indexing the books read from the db on every search.
         """
-        pattern = r'^\d{4}(-\d{2}-\d{2})?$'  # pattern for the format yyyy-mm-dd or yyyy
-        return bool(re.match(pattern, date))  # Return if the string matches the pattern
+        self.max_rating_values = max_rating_values
+        self.default_page_size = default_page_size
+        self.storage = storage
+        self.isbn_cache = IsbnCache(storage.isbn_cache_collection)
+        self.google_books = google_books or GoogleBooksClient()
+        self.response_cache = response_cache or ResponseCache()
+        # entity tag versions of the books and ratings collections and documents
+        self.versions = VersionTracker(enabled=entity_tags)
+        # built from the books collection on the first search
+        self.search_index = SearchIndex(enabled=search_index)
+        self._search_index_lock = threading.Lock()
+        self.facet_counters = facet_counters
+        self.enrichment = EnrichmentQueue(self.enrich_book, workers=enrichment_workers,
+                                          fail=self.fail_enrichment) if async_enrichment else None
+        self.cache_sync = None  # the ChangeListener keeping the caches coherent with other replicas, if any
+
+    validate_title = staticmethod(validate_title)
+    validate_genre = staticmethod(validate_genre)
+    validate_publish_date = staticmethod(validate_publish_date)
 
     def validate_isbn(self, isbn):
         """
         Validate that the ISBN is exactly 13 characters long and unique within the database.
+        Uniqueness is only checked here when the storage does not enforce it on insert.
 
         Args:
             isbn (str): The ISBN to validate.
@@ -65,7 +89,9 @@ class BooksCollection:
         Returns:
             bool: True if the ISBN is valid and unique, False otherwise.
         """
-        return isinstance(isbn, str) and len(isbn) == 13 and not self.books_collection.find_one({"ISBN": isbn})
+        if not validate_isbn_format(isbn):
+            return False
+        return self.storage.unique_isbn or not self.storage.existing_isbns([isbn])
 
     def validate_data(self, title, isbn, genre):
         """
@@ -98,62 +124,386 @@ class BooksCollection:
             return None, 422
 
         # book_id = str(uuid.uuid4())
-        book_google_api_data, response_code = self.get_book_google_data(isbn)
+        if self.enrichment is None:
+            book_google_api_data, response_code = self.lookup_book_google_data(isbn)
+        else:  # only a cached lookup is used right away, the others are left to the enrichment workers
+            book_google_api_data, response_code = self.isbn_cache.get(isbn) or (None, 200)
         if response_code != 200:
             return book_google_api_data, response_code
-        authors = publisher = published_date = "missing"
 
-        if response_code == 200:
-            # handles the case that there is more than one author
-            authors = " and ".join(book_google_api_data["authors"])
-            publisher = book_google_api_data["publisher"]
-            # validate that published date is in the correct format, else define "missing"
-            published_date_str = book_google_api_data["publishedDate"]
-            published_date = published_date_str if BooksCollection.validate_publish_date(published_date_str) else (
-                published_date)
-
-        book = dict(title=title, authors=authors, ISBN=isbn, publisher=publisher, publishedDate=published_date,
-                    genre=genre)
-        book_insert_results = self.books_collection.insert_one(book)
-        self.ratings_collection.insert_one({'_id': book_insert_results.inserted_id,
-                                            'values': [], 'average': 0, 'title': title})
-        return str(book_insert_results.inserted_id), 201
-
-    def get_book(self, query: dict):
+        book = BooksCollection.build_book_document(title, isbn, genre, book_google_api_data)
+        book["_id"] = ObjectId()
+        ratings = BooksCollection.build_ratings_document(book["_id"], title)
+        try:
+            self.storage.insert_book(book, ratings)
+        except DuplicateIsbnError:
+            return None, 422  # the ISBN is already in the db
+        self.versions.bump("books", book["_id"])
+        self.versions.bump("ratings", book["_id"])
+        self.search_index.add(book)
+        self.update_facet_counters(added=[book])
+        self.response_cache.invalidate_matching("books", book)
+        self.response_cache.invalidate_matching("ratings_list", ratings)
+        self.publish_change(books=[book["_id"]], ratings=[book["_id"]])
+        if book.get("enrichment") == "pending":
+            self.enrichment.submit(book["_id"])
+        return str(book["_id"]), 201
+
+    def insert_books(self, entries: list):
+        """
+        Insert many new books at once. All entries are validated up front, ISBN uniqueness is checked with a
+        single query, Google Books enrichment runs on a bounded thread pool, or in the background with asynchronous
+        enrichment, and the books and their ratings are written with one bulk insert each.
+
+        Args:
+            entries (list): A list of dicts, each with the 'title', 'ISBN' and 'genre' of a book.
+
+        Returns:
+            tuple: A tuple containing a per-entry list of results (each with the entry index, its status code,
+            and the book ID or an error message) and the number of books created.
+        """
+        results = [None] * len(entries)
+        candidates = {}  # ISBN -> index of the first entry that passed validation
+        for index, entry in enumerate(entries):
+            if not isinstance(entry, dict):
+                results[index] = {"index": index, "status": 422, "message": "Bad query POST format"}
+                continue
+            title, isbn, genre = entry.get("title"), entry.get("ISBN"), entry.get("genre")
+            if not (BooksCollection.validate_title(title) and BooksCollection.validate_genre(genre)
+                    and validate_isbn_format(isbn)):
+                results[index] = {"index": index, "ISBN": isbn, "status": 422, "message": "Error creating book"}
+            elif isbn in candidates:  # the same ISBN appears twice in the batch
+                results[index] = {"index": index, "ISBN": isbn, "status": 422, "message": "Duplicate ISBN"}
+            else:
+                candidates[isbn] = index
+
+        # check uniqueness of the whole batch against the db in a single round trip
+        for isbn in self.storage.existing_isbns(list(candidates)):
+            index = candidates.pop(isbn)
+            results[index] = {"index": index, "ISBN": isbn, "status": 422, "message": "Duplicate ISBN"}
+
+        books = []
+        if candidates and self.enrichment is not None:
+            books = [(index, BooksCollection.build_book_document(entries[index]["title"], isbn, entries[index]["genre"],
+                                                                 None)) for isbn, index in candidates.items()]
+        elif candidates:
+            with ThreadPoolExecutor(max_workers=min(self.BULK_ENRICH_WORKERS, len(candidates))) as executor:
+                lookups = executor.map(self.lookup_book_google_data, candidates)
+                for (isbn, index), (book_google_api_data, response_code) in zip(candidates.items(), lookups):
+                    if response_code != 200:
+                        results[index] = {"index": index, "ISBN": isbn, "status": response_code,
+                                          "message": book_google_api_data.get("error", "Error creating book")}
+                        continue
+                    entry = entries[index]
+                    books.append((index, BooksCollection.build_book_document(entry["title"], isbn, entry["genre"],
+                                                                             book_google_api_data)))
+
+        if books:
+            for _, book in books:
+                book["_id"] = ObjectId()
+            ratings = [BooksCollection.build_ratings_document(book["_id"], book["title"]) for _, book in books]
+            # books inserted concurrently by another request since the uniqueness check are skipped
+            duplicates = self.storage.insert_books([book for _, book in books], ratings)
+            for position in duplicates:
+                index, book = books[position]
+                results[index] = {"index": index, "ISBN": book["ISBN"], "status": 422, "message": "Duplicate ISBN"}
+            books = [entry for position, entry in enumerate(books) if position not in duplicates]
+            ratings = [document for position, document in enumerate(ratings) if position not in duplicates]
+        if books:
+            self.versions.bump("books", *[book["_id"] for _, book in books])
+            self.versions.bump("ratings", *[book["_id"] for _, book in books])
+            for _, book in books:
+                self.search_index.add(book)
+            self.update_facet_counters(added=[book for _, book in books])
+            self.response_cache.invalidate_matching("books", *[book for _, book in books])
+            self.response_cache.invalidate_matching("ratings_list", *ratings)
+            self.publish_change(books=[book["_id"] for _, book in books], ratings=[book["_id"] for _, book in books])
+            for index, book in books:
+                results[index] = {"index": index, "ISBN": book["ISBN"], "status": 201, "ID": str(book["_id"])}
+                if book.get("enrichment") == "pending":
+                    self.enrichment.submit(book["_id"])
+        return results, len(books)
+
+    @staticmethod
+    def build_book_document(title: str, isbn: str, genre: str, book_google_api_data: dict):
+        """
+        Build a new book document from the client's fields and the Google Books data.
+
+        Args:
+            title (str): The title of the book.
+            isbn (str): The ISBN of the book.
+            genre (str): The genre of the book.
+            book_google_api_data (dict): The authors, publisher and publishedDate returned by Google Books,
+                or None to insert the book with its enrichment 'pending'.
+
+        Returns:
+            dict: The book document to insert.
+        """
+        if book_google_api_data is None:
+            return dict(title=title, authors="missing", ISBN=isbn, publisher="missing", publishedDate="missing",
+                        genre=genre, enrichment="pending")
+        fields = BooksCollection.google_fields(book_google_api_data)
+        return dict(title=title, authors=fields["authors"], ISBN=isbn, publisher=fields["publisher"],
+                    publishedDate=fields["publishedDate"], genre=genre)
+
+    @staticmethod
+    def google_fields(book_google_api_data: dict):
+        """
+        Convert Google Books data to the fields of a book document.
+
+        Args:
+            book_google_api_data (dict): The authors, publisher and publishedDate returned by Google Books.
+
+        Returns:
+            dict: The 'authors', 'publisher' and 'publishedDate' of the book, "missing" where Google has none.
+        """
+        # handles the case that there is more than one author
+        authors = " and ".join(book_google_api_data["authors"]) if book_google_api_data["authors"] else "missing"
+        publisher = book_google_api_data["publisher"] or "missing"
+        # validate that published date is in the correct format, else define "missing"
+        published_date_str = book_google_api_data["publishedDate"] or ""
+        published_date = published_date_str if BooksCollection.validate_publish_date(published_date_str) else (
+            "missing")
+        return dict(authors=authors, publisher=publisher, publishedDate=published_date)
+
+    @staticmethod
+    def build_ratings_document(book_id, title: str):
+        """
+        Build the empty ratings document of a new book.
+
+        Args:
+            book_id (ObjectId): The ID of the book in the db.
+            title (str): The title of the book.
+
+        Returns:
+            dict: The ratings document to insert.
+        """
+        return {'_id': book_id, 'values': [], 'average': 0, 'title': title,
+                'count': 0, 'sum': 0, 'histogram': {str(star): 0 for star in range(1, 6)}, 'eligible': False}
+
+    def get_book(self, query: dict, limit: int = None, after: str = None, fields: list = None):
         """
         Retrieve books that match the specified query parameters.
 
         Args:
             query (dict): Query parameters for book search.
+            limit (int): The maximum number of books to return, defaults to the configured page size.
+            after (str): An opaque cursor returned for the previous page, only books after it are returned.
+            fields (list): The book fields to return, all fields if not specified. '_id' is always returned.
 
         Returns:
             tuple: A tuple of the filtered book list and response status code.
         """
-        if not query:
-            books_list = [BooksCollection.convert_id_to_string(book) for book in self.books_collection.find()]
-            return books_list, 200  # Return all books if no query specified
-
-        # Check if the key 'id' exists and rename it to '_id'
-        if 'id' in query:
-            query['_id'] = query.pop('id')
-        # Cast the value of '_id' to ObjectId
-        if '_id' in query:
-            if len(query['_id']) != 24:
-                return f"Id {query['_id']} is not a recognized id", 404
-            query['_id'] = ObjectId(query['_id'])
-
-        # Validate query fields
-        for field in query:
-            if field not in self.BOOK_FIELDS:
-                return None, 422  # Return 422 status code if field is not recognized
-            if field == "genre" and not self.validate_genre(query[field]):
-                return None, 422  # Return 422 status code if genre is not valid
+        query, status = self.parse_book_query(query)
+        if status != 200:
+            return query, status
+
+        # Execute the query, an empty query returns all books
+        return self.find_page("books", query, limit, after, fields, self.BOOK_PROJECTION_FIELDS, "books")
+
+    def parse_book_query(self, query: dict):
+        """
+        Validate book query parameters and convert them to a storage query.
+
+        Args:
+            query (dict): Query parameters for book search, field names mapped to string values.
+
+        Returns:
+            tuple: A tuple of the storage query, or the error content, and the status code: 200 if the query is valid.
+        """
+        if query:
+            # Check if the key 'id' exists and rename it to '_id'
+            if 'id' in query:
+                query['_id'] = query.pop('id')
+            # Cast the value of '_id' to ObjectId
+            if '_id' in query:
+                if len(query['_id']) != 24 or not ObjectId.is_valid(query['_id']):
+                    return f"Id {query['_id']} is not a recognized id", 404
+                query['_id'] = ObjectId(query['_id'])
+
+            # Validate query fields
+            for field in query:
+                if field not in self.BOOK_FIELDS:
+                    return None, 422  # Return 422 status code if field is not recognized
+                if field == "genre" and not self.validate_genre(query[field]):
+                    return None, 422  # Return 422 status code if genre is not valid
+        return query, 200
+
+    def search_books(self, text: str, limit: int = SEARCH_DEFAULT_LIMIT, prefix: bool = True):
+        """
+        Search books by words of their title and authors, best matches first.
+        The search runs on an in-process inverted index, built from the db on the first search and kept up to date
+        by the writes of this process, and of the other replicas when the caches are synced. Without the kept index,
+        when other processes write behind this one, the books are read from the db and indexed for every search.
+        Matches are read back from the db, so books deleted since are never returned.
+
+        Args:
+            text (str): The search text, every word of it must match.
+            limit (int): The maximum number of books to return.
+            prefix (bool): Whether the last word also matches the words it is a prefix of, for autocomplete.
+
+        Returns:
+            tuple: A tuple of the matching books and the response status code.
+        """
+        index = self.search_index
+        if not index.enabled:
+            index = SearchIndex()
+            index.build(self.storage.find("books", {}, {"title": 1, "authors": 1}))
+        elif not index.built:
+            with self._search_index_lock:
+                if not index.built:
+                    index.build(self.storage.find("books", {}, {"title": 1, "authors": 1}))
+
+        book_ids = [ObjectId(book_id) for book_id in index.search(text, limit, prefix)]
+        if not book_ids:
+            return [], 200
+        books = {book["_id"]: book for book in self.storage.find_by_ids("books", book_ids)}
+        return [books[book_id] for book_id in book_ids if book_id in books], 200
+
+    def get_books_batch(self, queries: list):
+        """
+        Retrieve the books matching each of many queries at once.
+        Queries not in the response cache are run together by the storage, in a single round trip with Mongo.
+
+        Args:
+            queries (list): Query parameter dicts, as accepted by get_book.
+
+        Returns:
+            list: A (content, status code) tuple per query, in the order of the queries.
+        """
+        results = [None] * len(queries)
+        pending = {}  # cache key -> (storage query, generation, indexes of the queries using it)
+        for index, query in enumerate(queries):
+            query, status = self.parse_book_query(dict(query))
+            if status != 200:
+                results[index] = (query, status)
+                continue
+            cache_key = ("books", tuple(sorted(query.items())), "batch", None, ())
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                results[index] = (cached, 200)
+            elif cache_key in pending:
+                pending[cache_key][2].append(index)
+            else:
+                pending[cache_key] = (query, self.response_cache.generation, [index])
+
+        if pending:
+            pages = self.storage.find_batch("books", [query for query, _, _ in pending.values()])
+            for (cache_key, (query, generation, indexes)), page in zip(pending.items(), pages):
+                self.response_cache.set(cache_key, page, query, generation)
+                for index in indexes:
+                    results[index] = (page, 200)
+        return results
+
+    def find_page(self, collection, query: dict, limit: int, after: str, fields: list, projection_fields,
+                  cache_namespace: str):
+        """
+        Retrieve one page of the documents of a collection that match a query, in '_id' order when paginated.
+        Pages are served from the response cache when possible.
+
+        Args:
+            collection (str): The storage collection to query, 'books' or 'ratings'.
+            query (dict): The validated storage query.
+            limit (int): The maximum number of documents to return, defaults to the configured page size.
+            after (str): An opaque cursor, only documents after it are returned.
+            fields (list): The fields to return, all fields if not specified.
+            projection_fields (frozenset): The fields that may be projected.
+            cache_namespace (str): The response cache namespace of the pages.
+
+        Returns:
+            tuple: A tuple of the document list and response status code.
+        """
+        projection = None
+        if fields:
+            if not set(fields) <= projection_fields:
+                return None, 422  # Return 422 status code if a projected field is not recognized
+            projection = {field: 1 for field in fields}
+
+        query = query or {}
+        cache_key = (cache_namespace, tuple(sorted(query.items())), limit, after, tuple(fields or ()))
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            return cached, 200
+        generation = self.response_cache.generation
+
+        after_id = None
+        if after is not None:
+            after_id = BooksCollection.decode_cursor(after)
+            if after_id is None:
+                return None, 422  # Return 422 status code if the cursor was not issued by this service
+
+        page = self.storage.find(collection, query, projection, after_id, limit or self.default_page_size)
+        self.response_cache.set(cache_key, page, query, generation)
+        return page, 200
+
+    def next_cursor(self, page: list, limit: int = None):
+        """
+        Get the cursor for the page following a page returned by get_book or get_book_ratings.
+
+        Args:
+            page (list): The documents of the current page.
+            limit (int): The limit the page was requested with, defaults to the configured page size.
+
+        Returns:
+            str: The opaque cursor of the next page, or None if this is the last page.
+        """
+        limit = limit or self.default_page_size
+        if not limit or len(page) < limit:
+            return None
+        return BooksCollection.encode_cursor(page[-1]["_id"])
+
+    @staticmethod
+    def encode_cursor(document_id):
+        """
+        Encode a document ID as an opaque pagination cursor.
+
+        Args:
+            document_id: The ID of the last document of a page, as an ObjectId or its string form.
+
+        Returns:
+            str: The cursor.
+        """
+        return base64.urlsafe_b64encode(ObjectId(document_id).binary).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        """
+        Decode a pagination cursor back to the document ID it was created from.
+
+        Args:
+            cursor (str): The cursor.
+
+        Returns:
+            ObjectId: The document ID, or None if the cursor is malformed.
+        """
+        try:
+            return ObjectId(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError, InvalidId):
+            return None
+
+    def export_books(self, since: datetime = None):
+        """
+        Iterate over every book without loading the collection in memory, for streaming exports.
+
+        Args:
+            since (datetime): Only export books created at or after this time.
+
+        Returns:
+            An iterable of the book documents in '_id' order.
+        """
+        return self.storage.export("books", since)
+
+    def export_ratings(self, since: datetime = None):
+        """
+        Iterate over every ratings document without loading the collection in memory, for streaming exports.
 
-        # Execute the query
-        filtered_books = [BooksCollection.convert_id_to_string(book) for book in self.books_collection.find(query)]
-        if not filtered_books:
-            return [], 200  # Return empty list if no books match the query
-        return filtered_books, 200
+        Args:
+            since (datetime): Only export the ratings of books created at or after this time.
+
+        Returns:
+            An iterable of the ratings documents in '_id' order.
+        """
+        return self.storage.export("ratings", since)
 
     def get_book_by_id(self, book_id: str):
         """
@@ -165,11 +515,16 @@ class BooksCollection:
         Returns:
             tuple: A tuple containing the book or None if not found, and the response status code.
         """
-        result = self.books_collection.find_one({"_id": ObjectId(book_id)})
+        cached = self.response_cache.get(("book", book_id))
+        if cached is not None:
+            return cached, 200
+        generation = self.response_cache.generation
+        result = self.storage.get("books", ObjectId(book_id))
         # if the {id} is not a recognized id
         if not result:
             return None, 404
-        return BooksCollection.convert_id_to_string(result), 200
+        self.response_cache.set(("book", book_id), result, generation=generation)
+        return result, 200
 
     def update_book(self, put_values: dict):
         """
@@ -185,19 +540,114 @@ class BooksCollection:
         if not BooksCollection.validate_genre(put_values["genre"]):
             return None, 422
         book_id = put_values.pop("id")
-        id_query = {"_id": ObjectId(book_id)}
-        update_query = {"$set": put_values}
 
         # find a book by its id and update by payload in /books resource
         try:
-            update_res = self.books_collection.update_one(id_query, update_query)
-            if update_res.matched_count == 0:  # id is not a recognized id
+            if self.enrichment is not None:
+                book = self.storage.get("books", ObjectId(book_id), {"enrichment": 1})
+                if book and book.get("enrichment") == "pending":
+                    put_values["enrichment"] = "manual"  # the client supplied the data first, no fill-in is needed
+            previous = self.storage.update_book(ObjectId(book_id), put_values)
+            if previous is None:  # id is not a recognized id
                 return None, 404
             else:
+                self.book_updated(book_id, previous, dict(previous, **put_values))
                 return book_id, 200
         except Exception as e:  # maybe an processable content
             return None, 422
 
+    def book_updated(self, book_id: str, previous: dict, updated: dict):
+        """
+        Bring the entity tags, search index, facet counters and response cache up to date with an updated book.
+        With embedded ratings, a new title also changes the ratings document of the book.
+
+        Args:
+            book_id (str): The ID of the book.
+            previous (dict): The book before the update.
+            updated (dict): The book after the update.
+        """
+        self.versions.bump("books", book_id)
+        self.search_index.add(updated)
+        # listings that held the book before or that should hold it now are both stale
+        self.response_cache.invalidate(("book", book_id))
+        self.response_cache.invalidate_matching("books", previous, updated)
+        if self.facet_counters and previous.get("genre") != updated.get("genre"):
+            # the ratings of the book move to its new genre
+            ratings = self.storage.get("ratings", ObjectId(book_id), {"sum": 1, "count": 1})
+            previous, updated = dict(previous, ratings=ratings), dict(updated, ratings=ratings)
+        self.update_facet_counters(added=[updated], removed=[previous])
+        ratings_changed = []
+        if self.storage.embedded_ratings and previous.get("title") != updated.get("title"):
+            # the ratings are read with the title of the book, they changed too
+            ratings_changed = [book_id]
+            ratings = self.storage.get("ratings", ObjectId(book_id))
+            self.versions.bump("ratings", book_id)
+            self.response_cache.invalidate(("ratings", book_id))
+            self.response_cache.invalidate_matching("ratings_list", ratings and dict(ratings, title=previous["title"]),
+                                                    ratings)
+            self.response_cache.invalidate_namespace("top")
+        self.publish_change(books=[book_id], ratings=ratings_changed)
+
+    def enrich_book(self, book_id: str, last_attempt: bool = False):
+        """
+        Fill in the Google Books data of a book stored with its enrichment 'pending', and mark it 'enriched',
+        or 'failed' if Google Books has no such ISBN or the last attempt failed.
+        The update only applies while the book is still pending, so a concurrent PUT is never overwritten.
+
+        Args:
+            book_id (str): The ID of the book.
+            last_attempt (bool): Whether to mark the book failed on a transient lookup error, instead of retrying.
+
+        Returns:
+            bool: True if the book is done with, False to retry it later.
+        """
+        book = self.storage.get("books", ObjectId(book_id), {"ISBN": 1, "enrichment": 1})
+        if book is None or book.get("enrichment") != "pending":
+            return True  # deleted or updated since it was queued
+        book_google_api_data, response_code = self.lookup_book_google_data(book["ISBN"])
+        if response_code == 200:
+            values = dict(BooksCollection.google_fields(book_google_api_data), enrichment="enriched")
+        elif response_code == 400 or last_attempt:  # Google Books has no such ISBN, or the upstream stayed down
+            logger.warning("Enrichment of book %s failed: %s", book_id, book_google_api_data.get("error"))
+            values = {"enrichment": "failed"}
+        else:
+            return False
+        self._finish_enrichment(book_id, values)
+        return True
+
+    def fail_enrichment(self, book_id: str):
+        """
+        Mark a book 'failed' once the last attempt at its enrichment raised, unless it is no longer pending.
+
+        Args:
+            book_id (str): The ID of the book.
+        """
+        self._finish_enrichment(book_id, {"enrichment": "failed"})
+
+    def _finish_enrichment(self, book_id: str, values: dict):
+        previous = self.storage.update_book(ObjectId(book_id), values, expected={"enrichment": "pending"})
+        if previous is not None:
+            self.book_updated(book_id, previous, dict(previous, **values))
+
+    def resume_enrichment(self):
+        """
+        Queue the pending books, when asynchronous enrichment is enabled. Every worker resumes on start and then
+        every ENRICHMENT_LEASE seconds, see EnrichmentQueue.resume_periodically, so each book is claimed for
+        ENRICHMENT_LEASE seconds and only queued by the worker that claimed it. The books of a worker that stopped
+        before enriching them are resumed by the first worker to resume once their claims expire.
+
+        Returns:
+            int: The number of books queued.
+        """
+        if self.enrichment is None:
+            return 0
+        pending = self.storage.find("books", {"enrichment": "pending"}, {"_id": 1})
+        claimed = self.storage.claim_books([book["_id"] for book in pending], f"{socket.gethostname()}:{os.getpid()}",
+                                           self.ENRICHMENT_LEASE)
+        for book_id in claimed:
+            self.enrichment.submit(book_id)
+        return len(claimed)
+
     def delete_book(self, book_id: str):
         """
         Delete a book from the database by its ID.
@@ -209,12 +659,20 @@ class BooksCollection:
             tuple: A tuple containing the ID of the deleted book if successful,
             None if not, and the response status code.
         """
-        query = {"_id": ObjectId(book_id)}
-        # Attempt to delete the document
-        result = self.books_collection.delete_one(query)
+        # Attempt to delete the book with its ratings
+        book, ratings = self.storage.delete_book(ObjectId(book_id), {"sum": 1, "count": 1})
         # Check if a document was deleted
-        if result.deleted_count > 0:
-            self.ratings_collection.delete_one(query)
+        if book is not None:
+            self.versions.bump("books", book_id)
+            self.versions.bump("ratings", book_id)
+            self.search_index.remove(book_id)
+            self.update_facet_counters(removed=[dict(book, ratings=ratings)])
+            self.response_cache.invalidate(("book", book_id), ("ratings", book_id))
+            # the ratings document shares the '_id' and title of the book
+            self.response_cache.invalidate_matching("books", book)
+            self.response_cache.invalidate_matching("ratings_list", book)
+            self.response_cache.invalidate_namespace("top")
+            self.publish_change(books=[book_id], ratings=[book_id])
             return book_id, 200  # Successfully deleted
         else:
             return None, 404   # ID is not a recognized id
@@ -222,6 +680,8 @@ class BooksCollection:
     def rate_book(self, book_id: str, rate: int):
         """
         Add a rating to a book and update its average rating.
+        The rating is applied atomically to the running count, sum and per-star histogram of the book,
+        so concurrent ratings are never lost and the cost does not grow with the number of ratings.
 
         Args:
             book_id (str): The ID of the book to rate in the db.
@@ -231,28 +691,151 @@ class BooksCollection:
             tuple: A tuple containing the book ID, the new average rating if successful,
             or None if not, and the response status code.
         """
-        if not float(int(rate)) == rate or int(rate) not in [1, 2, 3, 4, 5]:  # invalid rating
+        if not validate_rating(rate):  # invalid rating
             return None, None, 422
 
-        query = {"_id": ObjectId(book_id)}
-        document = self.ratings_collection.find_one(query)
-        if document:
-            ratings = document.get("values", [])
-            ratings.append(rate)
-            new_average = sum(ratings) / len(ratings)
-
-            # Update the document with new ratings and average
-            update_result = self.ratings_collection.update_one(
-                query,
-                {"$set": {"values": ratings, "average": new_average}}
-            )
-            if update_result.modified_count > 0:
-                return book_id, new_average, 201  # Successfully updated
+        document = self.storage.add_rating(ObjectId(book_id), rate, self.max_rating_values)
+        if not document:
+            return None, None, 404  # ID is not a recognized id
+
+        new_average = document["sum"] / document["count"]
+        # Store the average and the leaderboard eligibility,
+        # unless a concurrent rating has already moved the count on and stores its own
+        self.storage.set_rating_average(document["_id"], document["count"], new_average,
+                                        document["count"] >= self.TOP_MIN_RATINGS)
+        self.versions.bump("ratings", book_id)
+        if self.facet_counters:
+            book = self.storage.get("books", document["_id"], {"genre": 1})
+            if book:
+                self.update_facet_counters(rated=[(book["genre"], rate)])
+        self.response_cache.invalidate(("ratings", book_id))
+        self.response_cache.invalidate_matching("ratings_list", document)
+        if document["count"] >= self.TOP_MIN_RATINGS:  # books not yet eligible cannot be on the leaderboard
+            self.response_cache.invalidate_namespace("top")
+        self.publish_change(ratings=[book_id])
+        return book_id, new_average, 201
+
+    def rate_books(self, entries: list):
+        """
+        Add many ratings at once. The ratings are grouped per book and applied with one bulk write, and the
+        averages, the leaderboard and the caches are updated once for the whole batch rather than once per rating.
+
+        Args:
+            entries (list): A list of dicts, each with the 'book_id' of a book and a rating 'value'.
+
+        Returns:
+            tuple: A tuple containing a per-entry list of results (each with the entry index, its status code,
+            and the book ID with its new average or an error message) and the number of ratings added.
+        """
+        results = [None] * len(entries)
+        ratings = defaultdict(list)  # book ID -> values, in the order they were given
+        indexes = defaultdict(list)  # book ID -> indexes of its entries
+        for index, entry in enumerate(entries):
+            book_id = entry.get("book_id") if isinstance(entry, dict) else None
+            try:
+                rate = float(entry["value"])
+            except (KeyError, TypeError, ValueError):
+                rate = None
+            if rate is None or not isinstance(book_id, str) or not validate_rating(rate):
+                results[index] = {"index": index, "ID": book_id, "status": 422, "message": "Error updating rating"}
+            elif len(book_id) != 24 or not ObjectId.is_valid(book_id):
+                results[index] = {"index": index, "ID": book_id, "status": 404, "message": "Book ID not recognized"}
             else:
-                return None, None, 404  # Update failed
+                ratings[ObjectId(book_id)].append(rate)
+                indexes[ObjectId(book_id)].append(index)
+
+        documents = self.storage.add_ratings(dict(ratings), self.max_rating_values) if ratings else []
+        # Store the averages and the leaderboard eligibility, as rate_book does
+        self.storage.set_rating_averages([(document["_id"], document["count"], document["sum"] / document["count"],
+                                           document["count"] >= self.TOP_MIN_RATINGS) for document in documents])
+        rated = 0
+        for document in documents:
+            for index in indexes.pop(document["_id"]):
+                results[index] = {"index": index, "ID": str(document["_id"]), "status": 201,
+                                  "average": document["sum"] / document["count"]}
+                rated += 1
+        for book_id, book_indexes in indexes.items():  # the books that do not exist
+            for index in book_indexes:
+                results[index] = {"index": index, "ID": str(book_id), "status": 404,
+                                  "message": "Book ID not recognized"}
+
+        if documents:
+            book_ids = [str(document["_id"]) for document in documents]
+            self.versions.bump("ratings", *book_ids)
+            if self.facet_counters:
+                books = self.storage.find_by_ids("books", [document["_id"] for document in documents])
+                self.update_facet_counters(rated=[(book["genre"], rate) for book in books
+                                                  for rate in ratings[book["_id"]]])
+            self.response_cache.invalidate(*[("ratings", book_id) for book_id in book_ids])
+            self.response_cache.invalidate_matching("ratings_list", *documents)
+            if any(document["count"] >= self.TOP_MIN_RATINGS for document in documents):
+                self.response_cache.invalidate_namespace("top")
+            self.publish_change(ratings=book_ids)
+        return results, rated
+
+    def publish_change(self, **changes):
+        """
+        Tell the other replicas which documents a write changed, when the caches are kept coherent across replicas.
+
+        Args:
+            changes (list): The IDs of the documents written, per collection name.
+        """
+        if self.cache_sync is not None:
+            self.cache_sync.publish(changes)
 
+    def invalidate_cached(self, collection: str, document_ids: list, version: int, documents: dict = None):
+        """
+        Drop what this process cached about documents written by another process. Without the previous version
+        of the books, the book listings that hold them are dropped along with those they now match, and every
+        cached listing of the ratings.
+
+        Args:
+            collection (str): The collection name, 'books' or 'ratings'.
+            document_ids (list): The IDs of the written documents.
+            version (int): The shared version of the write, see ChangeListener.
+            documents (dict): The written books by ID, None for deleted ones. The books are read from the db when
+                not given.
+        """
+        document_ids = [str(document_id) for document_id in document_ids]
+        self.versions.record(collection, document_ids, version)
+        if collection == "books":
+            if documents is None:
+                found = self.storage.find_by_ids("books", [ObjectId(document_id) for document_id in document_ids])
+                documents = {str(book["_id"]): book for book in found}
+            self.response_cache.invalidate(*[("book", document_id) for document_id in document_ids])
+            self.response_cache.invalidate_holding("books", document_ids, *documents.values())
+            if self.search_index.built:
+                for document_id in document_ids:
+                    if documents.get(document_id):
+                        self.search_index.add(documents[document_id])
+                    else:
+                        self.search_index.remove(document_id)
         else:
-            return None, None, 404  # ID is not a recognized id
+            self.response_cache.invalidate(*[("ratings", document_id) for document_id in document_ids])
+            self.response_cache.invalidate_namespace("ratings_list")
+            self.response_cache.invalidate_namespace("top")
+
+    def invalidate_all_cached(self, floor: int = None):
+        """
+        Drop every cached result, entity tag and the search index, when the writes of another process are unknown.
+
+        Args:
+            floor (int): The shared version above every write applied so far, when the versions are shared.
+        """
+        self.response_cache.clear()
+        self.versions.reset(floor)
+        with self._search_index_lock:
+            self.search_index.clear()  # rebuilt on the next search
+
+    def backfill_rating_aggregates(self):
+        """
+        Compute the running count, sum, histogram and leaderboard eligibility of ratings documents
+        created before they were stored.
+
+        Returns:
+            int: The number of ratings documents updated.
+        """
+        return self.storage.backfill_rating_aggregates(self.TOP_MIN_RATINGS)
 
     def get_book_ratings_by_id(self, book_id: str):
         """
@@ -264,24 +847,30 @@ class BooksCollection:
         Returns:
             tuple: A tuple containing the ratings if found, None if not, and the response status code.
         """
-        result = self.ratings_collection.find_one({"_id": ObjectId(book_id)})
+        cached = self.response_cache.get(("ratings", book_id))
+        if cached is not None:
+            return cached, 200
+        generation = self.response_cache.generation
+        result = self.storage.get("ratings", ObjectId(book_id))
         # if the {id} is not a recognized id
         if not result:
             return None, 404
-        return BooksCollection.convert_id_to_string(result), 200
+        self.response_cache.set(("ratings", book_id), result, generation=generation)
+        return result, 200
 
-    def get_book_ratings(self, query: dict):
+    def get_book_ratings(self, query: dict, limit: int = None, after: str = None, fields: list = None):
         """
         Retrieve the ratings for all books.
 
+        Args:
+            query (dict): Query parameters for ratings search.
+            limit (int): The maximum number of ratings to return, defaults to the configured page size.
+            after (str): An opaque cursor returned for the previous page, only ratings after it are returned.
+            fields (list): The ratings fields to return, all fields if not specified. '_id' is always returned.
+
         Returns:
             tuple: A tuple containing all ratings and the response status code.
         """
-        # If not specified, return all ratings data
-        if not query:
-            ratings_list = [BooksCollection.convert_id_to_string(rating) for rating in self.ratings_collection.find()]
-            return ratings_list, 200
-
         # Check for invalid query fields or unsupported genres
         for field, value in query.items():
             if field not in self.BOOK_FIELDS:
@@ -289,49 +878,148 @@ class BooksCollection:
             if field == "genre" and not self.validate_genre(value):
                 return None, 422  # Bad request due to unsupported genre
 
-        # Execute the query
-        filtered_ratings = [BooksCollection.convert_id_to_string(rating) for rating in
-                            self.ratings_collection.find(query)]
-        if not filtered_ratings:
-            return [], 200  # No results found, but the query was valid
-        return filtered_ratings, 200
+        # Execute the query, if not specified return all ratings data
+        return self.find_page("ratings", query, limit, after, fields, self.RATING_PROJECTION_FIELDS, "ratings_list")
 
-    def get_top(self):
+    def get_top(self, k: int = TOP_DEFAULT_K):
         """
-        Retrieve the top three books with the highest average ratings that have at least three ratings.
+        Retrieve the top k books with the highest average ratings that have at least three ratings.
+        The eligibility of every book is maintained by rate_book, so only the eligible books are ranked.
+
+        Args:
+            k (int): The number of books to return.
 
         Returns:
             tuple: A tuple containing the list of top-rated books and the response status code.
         """
-        # Aggregation pipeline to find the top 3 books
-        relevant_ratings_pipeline = [
-            {"$match": {"$expr": {"$gte": [{"$size": "$values"}, 3]}}},
-            # Corrected to filter documents with at least 3 ratings
-            {"$sort": {"average": -1}},  # Sort documents by the average field in descending order
-            {"$limit": 3}  # Limit the results to the top 3
-        ]
-
-        # Execute the aggregation pipeline
-        top_books = [BooksCollection.convert_id_to_string(rate) for rate in self.ratings_collection.aggregate(relevant_ratings_pipeline)]
+        cached = self.response_cache.get(("top", k))
+        if cached is not None:
+            return cached, 200
+        generation = self.response_cache.generation
+        top_books = self.storage.top(k)
+        self.response_cache.set(("top", k), top_books, generation=generation)
         return top_books, 200  # Return the top books and status code
 
+    def get_facets(self):
+        """
+        Count the books per genre, publication year and publisher, and compute the average rating per genre.
+
+        Returns:
+            tuple: A tuple of the facets, each mapping a value to its count or average, and the response status code.
+        """
+        if self.facet_counters:
+            counters = self.storage.get_facet_counters()
+        else:
+            counters = self.storage.aggregate_facets()
+        facets = {"genre": {}, "year": {}, "publisher": {}, "average_rating_by_genre": {}}
+        for counter in counters:
+            if counter.get("count", 0) > 0:
+                facets[counter["facet"]][counter["value"]] = counter["count"]
+            if counter["facet"] == "genre" and counter.get("rating_count", 0) > 0:
+                facets["average_rating_by_genre"][counter["value"]] = counter["rating_sum"] / counter["rating_count"]
+        return facets, 200
+
+    def update_facet_counters(self, added=(), removed=(), rated=()):
+        """
+        Apply the changes of a write to the facet counters, in one storage write. Does nothing unless the counters
+        are enabled.
+
+        Args:
+            added (list): The books added, or the new version of updated books.
+            removed (list): The books removed, or the previous version of updated books. The ratings aggregate
+                of a deleted book may be given under 'ratings' to remove its ratings from its genre.
+            rated (list): (genre, rating) pairs of the new ratings.
+        """
+        if not self.facet_counters:
+            return
+        deltas = defaultdict(lambda: defaultdict(int))  # (facet, value) -> field -> increment
+        for books, sign in ((added, 1), (removed, -1)):
+            for book in books:
+                for facet_value in BooksCollection.facet_values(book):
+                    deltas[facet_value]["count"] += sign
+                if book.get("ratings"):
+                    deltas[("genre", book["genre"])]["rating_sum"] += sign * book["ratings"]["sum"]
+                    deltas[("genre", book["genre"])]["rating_count"] += sign * book["ratings"]["count"]
+        for genre, rate in rated:
+            deltas[("genre", genre)]["rating_sum"] += rate
+            deltas[("genre", genre)]["rating_count"] += 1
+
+        self.storage.apply_facet_deltas({facet_value: increments for facet_value, increments in deltas.items()
+                                         if any(increments.values())})
+
+    def ensure_facet_counters(self):
+        """
+        Build the stored facet counters if they are enabled and were never built. The counters of a storage
+        written by several processes are only started here for an empty catalog, concurrent rebuilds by every
+        worker would lose the counts of their writes. Otherwise they are built by migrations/build_facet_counters.py,
+        and until then this process aggregates the facets on every read.
+        """
+        if not self.facet_counters or self.storage.has_facet_counters():
+            return
+        if not self.storage.multi_process:
+            self.rebuild_facet_counters()
+        elif not self.storage.find("books", {}, {"_id": 1}, limit=1):
+            self.storage.mark_facet_counters_built()
+        else:
+            logger.error("The facet counters were never built, run migrations/build_facet_counters.py with the "
+                         "writes stopped and restart, the facets are aggregated on every read until then")
+            self.facet_counters = False
+
+    def rebuild_facet_counters(self):
+        """
+        Recompute the stored facet counters from the books and ratings, with the writes stopped.
+        Needed when the counters are first enabled, or after the service ran with them disabled.
+        """
+        self.storage.replace_facet_counters(self.storage.aggregate_facets())
+
     @staticmethod
-    def convert_id_to_string(book: dict):
+    def facet_values(book: dict):
         """
-        Convert the '_id' field of a book document to a string.
+        Get the facet values a book is counted under.
 
         Args:
-            book (dict): A book document.
+            book (dict): The book document.
 
         Returns:
-            dict: The book document with the '_id' field as a string.
+            list: (facet, value) pairs for its genre, publication year if known, and publisher.
         """
-        if '_id' in book:
-            book['_id'] = str(book['_id'])
-        return book
+        values = [("genre", book.get("genre")), ("publisher", book.get("publisher"))]
+        published_date = book.get("publishedDate")
+        if isinstance(published_date, str) and BooksCollection.validate_publish_date(published_date):
+            values.append(("year", published_date[:4]))
+        return values
 
-    @staticmethod
-    def get_book_google_data(isbn: str):
+    def ensure_indexes(self):
+        """
+        Create the indexes used by the service's queries. Creating an index that already exists is a no-op,
+        so this is safe to run on every start.
+        """
+        self.storage.ensure_indexes()
+        self.isbn_cache.ensure_indexes()
+
+    def lookup_book_google_data(self, isbn: str):
+        """
+        Fetch book data from Google Books API through the ISBN cache.
+        Successful lookups and ISBNs unknown to Google are cached, transient request errors are not.
+
+        Args:
+            isbn (str): The ISBN of the book.
+
+        Returns:
+            tuple: A tuple containing the book data from Google Books and the response status code.
+        """
+        cached = self.isbn_cache.get(isbn)
+        if cached is not None:
+            return cached
+
+        book_google_api_data, response_code = self.get_book_google_data(isbn)
+        if response_code == 200:
+            self.isbn_cache.set(isbn, book_google_api_data, response_code)
+        elif book_google_api_data.get("error") == BooksCollection.GOOGLE_NO_ITEMS_ERROR:
+            self.isbn_cache.set(isbn, book_google_api_data, response_code, negative=True)
+        return book_google_api_data, response_code
+
+    def get_book_google_data(self, isbn: str):
         """
         Fetch book data from Google Books API using the ISBN.
 
@@ -341,19 +1029,4 @@ class BooksCollection:
         Returns:
             tuple: A tuple containing the book data from Google Books and the response status code.
         """
-        google_books_url = f"https://www.googleapis.com/books/v1/volumes?q=isbn:{isbn}"
-        try:
-            response = requests.get(google_books_url)
-            if response.json().get('totalItems', 0) == 0:
-                return {"error": "no items returned from Google Books API for given ISBN number"}, 400
-            else:
-                google_books_data = response.json()['items'][0]['volumeInfo']
-        except requests.exceptions.RequestException as e:
-            return {"error": str(e)}, 400
-
-        book_google_api_data = {
-            "authors": google_books_data.get("authors"),
-            "publisher": google_books_data.get("publisher"),
-            "publishedDate": google_books_data.get("publishedDate")
-        }
-        return book_google_api_data, 200
+        return self.google_books.lookup(isbn)
@@ -0,0 +1,484 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+
+class TTLCache:
+    """
+    A thread-safe, size-bounded LRU cache whose entries expire after a per-entry time to live.
+    """
+
+    def __init__(self, max_size=1024, default_ttl=300):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Retrieve a value from the cache and mark it as recently used.
+
+        Args:
+            key: The cache key.
+            default: The value returned when the key is missing or expired.
+
+        Returns:
+            The cached value, or default if not found.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():  # expired entries count as misses
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value in the cache, evicting the least recently used entries if the cache is full.
+
+        Args:
+            key: The cache key.
+            value: The value to store.
+            ttl (float): Time to live in seconds, defaults to the cache's default TTL.
+        """
+        ttl = self.default_ttl if ttl is None else ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Remove a key from the cache if present.
+
+        Args:
+            key: The cache key.
+
+        Returns:
+            bool: True if the key was in the cache.
+        """
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def delete_where(self, predicate):
+        """
+        Remove every entry whose key and value match a predicate.
+
+        Args:
+            predicate (callable): Called with each key and value, returns True for the entries to remove.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        with self._lock:
+            keys = [key for key, (_, value) in self._entries.items() if predicate(key, value)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Report the cache counters.
+
+        Returns:
+            dict: Size, hit, miss and eviction counters, and the hit ratio.
+        """
+        lookups = self.hits + self.misses
+        return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+class IsbnCache:
+    """
+    Two-tier cache for Google Books ISBN lookups: an in-process LRU in front of a Mongo collection.
+    Entries in Mongo are expired by a TTL index on 'expires_at'. Without a collection only the in-process tier is used.
+    """
+
+    def __init__(self, collection, max_size=4096, ttl=24 * 60 * 60, negative_ttl=10 * 60):
+        self.collection = collection
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.local = TTLCache(max_size=max_size, default_ttl=ttl)
+        self.store_hits = 0
+        self.store_misses = 0
+
+    def ensure_indexes(self):
+        """
+        Create the TTL index that lets Mongo drop expired lookups on its own.
+        """
+        if self.collection is not None:
+            self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def get(self, isbn: str):
+        """
+        Look up a cached Google Books result, first in process memory and then in Mongo.
+
+        Args:
+            isbn (str): The ISBN of the book.
+
+        Returns:
+            tuple: The cached (data, status) pair, or None if the ISBN is not cached.
+        """
+        cached = self.local.get(isbn)
+        if cached is not None or self.collection is None:
+            return cached
+
+        document = self.collection.find_one({"_id": isbn, "expires_at": {"$gt": datetime.utcnow()}})
+        if not document:
+            self.store_misses += 1
+            return None
+        self.store_hits += 1
+        cached = (document["data"], document["status"])
+        # keep the local copy no longer than the shared one
+        remaining = (document["expires_at"] - datetime.utcnow()).total_seconds()
+        self.local.set(isbn, cached, ttl=max(remaining, 0))
+        return cached
+
+    def set(self, isbn: str, data: dict, status: int, negative: bool = False):
+        """
+        Cache a Google Books result in both tiers.
+
+        Args:
+            isbn (str): The ISBN of the book.
+            data (dict): The lookup result.
+            status (int): The lookup response status code.
+            negative (bool): Whether this is a failed lookup, cached for the shorter negative TTL.
+        """
+        ttl = self.negative_ttl if negative else self.ttl
+        self.local.set(isbn, (data, status), ttl=ttl)
+        if self.collection is not None:
+            self.collection.replace_one({"_id": isbn},
+                                        {"_id": isbn, "data": data, "status": status,
+                                         "expires_at": datetime.utcnow() + timedelta(seconds=ttl)},
+                                        upsert=True)
+
+    def stats(self):
+        """
+        Report the hit and miss counters of both tiers.
+
+        Returns:
+            dict: Counters for the in-process tier and the Mongo tier.
+        """
+        return {"local": self.local.stats(), "store": {"hits": self.store_hits, "misses": self.store_misses}}
+
+
+class ResponseCache:
+    """
+    Read-through cache of query results, invalidated by the writes that could change them.
+    Keys are tuples whose first item is a namespace, e.g. ("book", book_id) or ("books", <query>).
+    Listing results are stored with the Mongo filter that produced them, so a write only drops
+    the listings whose filter matches the written document. A max_size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size=2048, ttl=60):
+        self.entries = TTLCache(max_size=max_size, default_ttl=ttl)
+        self.invalidations = 0
+        # bumped by every invalidation, so a read that raced a write does not cache what it read before the write
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Retrieve a cached result.
+
+        Args:
+            key (tuple): The cache key.
+
+        Returns:
+            The cached result, or None if not cached.
+        """
+        entry = self.entries.get(key)
+        return None if entry is None else entry[1]
+
+    def set(self, key, result, query: dict = None, generation: int = None):
+        """
+        Cache a result.
+
+        Args:
+            key (tuple): The cache key.
+            result: The result to cache.
+            query (dict): For listing results, the Mongo equality filter the result was read with.
+            generation (int): The cache generation read before querying the db. The result is not cached
+                if anything was invalidated since.
+        """
+        if not self.entries.max_size:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries.set(key, (query, result))
+
+    def _invalidate_where(self, predicate):
+        """
+        Drop the entries matching a predicate. The generation is bumped first, so a concurrent read either
+        caches its result before the entries are dropped or is refused by set.
+
+        Args:
+            predicate (callable): Called with each key and entry, returns True for the entries to drop.
+        """
+        with self._lock:
+            self.generation += 1
+        dropped = self.entries.delete_where(predicate)
+        with self._lock:
+            self.invalidations += dropped
+
+    def invalidate(self, *keys):
+        """
+        Drop the cached results of the given keys.
+
+        Args:
+            keys (tuple): The cache keys.
+        """
+        with self._lock:
+            self.generation += 1
+        dropped = sum(self.entries.delete(key) for key in keys)
+        with self._lock:
+            self.invalidations += dropped
+
+    def invalidate_namespace(self, namespace: str):
+        """
+        Drop every cached result of a namespace.
+
+        Args:
+            namespace (str): The namespace, the first item of the keys.
+        """
+        self._invalidate_where(lambda key, entry: key[0] == namespace)
+
+    def invalidate_matching(self, namespace: str, *documents):
+        """
+        Drop the cached listings of a namespace that could include any of the given documents,
+        before or after a write.
+
+        Args:
+            namespace (str): The namespace of the listings.
+            documents (dict): The written documents, None entries are ignored.
+        """
+        documents = [document for document in documents if document]
+        self._invalidate_where(lambda key, entry: key[0] == namespace and self._matches(entry[0], documents))
+
+    def invalidate_holding(self, namespace: str, document_ids, *documents):
+        """
+        Drop the cached listings of a namespace that hold any of the given documents, with the other pages of
+        their filter, or that could include them after a write. For writes whose previous documents are unknown.
+
+        Args:
+            namespace (str): The namespace of the listings.
+            document_ids (list): The IDs of the written documents, as strings.
+            documents (dict): The written documents, None entries are ignored.
+        """
+        document_ids = set(document_ids)
+        documents = [document for document in documents if document]
+        stale = set()  # the filters of the listings that held a document, all of their pages shift
+
+        def holds(key, entry):
+            query, result = entry
+            if key[0] != namespace:
+                return False
+            if self._matches(query, documents) or any(str(document["_id"]) in document_ids for document in result):
+                stale.add(key[1])
+                return True
+            return False
+
+        self._invalidate_where(holds)
+        if stale:
+            self._invalidate_where(lambda key, entry: key[0] == namespace and key[1] in stale)
+
+    @staticmethod
+    def _matches(query: dict, documents: list):
+        return any(all(document.get(field) == value for field, value in (query or {}).items())
+                   for document in documents)
+
+    def clear(self):
+        """
+        Drop every cached result.
+        """
+        self._invalidate_where(lambda key, entry: True)
+
+    def stats(self):
+        """
+        Report the cache counters.
+
+        Returns:
+            dict: Size, hit, miss, eviction and invalidation counters, and the hit ratio.
+        """
+        return dict(self.entries.stats(), invalidations=self.invalidations)
+
+
+class VersionTracker:
+    """
+    Versions of each collection and each document, moved on by every write.
+    Versions live in process memory, so entity tags built from them can be checked without a db query.
+
+    Alone, a process numbers the writes with its own clock, under an epoch of its own, so tags issued by another
+    process or before a restart never match. Once cache sync follows the changes, see ChangeListener, versions are
+    the positions of the changes in the sequence shared by every process, under a shared epoch, so every worker
+    issues the same tags. The documents not written since the shared floor of the sequence have the floor as
+    version. A write of this process is then untagged until its shared version is known.
+
+    Only the most recently written documents are tracked, the others have the version of the last one forgotten.
+    That version is above every version they had before their last write, so their old tags never match again.
+    """
+
+    def __init__(self, enabled=True, max_documents=100000):
+        """
+        Args:
+            enabled (bool): Whether to issue entity tags, etag returns None otherwise.
+            max_documents (int): The number of written documents whose versions are tracked.
+        """
+        self.enabled = enabled
+        self.max_documents = max_documents
+        self.epoch = uuid.uuid4().hex[:12]
+        self.shared = False  # whether the versions come from the shared sequence of cache sync
+        self._collections = {}
+        self._documents = OrderedDict()  # (collection, document ID) -> version, least recently written first
+        self._unconfirmed = set()  # the collections and documents written here whose shared version is not known
+        self._clock = 0
+        self._forgotten = 0  # the version of the documents not tracked
+        self._lock = threading.Lock()
+
+    def follow(self, epoch: str, floor: int):
+        """
+        Take the versions from the shared sequence of changes from now on, forgetting the versions known so far.
+
+        Args:
+            epoch (str): The epoch of the sequence.
+            floor (int): The version of the documents not written since, every later change must be recorded.
+        """
+        with self._lock:
+            self.shared = True
+            self.epoch = epoch
+            self._collections.clear()
+            self._documents.clear()
+            self._unconfirmed.clear()
+            self._forgotten = floor
+
+    def raise_floor(self, floor: int):
+        """
+        Forget the versions at or below a new floor of the shared sequence, the documents get the floor instead.
+
+        Args:
+            floor (int): The new floor.
+        """
+        with self._lock:
+            if floor <= self._forgotten:
+                return
+            self._forgotten = floor
+            for key in [key for key, version in self._documents.items() if version <= floor]:
+                del self._documents[key]
+            for collection in [collection for collection, version in self._collections.items() if version <= floor]:
+                del self._collections[collection]
+
+    def bump(self, collection: str, *document_ids):
+        """
+        Record a write of this process to a collection and to some of its documents. Once following the shared
+        sequence, they are untagged until record gives their version.
+
+        Args:
+            collection (str): The collection name.
+            document_ids (str): The IDs of the written documents.
+        """
+        if not self.enabled:
+            return
+        if self.shared:
+            with self._lock:
+                self._unconfirmed.add(collection)
+                self._unconfirmed.update((collection, str(document_id)) for document_id in document_ids)
+            return
+        with self._lock:
+            self._clock += 1
+            self._record(collection, document_ids, self._clock)
+
+    def record(self, collection: str, document_ids, version: int):
+        """
+        Record a change of the shared sequence, made by any process. Versions only move forward, a change applied
+        after a later one of the same document is ignored.
+
+        Args:
+            collection (str): The collection name.
+            document_ids (list): The IDs of the changed documents.
+            version (int): The version of the change.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._unconfirmed.discard(collection)
+            self._unconfirmed.difference_update((collection, str(document_id)) for document_id in document_ids)
+            self._record(collection, document_ids, version)
+
+    def _record(self, collection: str, document_ids, version: int):
+        if version <= self._forgotten:
+            return
+        self._collections[collection] = max(self._collections.get(collection, 0), version)
+        for document_id in document_ids:
+            key = (collection, str(document_id))
+            version = max(self._documents.pop(key, 0), version)
+            self._documents[key] = version
+        while len(self._documents) > self.max_documents:
+            _, forgotten = self._documents.popitem(last=False)
+            self._forgotten = max(self._forgotten, forgotten)
+
+    def reset(self, floor: int = None):
+        """
+        Make every entity tag issued so far stop matching, when the writes since they were issued are unknown.
+        Alone, a new epoch starts, following the shared sequence the floor is raised.
+
+        Args:
+            floor (int): The new floor of the shared sequence, above every version issued so far.
+        """
+        if self.shared:
+            with self._lock:
+                self._unconfirmed.clear()
+            self.raise_floor(floor)
+            return
+        with self._lock:
+            self.epoch = uuid.uuid4().hex[:12]
+            self._collections.clear()
+            self._documents.clear()
+            self._clock = self._forgotten = 0
+
+    def etag(self, collection: str, document_id: str = None):
+        """
+        Get the entity tag of a collection or of one of its documents.
+
+        Args:
+            collection (str): The collection name.
+            document_id (str): The document ID, None for the whole collection.
+
+        Returns:
+            str: The unquoted entity tag, None when entity tags are disabled or a write is not confirmed yet.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            if document_id is None:
+                if collection in self._unconfirmed:
+                    return None
+                return f"{self.epoch}-{collection}-{self._collections.get(collection, self._forgotten)}"
+            key = (collection, str(document_id))
+            if key in self._unconfirmed:
+                return None
+            return f"{self.epoch}-{collection}-{document_id}-{self._documents.get(key, self._forgotten)}"
@@ -0,0 +1,387 @@
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+SYNCED_COLLECTIONS = ("books", "ratings")
+# change stream events that change a single document, the others (drop, rename, invalidate) affect a whole collection
+DOCUMENT_OPERATIONS = frozenset(["insert", "update", "replace", "delete"])
+
+
+class ChangeListener:
+    """
+    Keeps the in-process caches of every service replica, and of every worker of a replica, coherent with the
+    writes made by the others: the response cache, the entity tag versions and the search index.
+
+    On a replica set the listener follows a change stream over the books and ratings collections, so it sees every
+    write whoever made it. On a standalone server, which has no change streams, it falls back to polling: every
+    write bumps a version counter and logs the IDs it changed under the new version, and each process applies the
+    versions it has not seen yet. Either way a replica's caches lag the writes of the others by at most about
+    the poll interval, or the change stream latency.
+
+    The entity tag versions are the positions of the changes in that shared sequence, the log versions or the
+    cluster times of the change stream events, so every process issues the same tags. A floor stored with the
+    sequence is the version of the documents not written since, and each process starts by replaying the changes
+    after it. The floor is raised when those changes are no longer known, or older than the retention.
+    """
+
+    AUTO, WATCH, POLL = "auto", "watch", "poll"
+    COUNTER_ID = "changes"
+    FLOOR_ID = "watch"  # the floor and epoch of the change stream versions
+
+    def __init__(self, db, books_collection, mode=AUTO, poll_interval=1.0, retry_delay=1.0, gap_timeout=10.0,
+                 retention=60 * 60):
+        """
+        Args:
+            db: The PyMongo database of the books and ratings collections.
+            books_collection (BooksCollection): The books collection whose caches are kept coherent.
+            mode (str): 'watch' for a change stream, 'poll' for the version counter, or 'auto' to watch when the
+                server supports change streams and poll otherwise.
+            poll_interval (float): Seconds between polls, also how long a change stream waits for an event.
+            retry_delay (float): Seconds to wait before reopening a change stream after an error.
+            gap_timeout (float): Seconds a missing version is waited for before every cache is dropped instead.
+                A version is missing while its writer has bumped the counter but not logged its change yet.
+            retention (int): Seconds the logged changes are kept, removed by a TTL index, and the longest a
+                starting process replays.
+        """
+        if mode not in (self.AUTO, self.WATCH, self.POLL):
+            raise ValueError(f"cache sync mode must be auto, watch or poll, got {mode}")
+        self.db = db
+        self.books_collection = books_collection
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.gap_timeout = gap_timeout
+        self.retention = retention
+        self.counter_collection = db.cache_sync
+        self.changes_collection = db.cache_changes
+        # the changes this process logged only move its versions when polled, it applied them to its caches already
+        self.origin = uuid.uuid4().hex
+        self.version = 0  # the last logged version applied
+        self.epoch = None  # the epoch of the shared sequence of changes
+        self._stream = None
+        self._resume_token = None
+        self._start_at = None  # the cluster time a new change stream starts at, without a resume token
+        self._gap_since = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self.counters = {"changes": 0, "full_invalidations": 0, "errors": 0, "publish_errors": 0}
+        self.lag = 0.0  # seconds between the last change applied and its write
+
+    def start(self, background=True):
+        """
+        Pick the sync mode and start following the writes of the other processes. Call it before serving writes,
+        so the polling mode logs every one of them.
+
+        Args:
+            background (bool): Whether to follow the changes on a daemon thread. Without it, call poll() directly.
+        """
+        if self.mode != self.POLL:
+            try:
+                self._open_stream().close()
+                self.mode = self.WATCH
+            except OperationFailure as e:  # a standalone server has no change streams
+                if self.mode == self.WATCH:
+                    raise
+                logger.info("Change streams are not available (%s), polling for changes", e)
+                self.mode = self.POLL
+        if self.mode == self.WATCH:
+            self._catch_up_stream()
+        else:
+            self.changes_collection.create_index("at", expireAfterSeconds=self.retention)
+            self._catch_up_log()
+        if background:
+            target = self._watch if self.mode == self.WATCH else self._poll_periodically
+            threading.Thread(target=target, name="cache-sync", daemon=True).start()
+
+    def stop(self):
+        """
+        Stop following the changes.
+        """
+        self._stopped.set()
+
+    def publish(self, changes: dict):
+        """
+        Log a write for the other processes to apply, in polling mode only. Change streams see the writes on
+        their own. A failure to log is not raised, as the write itself succeeded: the other processes then serve
+        what they cached until it expires, or drop every cache once the missing version times out.
+
+        Args:
+            changes (dict): The IDs of the documents written, per collection name.
+        """
+        if self.mode != self.POLL:
+            return
+        try:
+            counter = self.counter_collection.find_one_and_update(
+                {"_id": self.COUNTER_ID}, {"$inc": {"version": 1}, "$setOnInsert": {"floor": 0, "epoch": new_epoch()}},
+                upsert=True, return_document=ReturnDocument.AFTER)
+            entry = {collection: [str(document_id) for document_id in document_ids]
+                     for collection, document_ids in changes.items() if document_ids}
+            self.changes_collection.insert_one(dict(entry, _id=counter["version"], origin=self.origin,
+                                                    at=datetime.utcnow()))
+        except PyMongoError:
+            logger.exception("Failed to publish a change for the other replicas")
+            self._count("publish_errors")
+
+    def poll(self):
+        """
+        Apply the logged changes of the versions not seen yet, in version order.
+
+        Returns:
+            int: The number of versions applied.
+        """
+        counter = self.counter_collection.find_one({"_id": self.COUNTER_ID}) or {}
+        latest = counter.get("version", 0)
+        if latest < self.version or counter.get("epoch", self.epoch) != self.epoch:
+            # the counter was reset, nothing tells what changed since
+            self._catch_up_log(replay=False)
+            self._invalidate_all(self.version)
+            return 0
+
+        applied = 0
+        if latest > self.version:
+            for entry in self.changes_collection.find({"_id": {"$gt": self.version, "$lte": latest}}).sort("_id", 1):
+                if entry["_id"] != self.version + 1:
+                    break  # the next version is not logged yet
+                self.apply_entry(entry)
+                applied += 1
+
+        if self.version == latest:
+            self._gap_since = None
+        elif self._gap_since is None:
+            self._gap_since = time.monotonic()
+        elif time.monotonic() - self._gap_since >= self.gap_timeout:
+            # the writer of the missing version failed to log it, or the log expired
+            logger.warning("Change versions %d to %d are missing, dropping every cache", self.version + 1, latest)
+            self._invalidate_all(latest)
+            self.version = latest
+            self._gap_since = None
+            self.counter_collection.update_one({"_id": self.COUNTER_ID}, {"$max": {"floor": latest}})
+        # the floor raised by another process, once this one applied the changes below it
+        self.books_collection.versions.raise_floor(min(counter.get("floor", 0), self.version))
+        return applied
+
+    def apply_entry(self, entry: dict):
+        """
+        Apply a logged change to the caches, or only to the versions for a change of this process.
+
+        Args:
+            entry (dict): The logged change.
+        """
+        for collection in SYNCED_COLLECTIONS:
+            if not entry.get(collection):
+                continue
+            if entry["origin"] == self.origin:  # the caches were brought up to date by the write
+                self.books_collection.versions.record(collection, entry[collection], entry["_id"])
+            else:
+                self.books_collection.invalidate_cached(collection, entry[collection], entry["_id"])
+        if entry["origin"] != self.origin:
+            self.lag = max((datetime.utcnow() - entry["at"]).total_seconds(), 0.0)
+            self._count("changes")
+        self.version = entry["_id"]
+
+    def _catch_up_log(self, replay=True):
+        """
+        Follow the shared versions of the logged changes, replaying those after the floor. The floor is raised to
+        the latest version when some of them are no longer logged.
+
+        Args:
+            replay (bool): Whether to replay the logged changes, or to raise the floor right away.
+        """
+        counter = self.counter_collection.find_one_and_update(
+            {"_id": self.COUNTER_ID}, {"$setOnInsert": {"version": 0, "floor": 0, "epoch": new_epoch()}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        if "epoch" not in counter:  # logged before the versions were shared
+            self.counter_collection.update_one({"_id": self.COUNTER_ID, "epoch": {"$exists": False}},
+                                               {"$set": {"epoch": new_epoch(), "floor": counter["version"]}})
+            counter = self.counter_collection.find_one({"_id": self.COUNTER_ID})
+        self.epoch, floor, latest = counter["epoch"], counter["floor"], counter["version"]
+        self.books_collection.versions.follow(self.epoch, floor)
+        self.version = floor
+        if replay:
+            for entry in self.changes_collection.find({"_id": {"$gt": floor, "$lte": latest}}).sort("_id", 1):
+                if entry["_id"] != self.version + 1:
+                    break
+                self.apply_entry(entry)
+            self.lag = 0.0  # of the replayed changes, long applied by the other processes
+        if self.version < latest:
+            self.books_collection.versions.follow(self.epoch, latest)
+            self.version = latest
+            self.counter_collection.update_one({"_id": self.COUNTER_ID}, {"$max": {"floor": latest}})
+
+    def _poll_periodically(self):
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self.poll()
+            except PyMongoError:
+                logger.exception("Polling for changes failed")
+                self._count("errors")
+
+    def _open_stream(self):
+        # the floor changes come with the writes, in the order of the cluster times
+        pipeline = [{"$match": {"ns.coll": {"$in": [*SYNCED_COLLECTIONS, self.counter_collection.name]}}}]
+        return self.db.watch(pipeline, full_document="updateLookup", resume_after=self._resume_token,
+                             start_at_operation_time=None if self._resume_token else self._start_at,
+                             max_await_time_ms=int(self.poll_interval * 1000))
+
+    def _catch_up_stream(self):
+        """
+        Follow the cluster times of the change stream events as shared versions, replaying the events after the
+        floor before serving. The floor is raised to the current cluster time when they are no longer in the oplog,
+        or older than the retention.
+        """
+        floor = self.counter_collection.find_one({"_id": self.FLOOR_ID})
+        if floor is None:
+            self.counter_collection.update_one(
+                {"_id": self.FLOOR_ID}, {"$setOnInsert": {"floor": self._cluster_time(), "epoch": new_epoch()}},
+                upsert=True)
+            floor = self.counter_collection.find_one({"_id": self.FLOOR_ID})
+        self.epoch = floor["epoch"]
+        self._start_at = floor["floor"]
+        if self._start_at.time < time.time() - self.retention:
+            self._start_at = self._raise_stream_floor()
+        try:
+            self.books_collection.versions.follow(self.epoch, timestamp_version(self._start_at))
+            self._stream = self._open_stream()
+            while True:
+                event = self._stream.try_next()
+                if event is None:
+                    break
+                self.apply_event(event)
+                self._resume_token = self._stream.resume_token
+            self.lag = 0.0  # of the replayed changes, long applied by the other processes
+        except OperationFailure as e:  # the floor fell off the oplog
+            logger.info("Changes since the entity tag floor are not available (%s), raising it", e)
+            self._resume_token = None
+            self._start_at = self._raise_stream_floor()
+            self.books_collection.versions.follow(self.epoch, timestamp_version(self._start_at))
+            self._stream = self._open_stream()
+
+    def _raise_stream_floor(self):
+        """
+        Raise the shared floor of the change stream versions to the current cluster time.
+
+        Returns:
+            Timestamp: The new floor.
+        """
+        floor = self._cluster_time()
+        self.counter_collection.update_one({"_id": self.FLOOR_ID}, {"$max": {"floor": floor}})
+        return floor
+
+    def _cluster_time(self):
+        with self.db.client.start_session() as session:
+            self.counter_collection.find_one({"_id": self.FLOOR_ID}, session=session)
+            return session.operation_time
+
+    def _watch(self):
+        while not self._stopped.is_set():
+            try:
+                if self._stream is None:
+                    self._stream = self._open_stream()
+                while self._stream.alive and not self._stopped.is_set():
+                    event = self._stream.try_next()
+                    if event is not None:
+                        self.apply_event(event)
+                    self._resume_token = self._stream.resume_token
+                self._stream.close()
+                self._stream = None
+            except OperationFailure:
+                # the resume token, or the floor, fell off the oplog, the changes since are unknown
+                logger.exception("Change stream failed, dropping every cache and starting a new one")
+                self._count("errors")
+                self._reset_stream()
+            except PyMongoError:
+                logger.exception("Change stream interrupted, resuming")
+                self._count("errors")
+                self._stream = None
+                self._stopped.wait(self.retry_delay)
+
+    def _reset_stream(self):
+        self._stream = None
+        if self._resume_token is not None or self._start_at is not None:
+            try:
+                self._start_at = self._raise_stream_floor()  # the stream restarts from there
+            except PyMongoError:
+                logger.exception("Failed to raise the entity tag floor, retrying")
+            else:
+                self._resume_token = None
+                self._invalidate_all(timestamp_version(self._start_at))
+        self._stopped.wait(self.retry_delay)
+
+    def apply_event(self, event: dict):
+        """
+        Apply a change stream event to the caches.
+
+        Args:
+            event (dict): The change stream event.
+        """
+        version = timestamp_version(event["clusterTime"])
+        if event.get("ns", {}).get("coll") == self.counter_collection.name:
+            document = event.get("fullDocument")
+            if document and document["_id"] == self.FLOOR_ID:  # raised by another process
+                self.books_collection.versions.raise_floor(timestamp_version(document["floor"]))
+            return
+        if event["operationType"] in DOCUMENT_OPERATIONS:
+            document_id = event["documentKey"]["_id"]
+            document = event.get("fullDocument")  # None once the document is deleted
+            embedded_ratings = self.books_collection.storage.embedded_ratings
+            if not (embedded_ratings and updates_only_ratings(event)):  # a rating leaves the book as it was
+                self.books_collection.invalidate_cached(event["ns"]["coll"], [document_id], version,
+                                                        {str(document_id): document})
+            if embedded_ratings:  # the ratings are written with the book
+                self.books_collection.invalidate_cached("ratings", [document_id], version)
+        else:  # a collection was dropped or renamed, and the stream closes on an invalidate event
+            self._invalidate_all(version)
+        if "clusterTime" in event:
+            self.lag = max(time.time() - event["clusterTime"].time, 0.0)
+        self._count("changes")
+
+    def _invalidate_all(self, floor: int = None):
+        self.books_collection.invalidate_all_cached(floor)
+        self._count("full_invalidations")
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        """
+        Report how the caches are kept coherent.
+
+        Returns:
+            dict: The sync mode, the changes applied, full invalidations and errors, the lag of the last change
+            applied in seconds, and the last version applied when polling.
+        """
+        with self._lock:
+            stats = dict(self.counters, mode=self.mode, lag_seconds=self.lag)
+        if self.mode == self.POLL:
+            stats["version"] = self.version
+        return stats
+
+
+def new_epoch():
+    return uuid.uuid4().hex[:12]
+
+
+def timestamp_version(timestamp):
+    """
+    Convert the cluster time of a change to a version, ordered like the cluster times.
+    """
+    return (timestamp.time << 32) | timestamp.inc
+
+
+def updates_only_ratings(event: dict):
+    """
+    Whether a change stream event is an update of the embedded ratings of a book alone.
+    """
+    description = event.get("updateDescription")
+    if event["operationType"] != "update" or description is None:
+        return False
+    fields = [*description.get("updatedFields", {}), *description.get("removedFields", []),
+              *[array["field"] for array in description.get("truncatedArrays", [])]]
+    return all(field == "ratings" or field.startswith("ratings.") for field in fields)
@@ -0,0 +1,115 @@
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class EnrichmentQueue:
+    """
+    In-process queue of books waiting for their Google Books data, worked by a pool of threads.
+    A book whose lookup failed transiently is retried after an exponential backoff with full jitter, up to a maximum
+    number of attempts. The queue itself is not persisted: the pending state lives in the book documents,
+    and the books still pending are queued again periodically, those of a stopped process included.
+    """
+
+    def __init__(self, enrich, workers=4, max_attempts=5, retry_delay=1.0, max_retry_delay=60.0, fail=None):
+        """
+        Args:
+            enrich: Callable taking a book ID and whether this is its last attempt, returning True once the book
+                is done with, or False to retry it later.
+            workers (int): The number of worker threads.
+            max_attempts (int): The number of attempts per book.
+            retry_delay (float): The base of the backoff between attempts, in seconds.
+            max_retry_delay (float): The cap of the backoff, in seconds.
+            fail: Callable taking a book ID, marking the book failed when its last attempt raised.
+        """
+        self.enrich = enrich
+        self.fail = fail
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="enrichment")
+        self._queued = set()  # IDs of the books queued, running or waiting for a retry, so each runs once at a time
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.counters = {"submitted": 0, "completed": 0, "retried": 0, "errors": 0}
+
+    def submit(self, book_id, attempt: int = 1):
+        """
+        Queue a book for enrichment, unless it is already queued.
+
+        Args:
+            book_id: The ID of the book.
+            attempt (int): The number of the attempt, from 1.
+        """
+        book_id = str(book_id)
+        with self._lock:
+            if attempt == 1:
+                if book_id in self._queued:
+                    return
+                self._queued.add(book_id)
+                self.counters["submitted"] += 1
+        self._executor.submit(self._run, book_id, attempt)
+
+    def _run(self, book_id: str, attempt: int):
+        last_attempt = attempt >= self.max_attempts
+        try:
+            done = self.enrich(book_id, last_attempt)
+        except Exception:  # a db error, retried like a failed lookup
+            logger.exception("Enrichment of book %s failed", book_id)
+            with self._lock:
+                self.counters["errors"] += 1
+            done = last_attempt
+            if last_attempt and self.fail is not None:
+                try:
+                    self.fail(book_id)
+                except Exception:  # left pending, queued again by the next resume
+                    logger.exception("Marking the enrichment of book %s failed did not succeed", book_id)
+        if done:
+            with self._lock:
+                self._queued.discard(book_id)
+                self.counters["completed"] += 1
+            return
+        with self._lock:
+            self.counters["retried"] += 1
+        delay = random.uniform(0, min(self.max_retry_delay, self.retry_delay * 2 ** (attempt - 1)))
+        timer = threading.Timer(delay, self.submit, args=(book_id, attempt + 1))
+        timer.daemon = True
+        timer.start()
+
+    def resume_periodically(self, resume, interval: float):
+        """
+        Queue the pending books now, then every 'interval' seconds on a daemon thread, until stopped.
+
+        Args:
+            resume: Callable queueing the pending books.
+            interval (float): Seconds between resumes.
+        """
+        def run():
+            while True:
+                try:
+                    resume()
+                except Exception:
+                    logger.exception("Resuming the pending enrichments failed")
+                    with self._lock:
+                        self.counters["errors"] += 1
+                if self._stopped.wait(interval):
+                    return
+
+        threading.Thread(target=run, name="enrichment-resume", daemon=True).start()
+
+    def stop(self):
+        """
+        Stop resuming the pending books.
+        """
+        self._stopped.set()
+
+    def stats(self):
+        """
+        Returns:
+            dict: The number of books in the queue and the submitted, completed, retried and errored counters.
+        """
+        with self._lock:
+            return dict(self.counters, queued=len(self._queued))
@@ -0,0 +1,239 @@
+import logging
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Environment variable -> GoogleBooksClient option
+FLOAT_CLIENT_OPTIONS = {
+    "GOOGLE_BOOKS_CONNECT_TIMEOUT": "connect_timeout",
+    "GOOGLE_BOOKS_READ_TIMEOUT": "read_timeout",
+    "GOOGLE_BOOKS_BACKOFF": "backoff",
+    "GOOGLE_BOOKS_ACQUIRE_TIMEOUT": "acquire_timeout",
+    "GOOGLE_BOOKS_BREAKER_RESET": "reset_timeout",
+}
+INT_CLIENT_OPTIONS = {
+    "GOOGLE_BOOKS_RETRIES": "retries",
+    "GOOGLE_BOOKS_MAX_CONCURRENCY": "max_concurrency",
+    "GOOGLE_BOOKS_BREAKER_THRESHOLD": "failure_threshold",
+}
+
+
+def google_books_client_options(environ=os.environ):
+    """
+    Build the GoogleBooksClient keyword options from the environment. Unset variables keep the client's defaults.
+
+    Args:
+        environ (dict): The environment to read, os.environ by default.
+
+    Returns:
+        dict: The client options.
+    """
+    options = {option: float(environ[variable]) for variable, option in FLOAT_CLIENT_OPTIONS.items()
+               if environ.get(variable)}
+    options.update({option: int(environ[variable]) for variable, option in INT_CLIENT_OPTIONS.items()
+                    if environ.get(variable)})
+    if environ.get("GOOGLE_BOOKS_URL"):
+        options["url"] = environ["GOOGLE_BOOKS_URL"]
+    return options
+
+
+class CircuitBreaker:
+    """
+    Fails fast while an upstream is degraded: opens after a number of consecutive failed calls, lets a single
+    trial call through once the reset timeout has passed, and closes again when that call succeeds.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened = 0  # number of times the breaker opened
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns:
+            bool: Whether a call may go to the upstream now.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN  # this caller makes the trial call, the others keep failing fast
+                return True
+            return False
+
+    def cancel_trial(self):
+        """
+        Give back the trial call of a half-open breaker when it never reached the upstream,
+        so the next call makes it instead of the breaker staying half-open for good.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN  # opened long enough ago, the next allow lets a trial call through
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                    logger.warning("Google Books circuit breaker opened after %d consecutive failures",
+                                   self.consecutive_failures)
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures, "opened": self.opened}
+
+
+class GoogleBooksClient:
+    """
+    Client of the Google Books volumes API, resilient to a slow or failing upstream.
+    Connections are pooled and kept alive, every request has connect and read timeouts, transient failures are
+    retried a bounded number of times with full-jitter exponential backoff, a circuit breaker fails fast while the
+    upstream keeps failing, and a semaphore bounds the concurrent lookups of the process.
+    """
+
+    DEFAULT_URL = "https://www.googleapis.com/books/v1/volumes"
+    NO_ITEMS_ERROR = "no items returned from Google Books API for given ISBN number"
+    RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+    def __init__(self, url=DEFAULT_URL, connect_timeout=2.0, read_timeout=5.0, retries=2, backoff=0.2,
+                 max_backoff=2.0, max_concurrency=10, acquire_timeout=5.0, failure_threshold=5, reset_timeout=30.0):
+        """
+        Args:
+            url (str): The volumes API URL.
+            connect_timeout (float): Seconds to wait for a connection.
+            read_timeout (float): Seconds to wait for the response, between bytes.
+            retries (int): How many times a failed request is retried.
+            backoff (float): The base of the exponential backoff between retries, in seconds.
+            max_backoff (float): The cap of the backoff, in seconds.
+            max_concurrency (int): The maximum number of concurrent lookups, also the connection pool size.
+            acquire_timeout (float): Seconds a lookup waits for a concurrency slot before failing.
+            failure_threshold (int): Consecutive failed lookups that open the circuit breaker.
+            reset_timeout (float): Seconds the breaker stays open before a trial lookup.
+        """
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_concurrency = max_concurrency
+        self.acquire_timeout = acquire_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.counters = {"lookups": 0, "succeeded": 0, "not_found": 0, "failed": 0, "retries": 0, "timeouts": 0,
+                         "short_circuited": 0, "rejected_busy": 0}
+        self.in_flight = 0
+
+    def lookup(self, isbn: str):
+        """
+        Fetch the authors, publisher and publication date of a book.
+
+        Args:
+            isbn (str): The ISBN of the book.
+
+        Returns:
+            tuple: The book data and 200, an error and 400 if Google Books has no such ISBN,
+            or an error and 503 if the upstream is unavailable, degraded or saturated.
+        """
+        self._count("lookups")
+        if not self.breaker.allow():
+            self._count("short_circuited")
+            return {"error": "Google Books API is unavailable, circuit breaker open"}, 503
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            self.breaker.cancel_trial()
+            self._count("rejected_busy")
+            return {"error": "too many concurrent Google Books API lookups"}, 503
+        with self._lock:
+            self.in_flight += 1
+        try:
+            body, error = self._get_with_retries(isbn)
+        except Exception:
+            self.breaker.record_failure()  # never left half-open by an unexpected error
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+        if error is not None:
+            self.breaker.record_failure()
+            self._count("failed")
+            return {"error": error}, 503
+        self.breaker.record_success()
+        if body.get("totalItems", 0) == 0 or not body.get("items"):
+            self._count("not_found")
+            return {"error": self.NO_ITEMS_ERROR}, 400
+        self._count("succeeded")
+        volume_info = body["items"][0].get("volumeInfo", {})
+        return {"authors": volume_info.get("authors"), "publisher": volume_info.get("publisher"),
+                "publishedDate": volume_info.get("publishedDate")}, 200
+
+    def _get_with_retries(self, isbn: str):
+        """
+        Request the volumes of an ISBN, retrying connection errors, timeouts and retryable status codes.
+
+        Returns:
+            tuple: The parsed response body and None, or None and the error of the last attempt.
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count("retries")
+                # full jitter spreads the retries of concurrent lookups
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1))))
+            try:
+                response = self.session.get(self.url, params={"q": f"isbn:{isbn}"}, timeout=self.timeout)
+            except requests.exceptions.Timeout as e:
+                self._count("timeouts")
+                error = str(e)
+                continue
+            except requests.exceptions.RequestException as e:
+                error = str(e)
+                continue
+            if response.status_code in self.RETRY_STATUS_CODES:
+                error = f"Google Books API responded {response.status_code}"
+                continue
+            if response.status_code != 200:
+                return None, f"Google Books API responded {response.status_code}"
+            try:
+                return response.json(), None
+            except ValueError:
+                return None, "Google Books API returned malformed JSON"
+        return None, error
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        """
+        Report the health of the upstream as seen by this process.
+
+        Returns:
+            dict: The lookup outcome counters, the lookups in flight and the circuit breaker state.
+        """
+        with self._lock:
+            return dict(self.counters, in_flight=self.in_flight, max_concurrency=self.max_concurrency,
+                        breaker=self.breaker.stats())
@@ -0,0 +1,259 @@
+import bisect
+import functools
+import glob
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from flask import g, request
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+
+# Metric name -> (type, help text) of every metric the service records
+METRICS = {
+    "http_requests_total": ("counter", "Requests handled, by resource, method and status code."),
+    "http_request_duration_seconds": ("histogram", "Time to produce the response, by resource, method and status code."),
+    "books_collection_call_duration_seconds": ("histogram", "Duration of BooksCollection method calls, by method."),
+    "books_collection_call_errors_total": ("counter", "BooksCollection method calls that raised, by method."),
+    "mongo_command_duration_seconds": ("histogram", "Duration of Mongo commands, by command name and outcome."),
+    "books_stat": ("gauge", "Internal counters of the stats sources also shown by /stats, for the scraped worker."),
+}
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsRegistry:
+    """
+    Thread-safe in-process counters and latency histograms, rendered in the Prometheus text format.
+
+    Under a multi-process server every worker has its own registry. When a directory is given, each worker
+    periodically writes its totals to its own file there and a scrape of any worker merges the files of all of them,
+    so the served counts cover the whole deployment. Files of exited workers are kept so counters never go down;
+    the directory should be emptied when the server starts.
+    """
+
+    def __init__(self, directory=None, flush_interval=1.0, buckets=DEFAULT_BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum]
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        self._file = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._file = os.path.join(directory, f"metrics-{os.getpid()}-{uuid.uuid4().hex[:8]}.json")
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Increment a counter.
+
+        Args:
+            name (str): The metric name.
+            labels (tuple): The (label, value) pairs of the series, in a fixed order.
+            value (float): The increment.
+        """
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        """
+        Record a duration in a histogram.
+
+        Args:
+            name (str): The metric name.
+            labels (tuple): The (label, value) pairs of the series, in a fixed order.
+            seconds (float): The observed duration.
+        """
+        index = bisect.bisect_left(self.buckets, seconds)  # the last slot counts the values above every bucket
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    def timed(self, function, method):
+        """
+        Wrap a function so every call is recorded in the BooksCollection call histogram.
+
+        Args:
+            function: The function to wrap.
+            method (str): The method label.
+
+        Returns:
+            The wrapped function.
+        """
+        labels = (("method", method),)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                self.inc("books_collection_call_errors_total", labels)
+                raise
+            finally:
+                self.observe("books_collection_call_duration_seconds", labels, time.perf_counter() - start)
+        return wrapper
+
+    def instrument_class(self, cls):
+        """
+        Time every public method of a class, including static methods such as the outbound Google Books call.
+
+        Args:
+            cls: The class to instrument, in place.
+        """
+        for name, attribute in list(vars(cls).items()):
+            function = attribute.__func__ if isinstance(attribute, staticmethod) else attribute
+            if name.startswith("_") or not inspect.isfunction(function) or hasattr(function, "__wrapped__"):
+                continue  # private, not a method, or already instrumented
+            wrapper = self.timed(function, name)
+            setattr(cls, name, staticmethod(wrapper) if isinstance(attribute, staticmethod) else wrapper)
+
+    def snapshot(self):
+        """
+        Copy the current totals of this process.
+
+        Returns:
+            dict: The counters and histograms, as lists of [name, labels, values] entries.
+        """
+        with self._lock:
+            return {"counters": [[name, list(map(list, labels)), value]
+                                 for (name, labels), value in self._counters.items()],
+                    "histograms": [[name, list(map(list, labels)), list(values)]
+                                   for (name, labels), values in self._histograms.items()]}
+
+    def maybe_flush(self):
+        """
+        Write the totals of this process to its file if the flush interval elapsed since the last write.
+        """
+        if self._file and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the totals of this process to its file, atomically so concurrent scrapes never read a partial file.
+        """
+        if not self._file:
+            return
+        self._last_flush = time.monotonic()
+        temporary = f"{self._file}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temporary, self._file)
+
+    def collect(self):
+        """
+        Merge the totals of every worker, or of this process only when no directory is configured.
+
+        Returns:
+            tuple: The counters and histograms, keyed by (name, labels).
+        """
+        snapshots = [self.snapshot()]
+        if self._file:
+            self.flush()
+            snapshots = []
+            for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue  # a file removed between the listing and the read
+        counters, histograms = {}, {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.get(key)
+                histograms[key] = values if merged is None else [a + b for a, b in zip(merged, values)]
+        return counters, histograms
+
+    def render(self, stats_sources=None):
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Args:
+            stats_sources (dict): Source name -> callable returning a stats dict, exposed as gauges of this worker.
+
+        Returns:
+            str: The metrics text.
+        """
+        counters, histograms = self.collect()
+        series = {name: [] for name in METRICS}
+        for (name, labels), value in sorted(counters.items()):
+            series[name].append(f"{name}{format_labels(labels)} {format_value(value)}")
+        for (name, labels), values in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                series[name].append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+            series[name].append(f"{name}_sum{format_labels(labels)} {format_value(values[-1])}")
+            series[name].append(f"{name}_count{format_labels(labels)} {cumulative}")
+        for source, stats in (stats_sources or {}).items():
+            for stat, value in flatten_stats(stats()):
+                series["books_stat"].append(
+                    f"books_stat{format_labels((('source', source), ('stat', stat)))} {format_value(value)}")
+
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            if series[name]:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"] + series[name]
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + "}"
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def flatten_stats(stats, prefix=""):
+    """
+    Yield the numeric values of a possibly nested stats dict, with dotted names.
+    """
+    for key, value in stats.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from flatten_stats(value, f"{name}.")
+        elif isinstance(value, (int, float)):  # booleans included, as 0 or 1
+            yield name, value
+
+
+def instrument_app(app, registry):
+    """
+    Record the count and duration of every request handled by a Flask app.
+
+    Args:
+        app (Flask): The app.
+        registry (MetricsRegistry): The registry recording the requests.
+    """
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("request_start", None)
+        if start is not None:
+            labels = (("resource", request.url_rule.rule if request.url_rule else "unmatched"),
+                      ("method", request.method), ("status", str(response.status_code)))
+            registry.inc("http_requests_total", labels)
+            registry.observe("http_request_duration_seconds", labels, time.perf_counter() - start)
+            registry.maybe_flush()
+        return response
+
@@ -0,0 +1,59 @@
+import json
+from datetime import date, datetime
+from bson import ObjectId
+from flask import make_response
+
+try:  # orjson is several times faster than the standard library, fall back to json when it is not installed
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_default(obj):
+    """
+    Encode the values JSON has no type for, so Mongo documents can be serialized as they are read.
+
+    Args:
+        obj: The value to encode.
+
+    Returns:
+        str: The JSON-compatible value.
+    """
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(data):
+    """
+    Serialize data to JSON, handling ObjectId values natively.
+
+    Args:
+        data: The data to serialize.
+
+    Returns:
+        bytes: The UTF-8 encoded JSON.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=encode_default)
+    return json.dumps(data, default=encode_default, separators=(',', ':')).encode()
+
+
+def output_json(data, code, headers=None):
+    """
+    Flask-RESTful representation for 'application/json' responses.
+
+    Args:
+        data: The data returned by the resource.
+        code (int): The response status code.
+        headers (dict): Additional response headers.
+
+    Returns:
+        Response: The JSON response.
+    """
+    response = make_response(dumps(data), code)
+    response.headers.extend(headers or {})
+    response.mimetype = 'application/json'
+    return response
@@ -0,0 +1,131 @@
+import os
+import threading
+from pymongo import ReadPreference, monitoring
+
+# Environment variable -> MongoClient option, for the integer options
+INT_CLIENT_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+    "MONGO_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGO_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "MONGO_WTIMEOUT_MS": "wTimeoutMS",
+}
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+
+def mongo_client_options(environ=os.environ):
+    """
+    Build the MongoClient keyword options from the environment. Unset variables keep PyMongo's defaults.
+
+    Args:
+        environ (dict): The environment to read, os.environ by default.
+
+    Returns:
+        dict: The MongoClient options.
+    """
+    options = {option: int(environ[variable]) for variable, option in INT_CLIENT_OPTIONS.items()
+               if environ.get(variable)}
+    write_concern = environ.get("MONGO_WRITE_CONCERN")
+    if write_concern:  # a number of nodes or a tag such as "majority"
+        options["w"] = int(write_concern) if write_concern.isdigit() else write_concern
+    if environ.get("MONGO_JOURNAL"):
+        options["journal"] = environ["MONGO_JOURNAL"].lower() == "true"
+    return options
+
+
+def read_preference(environ=os.environ):
+    """
+    Get the read preference of the read-only queries from the MONGO_READ_PREFERENCE environment variable.
+
+    Args:
+        environ (dict): The environment to read, os.environ by default.
+
+    Returns:
+        The PyMongo read preference, primary if not set.
+    """
+    name = environ.get("MONGO_READ_PREFERENCE", "primary")
+    if name not in READ_PREFERENCES:
+        raise ValueError(f"MONGO_READ_PREFERENCE must be one of {', '.join(READ_PREFERENCES)}, got {name}")
+    return READ_PREFERENCES[name]
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+    PyMongo connection pool listener that keeps utilization counters across all the pools of a client.
+    """
+
+    def __init__(self, max_pool_size=100):
+        self.max_pool_size = max_pool_size
+        self._lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.cleared = 0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            self.waiting += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.waiting -= 1
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.waiting -= 1
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def stats(self):
+        """
+        Report the pool counters.
+
+        Returns:
+            dict: Open, in use and waiting connection counts with their peaks, and the pool utilization.
+        """
+        return {"max_pool_size": self.max_pool_size, "open": self.open, "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use, "waiting": self.waiting, "peak_waiting": self.peak_waiting,
+                "checkouts": self.checkouts, "checkout_failures": self.checkout_failures, "cleared": self.cleared,
+                "utilization": self.in_use / self.max_pool_size if self.max_pool_size else 0.0}
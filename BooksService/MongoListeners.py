@@ -0,0 +1,66 @@
+import logging
+import threading
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+
+class SlowQueryLogger(monitoring.CommandListener):
+    """
+    PyMongo command listener that logs every command slower than a threshold.
+    """
+
+    MAX_LOGGED_COMMAND_LENGTH = 500
+
+    def __init__(self, threshold_ms=100):
+        self.threshold_micros = threshold_ms * 1000
+        self._commands = {}  # (connection, request id) -> command document of in-flight commands
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        with self._lock:
+            self._commands[(event.connection_id, event.request_id)] = event.command
+
+    def succeeded(self, event):
+        self._finished(event, "succeeded")
+
+    def failed(self, event):
+        self._finished(event, "failed")
+
+    def _finished(self, event, outcome):
+        """
+        Log the command of a finished event if it ran longer than the threshold.
+
+        Args:
+            event: The CommandSucceededEvent or CommandFailedEvent.
+            outcome (str): Whether the command succeeded or failed.
+        """
+        with self._lock:
+            command = self._commands.pop((event.connection_id, event.request_id), None)
+        if event.duration_micros < self.threshold_micros:
+            return
+        command_text = str(command)[:self.MAX_LOGGED_COMMAND_LENGTH]
+        logger.warning("Slow Mongo command %s %s in %.1f ms: %s", event.command_name, outcome,
+                       event.duration_micros / 1000, command_text)
+
+
+class CommandDurations(monitoring.CommandListener):
+    """
+    PyMongo command listener recording the duration of every command in a metrics registry.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._observe(event, "succeeded")
+
+    def failed(self, event):
+        self._observe(event, "failed")
+
+    def _observe(self, event, outcome):
+        self.registry.observe("mongo_command_duration_seconds", (("command", event.command_name), ("outcome", outcome)),
+                              event.duration_micros / 1e6)
@@ -0,0 +1,155 @@
+import bisect
+import re
+import threading
+from collections import defaultdict
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+class SearchIndex:
+    """
+    In-process inverted index over the title and authors of books, with ranked and prefix lookups.
+    A disabled index ignores the writes, for processes that cannot keep it up to date and index per search instead.
+    """
+
+    FIELD_WEIGHTS = {"title": 2.0, "authors": 1.0}  # a term in the title ranks above the same term in the authors
+    PREFIX_WEIGHT = 0.5  # a prefix match of the last query term ranks below a whole-word match
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._postings = defaultdict(dict)  # token -> {book ID: weight of the token in the book}
+        self._book_tokens = {}  # book ID -> tokens of the book, to remove it from the postings
+        self._book_lengths = {}  # book ID -> number of tokens, shorter matches rank first on equal scores
+        self._vocabulary = []  # sorted tokens, for prefix lookups
+        self._lock = threading.RLock()
+        self.built = False
+
+    @staticmethod
+    def tokenize(text):
+        """
+        Split text into lowercase word tokens.
+
+        Args:
+            text (str): The text to tokenize.
+
+        Returns:
+            list: The tokens, in order.
+        """
+        return TOKEN_PATTERN.findall(text.lower()) if isinstance(text, str) else []
+
+    def build(self, books):
+        """
+        Index every book of an iterable, typically a cursor over the books collection.
+
+        Args:
+            books: The book documents, with at least their '_id', 'title' and 'authors'.
+        """
+        for book in books:
+            self.add(book)
+        self.built = True
+
+    def add(self, book: dict):
+        """
+        Index a book, replacing its previous entry if it was already indexed.
+
+        Args:
+            book (dict): The book document, with at least its '_id', 'title' and 'authors'.
+        """
+        if not self.enabled:
+            return
+        weights = defaultdict(float)
+        length = 0
+        for field, field_weight in self.FIELD_WEIGHTS.items():
+            tokens = self.tokenize(book.get(field))
+            length += len(tokens)
+            for token in tokens:
+                weights[token] += field_weight
+        book_id = str(book["_id"])
+        with self._lock:
+            self._remove(book_id)
+            for token, weight in weights.items():
+                if token not in self._postings:
+                    bisect.insort(self._vocabulary, token)
+                self._postings[token][book_id] = weight
+            self._book_tokens[book_id] = list(weights)
+            self._book_lengths[book_id] = length
+
+    def remove(self, book_id):
+        """
+        Remove a book from the index.
+
+        Args:
+            book_id: The ID of the book.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._remove(str(book_id))
+
+    def _remove(self, book_id: str):
+        for token in self._book_tokens.pop(book_id, ()):
+            postings = self._postings[token]
+            postings.pop(book_id, None)
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+        self._book_lengths.pop(book_id, None)
+
+    def clear(self):
+        """
+        Empty the index, it is built again on the next search.
+        """
+        with self._lock:
+            self._postings.clear()
+            self._book_tokens.clear()
+            self._book_lengths.clear()
+            self._vocabulary.clear()
+            self.built = False
+
+    def search(self, text: str, limit: int = 10, prefix: bool = True):
+        """
+        Find the books matching every term of a search text, best matches first.
+
+        Args:
+            text (str): The search text.
+            limit (int): The maximum number of results.
+            prefix (bool): Whether the last term also matches the words it is a prefix of, for autocomplete.
+
+        Returns:
+            list: The IDs of the matching books, best match first.
+        """
+        terms = self.tokenize(text)
+        if not terms:
+            return []
+        with self._lock:
+            scores = None
+            for position, term in enumerate(terms):
+                term_scores = defaultdict(float)
+                for book_id, weight in self._postings.get(term, {}).items():
+                    term_scores[book_id] += weight
+                if prefix and position == len(terms) - 1:
+                    start = bisect.bisect_right(self._vocabulary, term)  # the words longer than the term
+                    for token in self._vocabulary[start:]:
+                        if not token.startswith(term):
+                            break
+                        for book_id, weight in self._postings[token].items():
+                            term_scores[book_id] = max(term_scores[book_id], weight * self.PREFIX_WEIGHT)
+                if scores is None:
+                    scores = term_scores
+                else:  # every term must match
+                    scores = {book_id: score + term_scores[book_id] for book_id, score in scores.items()
+                              if book_id in term_scores}
+                if not scores:
+                    return []
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], self._book_lengths.get(item[0], 0), item[0]))
+        return [book_id for book_id, _ in ranked[:limit]]
+
+    def stats(self):
+        """
+        Report the size of the index.
+
+        Returns:
+            dict: The number of indexed books and distinct tokens.
+        """
+        return {"enabled": self.enabled, "built": self.built, "books": len(self._book_tokens),
+                "tokens": len(self._postings)}
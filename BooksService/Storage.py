@@ -0,0 +1,1129 @@
+import atexit
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from bson import BSON, ObjectId, decode_file_iter
+from pymongo import ASCENDING, DESCENDING, DeleteMany, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+YEAR_DATE_PATTERN = r"^\d{4}(-\d{2}-\d{2})?$"  # the publication dates whose year is counted by the facets
+
+
+class DuplicateIsbnError(Exception):
+    """
+    Raised when a write would give two books the same ISBN.
+    """
+
+
+class Storage(ABC):
+    """
+    The persistence operations of the books service, over a 'books' and a 'ratings' collection of documents
+    keyed by ObjectId '_id'. A ratings document shares the '_id' of its book.
+    Queries are dicts of field -> value that documents must equal on every field.
+    """
+
+    unique_isbn = False  # whether inserts enforce ISBN uniqueness, otherwise it is checked before each insert
+    embedded_ratings = False  # whether the ratings of a book are stored in the book document
+    isbn_cache_collection = None  # the Mongo collection shared by the ISBN caches of every process, if any
+    multi_process = False  # whether several processes may write to the storage at once
+
+    @abstractmethod
+    def ensure_indexes(self):
+        """
+        Create the indexes used by the queries. Safe to run on every start.
+        """
+
+    @abstractmethod
+    def existing_isbns(self, isbns):
+        """
+        Args:
+            isbns (list): The ISBNs to look up.
+
+        Returns:
+            set: The ISBNs already held by a book.
+        """
+
+    @abstractmethod
+    def insert_book(self, book: dict, ratings: dict):
+        """
+        Insert a book and its ratings document, both or neither.
+
+        Args:
+            book (dict): The book document, with its '_id'.
+            ratings (dict): The ratings document of the book, with the same '_id'.
+
+        Raises:
+            DuplicateIsbnError: If a book with the same ISBN exists.
+        """
+
+    @abstractmethod
+    def insert_books(self, books: list, ratings: list):
+        """
+        Insert many books and their ratings documents. Books whose ISBN already exists are skipped, with their
+        ratings documents.
+
+        Args:
+            books (list): The book documents, with their '_id'.
+            ratings (list): The ratings document of each book, in the same order.
+
+        Returns:
+            set: The positions of the books skipped as duplicate ISBNs.
+        """
+
+    @abstractmethod
+    def find(self, collection: str, query: dict, projection: dict = None, after: ObjectId = None, limit: int = None):
+        """
+        Find the documents matching a query, in '_id' order when paginated.
+
+        Args:
+            collection (str): 'books' or 'ratings'.
+            query (dict): The query.
+            projection (dict): The fields to return as {field: 1}, '_id' is always returned. All fields if None.
+            after (ObjectId): Only return documents with a greater '_id'.
+            limit (int): The maximum number of documents to return.
+
+        Returns:
+            list: The documents.
+        """
+
+    @abstractmethod
+    def find_batch(self, collection: str, queries: list):
+        """
+        Find the documents matching each of many queries.
+
+        Args:
+            collection (str): 'books' or 'ratings'.
+            queries (list): The queries.
+
+        Returns:
+            list: The list of matching documents of each query, in the order of the queries.
+        """
+
+    @abstractmethod
+    def find_by_ids(self, collection: str, document_ids: list):
+        """
+        Returns:
+            list: The documents with the given '_id's that exist, in no particular order.
+        """
+
+    @abstractmethod
+    def get(self, collection: str, document_id: ObjectId, projection: dict = None):
+        """
+        Returns:
+            dict: The document with the given '_id', or None.
+        """
+
+    @abstractmethod
+    def update_book(self, book_id: ObjectId, values: dict, expected: dict = None):
+        """
+        Set fields of a book.
+
+        Args:
+            book_id (ObjectId): The ID of the book.
+            values (dict): The fields to set.
+            expected (dict): Field values the book must have for the update to apply.
+
+        Returns:
+            dict: The book before the update, or None if there is no such book or it does not have
+            the expected values.
+
+        Raises:
+            DuplicateIsbnError: If the new ISBN is held by another book.
+        """
+
+    @abstractmethod
+    def claim_books(self, book_ids: list, owner: str, lease: float):
+        """
+        Claim books for one process for a while, so the other processes leave them alone, e.g. while enriching them.
+
+        Args:
+            book_ids (list): The IDs of the books.
+            owner (str): The name of the claiming process.
+            lease (float): Seconds the claims hold.
+
+        Returns:
+            list: The IDs claimed, those not claimed by another process, or whose claim expired.
+        """
+
+    @abstractmethod
+    def delete_book(self, book_id: ObjectId, ratings_projection: dict = None):
+        """
+        Delete a book and its ratings document, both or neither.
+
+        Args:
+            book_id (ObjectId): The ID of the book.
+            ratings_projection (dict): The fields of the deleted ratings document to return, all fields if None.
+
+        Returns:
+            tuple: The deleted book and ratings document, or None and None if there was no such book.
+        """
+
+    @abstractmethod
+    def export(self, collection: str, since: datetime = None):
+        """
+        Iterate over every document of a collection in '_id' order, without holding them all in memory at once
+        where the backend allows it.
+
+        Args:
+            collection (str): 'books' or 'ratings'.
+            since (datetime): Only export documents whose '_id' was generated at or after this time.
+
+        Returns:
+            An iterable of the documents.
+        """
+
+    @abstractmethod
+    def add_rating(self, book_id: ObjectId, rate: int, max_values: int = None):
+        """
+        Atomically count a rating in the running count, sum and histogram of a book.
+
+        Args:
+            book_id (ObjectId): The ID of the book.
+            rate (int): The rating, 1 to 5.
+            max_values (int): How many of the most recent values to keep, 0 for none and None for all.
+
+        Returns:
+            dict: The '_id', 'count', 'sum' and 'title' after the rating, or None if there is no such book.
+        """
+
+    @abstractmethod
+    def add_ratings(self, ratings: dict, max_values: int = None):
+        """
+        Count many ratings of many books, with one atomic update per book written in a single batch.
+
+        Args:
+            ratings (dict): The ratings of each book, by book ID.
+            max_values (int): How many of the most recent values to keep, 0 for none and None for all.
+
+        Returns:
+            list: The '_id', 'count', 'sum' and 'title' after the ratings of each book that exists.
+        """
+
+    @abstractmethod
+    def set_rating_average(self, book_id: ObjectId, count: int, average: float, eligible: bool):
+        """
+        Store the average and leaderboard eligibility of a book, unless its count moved on since.
+
+        Args:
+            book_id (ObjectId): The ID of the book.
+            count (int): The number of ratings the average was computed from.
+            average (float): The average rating.
+            eligible (bool): Whether the book is eligible for the leaderboard.
+        """
+
+    @abstractmethod
+    def set_rating_averages(self, averages: list):
+        """
+        Store the averages and leaderboard eligibility of many books in a single batch, as set_rating_average does.
+
+        Args:
+            averages (list): (book ID, count, average, eligible) tuples.
+        """
+
+    @abstractmethod
+    def backfill_rating_aggregates(self, min_ratings: int):
+        """
+        Compute the count, sum, histogram and eligibility of ratings documents created before they were stored.
+
+        Args:
+            min_ratings (int): The number of ratings a book needs to be eligible for the leaderboard.
+
+        Returns:
+            int: The number of documents updated.
+        """
+
+    @abstractmethod
+    def top(self, k: int):
+        """
+        Returns:
+            list: The k eligible ratings documents with the highest average, highest first.
+        """
+
+    @abstractmethod
+    def aggregate_facets(self):
+        """
+        Compute every facet counter from the books and ratings.
+
+        Returns:
+            list: The counters, each with its 'facet', 'value', 'count' and, for genres, 'rating_sum'
+            and 'rating_count'.
+        """
+
+    @abstractmethod
+    def get_facet_counters(self):
+        """
+        Returns:
+            list: The stored facet counters with a non-zero count or rating count.
+        """
+
+    @abstractmethod
+    def has_facet_counters(self):
+        """
+        Returns:
+            bool: Whether the facet counters were built, even if none is stored for an empty catalog.
+        """
+
+    @abstractmethod
+    def mark_facet_counters_built(self):
+        """
+        Record that the facet counters are built without changing them, for a catalog that has no books yet.
+        """
+
+    @abstractmethod
+    def apply_facet_deltas(self, deltas: dict):
+        """
+        Increment the stored facet counters.
+
+        Args:
+            deltas (dict): (facet, value) -> {counter field: increment}.
+        """
+
+    @abstractmethod
+    def replace_facet_counters(self, counters: list):
+        """
+        Replace every stored facet counter and record that they are built. The writes must be stopped meanwhile,
+        the counts of the writes made since the counters were aggregated would be lost.
+
+        Args:
+            counters (list): The counters, as returned by aggregate_facets.
+        """
+
+    @abstractmethod
+    def stats(self):
+        """
+        Returns:
+            dict: Counters describing the backend.
+        """
+
+
+class MongoStorage(Storage):
+    """
+    Storage in the 'books', 'ratings' and 'facet_counts' collections of a Mongo database.
+    A book and its ratings document are written with one operation on each collection, in a multi-document
+    transaction when enabled, so a failure between the two never leaves a book without ratings or the reverse.
+    """
+
+    BATCH_QUERY_WORKERS = 8  # concurrent finds of a query batch too large for a single aggregation
+    FACET_COUNTERS_BUILT_ID = "_built"  # the 'facet_counts' document recording that the counters were built
+    multi_process = True
+    EXPORT_BATCH_SIZE = 1000  # documents fetched per round trip by exports
+
+    def __init__(self, db, read_preference=None, transactions=False):
+        """
+        Args:
+            db: The Mongo database.
+            read_preference: The read preference of the read-only listing queries (find, find_batch, top and
+                the facet aggregation), the client's read preference if None.
+            transactions (bool): Whether to write a book and its ratings in a transaction, which needs a replica set.
+        """
+        self.client = db.client
+        self.transactions = transactions
+        self.collections = {"books": db.books, "ratings": db.ratings}
+        # the read-only listing queries may be served by secondaries
+        self.readers = {name: collection.with_options(read_preference=read_preference) if read_preference
+                        else collection for name, collection in self.collections.items()}
+        self.facet_counts_collection = db.facet_counts
+        self.isbn_cache_collection = db.isbn_cache
+        self.claims_collection = db.book_claims
+
+    def ensure_indexes(self):
+        books = self.collections["books"]
+        try:
+            books.create_index("ISBN", unique=True)
+            self.unique_isbn = True
+        except OperationFailure as e:  # the db already holds duplicate ISBNs, keep checking them before inserts
+            logger.error("Could not create the unique ISBN index, duplicate ISBNs are checked per insert: %s", e)
+            books.create_index("ISBN")
+        for field in ("genre", "authors", "publishedDate"):
+            books.create_index(field)
+        books.create_index("enrichment", sparse=True)  # only books stored with asynchronous enrichment have one
+        self.claims_collection.create_index("expires_at", expireAfterSeconds=0)
+        if self.embedded_ratings:
+            books.create_index([("ratings.eligible", ASCENDING), ("ratings.average", DESCENDING)])
+        else:
+            self.collections["ratings"].create_index([("eligible", ASCENDING), ("average", DESCENDING)])
+
+    def existing_isbns(self, isbns):
+        return {book["ISBN"] for book in self.collections["books"].find({"ISBN": {"$in": list(isbns)}}, {"ISBN": 1})}
+
+    def _write(self, operation):
+        """
+        Run a write operation, in a transaction when enabled. The operation is called with the session of the
+        transaction, or None, and may be called again if the transaction hits a transient error.
+        """
+        if not self.transactions:
+            return operation(None)
+        with self.client.start_session() as session:
+            return session.with_transaction(operation)
+
+    def insert_book(self, book: dict, ratings: dict):
+        def insert(session):
+            self.collections["books"].insert_one(book, session=session)
+            self.collections["ratings"].insert_one(ratings, session=session)
+
+        try:
+            self._write(insert)
+        except DuplicateKeyError:
+            raise DuplicateIsbnError(book["ISBN"])
+
+    def insert_books(self, books: list, ratings: list):
+        if not self.transactions:
+            return self._insert_books(books, ratings, None)
+        # a transaction stops at its first duplicate, retry without it until the rest goes through
+        duplicates = set()
+        while len(duplicates) < len(books):
+            positions = [position for position in range(len(books)) if position not in duplicates]
+            try:
+                self._write(lambda session: self._insert_books([books[position] for position in positions],
+                                                               [ratings[position] for position in positions],
+                                                               session))
+                break
+            except BulkWriteError as e:
+                errors = e.details["writeErrors"]
+                if any(error["code"] != 11000 for error in errors):
+                    raise
+                duplicates.update(positions[error["index"]] for error in errors)
+        return duplicates
+
+    def _insert_books(self, books: list, ratings: list, session):
+        duplicates = set()
+        try:
+            self.collections["books"].insert_many(books, ordered=False, session=session)
+        except BulkWriteError as e:
+            # books inserted concurrently by another request since the uniqueness check
+            duplicates = {error["index"] for error in e.details["writeErrors"] if error["code"] == 11000}
+            if session is not None or len(duplicates) < len(e.details["writeErrors"]):
+                raise
+        inserted = [document for position, document in enumerate(ratings) if position not in duplicates]
+        if inserted:
+            self.collections["ratings"].insert_many(inserted, session=session)
+        return duplicates
+
+    def find(self, collection: str, query: dict, projection: dict = None, after: ObjectId = None, limit: int = None):
+        mongo_query = query
+        if after is not None:
+            mongo_query = {"$and": [query, {"_id": {"$gt": after}}]} if query else {"_id": {"$gt": after}}
+        cursor = self.readers[collection].find(mongo_query, projection)
+        if limit or after is not None:
+            cursor = cursor.sort("_id", ASCENDING)  # pages are cut in '_id' order so the cursor stays stable
+        if limit:
+            cursor = cursor.limit(limit)
+        return list(cursor)
+
+    def find_batch(self, collection: str, queries: list):
+        return self._find_batch(self.readers[collection], queries)
+
+    def _find_batch(self, reader, queries: list, projection: dict = None):
+        stages = [{"$project": projection}] if projection else []
+        try:  # every query in one round trip
+            facets = {f"q{position}": [{"$match": query}, *stages] for position, query in enumerate(queries)}
+            # the sub-pipelines of $facet cannot use indexes, the leading $match narrows their input with one
+            merged = next(reader.aggregate([{"$match": {"$or": queries}}, {"$facet": facets}]))
+            return [merged[f"q{position}"] for position in range(len(queries))]
+        except OperationFailure:  # the combined result is larger than a single document may be
+            with ThreadPoolExecutor(max_workers=min(self.BATCH_QUERY_WORKERS, len(queries))) as executor:
+                return list(executor.map(lambda query: list(reader.find(query, projection)), queries))
+
+    def find_by_ids(self, collection: str, document_ids: list):
+        return list(self.readers[collection].find({"_id": {"$in": document_ids}}))
+
+    def get(self, collection: str, document_id: ObjectId, projection: dict = None):
+        return self.collections[collection].find_one({"_id": document_id}, projection)
+
+    def update_book(self, book_id: ObjectId, values: dict, expected: dict = None):
+        try:
+            return self.collections["books"].find_one_and_update(dict(expected or {}, _id=book_id),
+                                                                 {"$set": values},
+                                                                 return_document=ReturnDocument.BEFORE)
+        except DuplicateKeyError:
+            raise DuplicateIsbnError(values.get("ISBN"))
+
+    def claim_books(self, book_ids: list, owner: str, lease: float):
+        claimed = []
+        for book_id in book_ids:
+            now = datetime.utcnow()
+            claim = {"owner": owner, "expires_at": now + timedelta(seconds=lease)}
+            try:
+                # a live claim is not matched, and the upsert then fails on its '_id'
+                self.claims_collection.update_one({"_id": book_id, "expires_at": {"$lte": now}}, {"$set": claim},
+                                                  upsert=True)
+            except DuplicateKeyError:
+                continue
+            claimed.append(book_id)
+        return claimed
+
+    def delete_book(self, book_id: ObjectId, ratings_projection: dict = None):
+        def delete(session):
+            book = self.collections["books"].find_one_and_delete({"_id": book_id}, session=session)
+            if book is None:
+                return None, None
+            return book, self.collections["ratings"].find_one_and_delete({"_id": book_id},
+                                                                         projection=ratings_projection,
+                                                                         session=session)
+
+        return self._write(delete)
+
+    def export(self, collection: str, since: datetime = None):
+        query = {"_id": {"$gte": ObjectId.from_datetime(since)}} if since else {}
+        return self.collections[collection].find(query).sort("_id", ASCENDING).batch_size(self.EXPORT_BATCH_SIZE)
+
+    def add_rating(self, book_id: ObjectId, rate: int, max_values: int = None):
+        return self.collections["ratings"].find_one_and_update({"_id": book_id}, rating_update([rate], max_values),
+                                                               projection={"count": 1, "sum": 1, "title": 1},
+                                                               return_document=ReturnDocument.AFTER)
+
+    def add_ratings(self, ratings: dict, max_values: int = None):
+        return self._add_ratings(ratings, max_values, "")
+
+    def _add_ratings(self, ratings: dict, max_values: int, prefix: str):
+        """
+        Apply the ratings of every book in one bulk write, then read back the aggregates of the books that exist.
+        The ratings fields are under prefix in the updated documents.
+        """
+        collection = self.collections["books" if prefix else "ratings"]
+        collection.bulk_write([UpdateOne({"_id": book_id}, rating_update(values, max_values, prefix))
+                               for book_id, values in ratings.items()], ordered=False)
+        documents = collection.find({"_id": {"$in": list(ratings)}},
+                                    {f"{prefix}count": 1, f"{prefix}sum": 1, "title": 1})
+        return [ratings_view(document) if prefix else document for document in documents]
+
+    def set_rating_average(self, book_id: ObjectId, count: int, average: float, eligible: bool):
+        self.collections["ratings"].update_one({"_id": book_id, "count": count},
+                                               {"$set": {"average": average, "eligible": eligible}})
+
+    def set_rating_averages(self, averages: list):
+        self._set_rating_averages(averages, "")
+
+    def _set_rating_averages(self, averages: list, prefix: str):
+        if averages:
+            collection = self.collections["books" if prefix else "ratings"]
+            collection.bulk_write([UpdateOne({"_id": book_id, f"{prefix}count": count},
+                                             {"$set": {f"{prefix}average": average, f"{prefix}eligible": eligible}})
+                                   for book_id, count, average, eligible in averages], ordered=False)
+
+    def backfill_rating_aggregates(self, min_ratings: int):
+        ratings = self.collections["ratings"]
+        updated = 0
+        for document in ratings.find({"count": {"$exists": False}}, {"values": 1}):
+            ratings.update_one({"_id": document["_id"], "count": {"$exists": False}},
+                               {"$set": rating_aggregates(document.get("values", []))})
+            updated += 1
+
+        # mark the documents that are missing their leaderboard eligibility
+        updated += ratings.update_many({"eligible": {"$exists": False}, "count": {"$gte": min_ratings}},
+                                       {"$set": {"eligible": True}}).modified_count
+        updated += ratings.update_many({"eligible": {"$exists": False}},
+                                       {"$set": {"eligible": False}}).modified_count
+        return updated
+
+    def top(self, k: int):
+        return list(self.readers["ratings"].find({"eligible": True}).sort("average", DESCENDING).limit(k))
+
+    def aggregate_facets(self):
+        # '$ratings' is the list of ratings documents joined to each book, or the ratings embedded in it
+        genre = [{"$group": {"_id": "$genre", "count": {"$sum": 1},
+                             "rating_sum": {"$sum": {"$sum": "$ratings.sum"}},
+                             "rating_count": {"$sum": {"$sum": "$ratings.count"}}}}]
+        if not self.embedded_ratings:
+            genre.insert(0, {"$lookup": {"from": self.collections["ratings"].name, "localField": "_id",
+                                         "foreignField": "_id", "as": "ratings"}})
+        pipeline = [{"$facet": {
+            "genre": genre,
+            "year": [{"$match": {"publishedDate": {"$regex": YEAR_DATE_PATTERN}}},
+                     {"$group": {"_id": {"$substrBytes": ["$publishedDate", 0, 4]}, "count": {"$sum": 1}}}],
+            "publisher": [{"$group": {"_id": "$publisher", "count": {"$sum": 1}}}],
+        }}]
+        result = next(self.readers["books"].aggregate(pipeline))
+        return [dict(counter, facet=facet, value=counter["_id"]) for facet, counters in result.items()
+                for counter in counters]
+
+    def get_facet_counters(self):
+        return list(self.facet_counts_collection.find({"$or": [{"count": {"$gt": 0}}, {"rating_count": {"$gt": 0}}]}))
+
+    def has_facet_counters(self):
+        return self.facet_counts_collection.find_one({"_id": self.FACET_COUNTERS_BUILT_ID}) is not None
+
+    def mark_facet_counters_built(self):
+        self.facet_counts_collection.update_one({"_id": self.FACET_COUNTERS_BUILT_ID},
+                                                {"$set": {"at": datetime.utcnow()}}, upsert=True)
+
+    def apply_facet_deltas(self, deltas: dict):
+        requests = [UpdateOne({"_id": f"{facet}:{value}"},
+                              {"$inc": increments, "$setOnInsert": {"facet": facet, "value": value}}, upsert=True)
+                    for (facet, value), increments in deltas.items()]
+        if requests:
+            self.facet_counts_collection.bulk_write(requests, ordered=False)
+
+    def replace_facet_counters(self, counters: list):
+        counters = [facet_counter(counter) for counter in counters]
+        kept = [counter["_id"] for counter in counters] + [self.FACET_COUNTERS_BUILT_ID]
+        # replaced one by one rather than dropped and inserted, so a rerun never fails on existing counters
+        self.facet_counts_collection.bulk_write(
+            [ReplaceOne({"_id": counter["_id"]}, counter, upsert=True) for counter in counters]
+            + [DeleteMany({"_id": {"$nin": kept}})])
+        self.mark_facet_counters_built()
+
+    def stats(self):
+        return {"engine": "mongo", "unique_isbn": self.unique_isbn, "transactions": self.transactions,
+                "ratings_layout": "embedded" if self.embedded_ratings else "collection"}
+
+
+class EmbeddedMongoStorage(MongoStorage):
+    """
+    Storage in a Mongo database with the ratings of each book embedded in its document, under 'ratings', so every
+    write of a book and its ratings is a single-document operation. The ratings documents are rebuilt from the books
+    on read, in the shape of the 'ratings' collection of MongoStorage, with the current title of the book.
+    migrations/embed_ratings.py converts the data of a MongoStorage.
+    """
+
+    embedded_ratings = True
+    BOOK_PROJECTION = {"ratings": 0}  # the book reads leave out the embedded ratings
+
+    def insert_book(self, book: dict, ratings: dict):
+        try:
+            self.collections["books"].insert_one(embed_ratings(book, ratings))
+        except DuplicateKeyError:
+            raise DuplicateIsbnError(book["ISBN"])
+
+    def insert_books(self, books: list, ratings: list):
+        try:
+            self.collections["books"].insert_many([embed_ratings(book, document)
+                                                   for book, document in zip(books, ratings)], ordered=False)
+        except BulkWriteError as e:
+            # books inserted concurrently by another request since the uniqueness check
+            duplicates = {error["index"] for error in e.details["writeErrors"] if error["code"] == 11000}
+            if len(duplicates) < len(e.details["writeErrors"]):
+                raise
+            return duplicates
+        return set()
+
+    def find(self, collection: str, query: dict, projection: dict = None, after: ObjectId = None, limit: int = None):
+        if collection == "books":
+            return super().find("books", query, projection or self.BOOK_PROJECTION, after, limit)
+        books = super().find("books", ratings_query(query), ratings_projection(projection), after, limit)
+        return [ratings_view(book) for book in books]
+
+    def find_batch(self, collection: str, queries: list):
+        if collection == "books":
+            return self._find_batch(self.readers["books"], queries, self.BOOK_PROJECTION)
+        return [self.find("ratings", query) for query in queries]
+
+    def find_by_ids(self, collection: str, document_ids: list):
+        if collection == "books":
+            return list(self.readers["books"].find({"_id": {"$in": document_ids}}, self.BOOK_PROJECTION))
+        books = self.readers["books"].find({"_id": {"$in": document_ids}}, ratings_projection(None))
+        return [ratings_view(book) for book in books]
+
+    def get(self, collection: str, document_id: ObjectId, projection: dict = None):
+        if collection == "books":
+            return self.collections["books"].find_one({"_id": document_id}, projection or self.BOOK_PROJECTION)
+        book = self.collections["books"].find_one({"_id": document_id}, ratings_projection(projection))
+        return ratings_view(book) if book else None
+
+    def update_book(self, book_id: ObjectId, values: dict, expected: dict = None):
+        try:
+            return self.collections["books"].find_one_and_update(dict(expected or {}, _id=book_id),
+                                                                 {"$set": values}, projection=self.BOOK_PROJECTION,
+                                                                 return_document=ReturnDocument.BEFORE)
+        except DuplicateKeyError:
+            raise DuplicateIsbnError(values.get("ISBN"))
+
+    def delete_book(self, book_id: ObjectId, ratings_projection: dict = None):
+        book = self.collections["books"].find_one_and_delete({"_id": book_id})
+        if book is None:
+            return None, None
+        ratings = copy_document(ratings_view(book), ratings_projection)
+        book.pop("ratings", None)
+        return book, ratings
+
+    def export(self, collection: str, since: datetime = None):
+        query = {"_id": {"$gte": ObjectId.from_datetime(since)}} if since else {}
+        projection = self.BOOK_PROJECTION if collection == "books" else ratings_projection(None)
+        cursor = self.collections["books"].find(query, projection).sort("_id", ASCENDING)
+        cursor = cursor.batch_size(self.EXPORT_BATCH_SIZE)
+        return cursor if collection == "books" else map(ratings_view, cursor)
+
+    def add_rating(self, book_id: ObjectId, rate: int, max_values: int = None):
+        book = self.collections["books"].find_one_and_update(
+            {"_id": book_id}, rating_update([rate], max_values, prefix="ratings."),
+            projection={"ratings.count": 1, "ratings.sum": 1, "title": 1}, return_document=ReturnDocument.AFTER)
+        return ratings_view(book) if book else None
+
+    def add_ratings(self, ratings: dict, max_values: int = None):
+        return self._add_ratings(ratings, max_values, "ratings.")
+
+    def set_rating_average(self, book_id: ObjectId, count: int, average: float, eligible: bool):
+        self.collections["books"].update_one({"_id": book_id, "ratings.count": count},
+                                             {"$set": {"ratings.average": average, "ratings.eligible": eligible}})
+
+    def set_rating_averages(self, averages: list):
+        self._set_rating_averages(averages, "ratings.")
+
+    def backfill_rating_aggregates(self, min_ratings: int):
+        books = self.collections["books"]
+        updated = 0
+        for book in books.find({"ratings.count": {"$exists": False}}, {"ratings.values": 1}):
+            values = book.get("ratings", {}).get("values", [])
+            aggregates = {f"ratings.{field}": value for field, value in rating_aggregates(values).items()}
+            books.update_one({"_id": book["_id"], "ratings.count": {"$exists": False}},
+                             {"$set": dict(aggregates, **{"ratings.values": values})})
+            updated += 1
+
+        # mark the books that are missing their leaderboard eligibility
+        updated += books.update_many({"ratings.eligible": {"$exists": False}, "ratings.count": {"$gte": min_ratings}},
+                                     {"$set": {"ratings.eligible": True}}).modified_count
+        updated += books.update_many({"ratings.eligible": {"$exists": False}},
+                                     {"$set": {"ratings.eligible": False}}).modified_count
+        return updated
+
+    def top(self, k: int):
+        books = self.readers["books"].find({"ratings.eligible": True}, ratings_projection(None))
+        return [ratings_view(book) for book in books.sort("ratings.average", DESCENDING).limit(k)]
+
+
+class MemoryStorage(Storage):
+    """
+    Storage in process memory, for tests and single-process deployments that need no Mongo server.
+    Books are indexed by ISBN, genre and authors in dicts, and the leaderboard is selected with a heap.
+    The data can be snapshotted to a BSON file, periodically and at exit, and is reloaded from it on start.
+
+    Every process holds its own copy of the data, so serve it from a single worker process.
+    """
+
+    INDEXED_FIELDS = ("ISBN", "genre", "authors")  # the first indexed field of a query selects the candidates
+
+    unique_isbn = True
+
+    def __init__(self, snapshot_path=None, snapshot_interval=None):
+        """
+        Args:
+            snapshot_path (str): The file the data is saved to and loaded from, None to keep it in memory only.
+            snapshot_interval (float): Seconds between snapshots of changed data, None to only save at exit.
+        """
+        self.documents = {"books": {}, "ratings": {}}  # collection -> '_id' -> document, in '_id' order
+        self.indexes = {field: defaultdict(dict) for field in self.INDEXED_FIELDS}  # field -> value -> {'_id': None}
+        self.eligible = {}  # '_id' of the ratings documents on the leaderboard -> None
+        self.facet_counters = {}  # "facet:value" -> counter
+        self.snapshot_path = snapshot_path
+        self.last_snapshot = None
+        self._dirty = False
+        self._lock = threading.RLock()
+        if snapshot_path:
+            if os.path.exists(snapshot_path):
+                self.load_snapshot()
+            atexit.register(self.save_snapshot)
+            if snapshot_interval:
+                threading.Thread(target=self._snapshot_periodically, args=(snapshot_interval,), daemon=True).start()
+
+    def ensure_indexes(self):
+        pass  # the indexes are maintained by every write
+
+    def existing_isbns(self, isbns):
+        with self._lock:
+            return {isbn for isbn in isbns if self.indexes["ISBN"].get(isbn)}
+
+    def insert_book(self, book: dict, ratings: dict):
+        with self._lock:
+            if self.indexes["ISBN"].get(book["ISBN"]):
+                raise DuplicateIsbnError(book["ISBN"])
+            self._put_book(copy_document(book))
+            self._put_ratings(copy_document(ratings))
+
+    def insert_books(self, books: list, ratings: list):
+        duplicates = set()
+        with self._lock:
+            for position, (book, document) in enumerate(zip(books, ratings)):
+                if self.indexes["ISBN"].get(book["ISBN"]):
+                    duplicates.add(position)
+                else:
+                    self._put_book(copy_document(book))
+                    self._put_ratings(copy_document(document))
+        return duplicates
+
+    def find(self, collection: str, query: dict, projection: dict = None, after: ObjectId = None, limit: int = None):
+        page = []
+        with self._lock:
+            for document in self._candidates(collection, query):
+                if after is not None and document["_id"] <= after:
+                    continue
+                if all(document.get(field, MISSING) == value for field, value in query.items()):
+                    page.append(copy_document(document, projection))
+                    if limit and len(page) == limit:
+                        break
+        return page
+
+    def find_batch(self, collection: str, queries: list):
+        return [self.find(collection, query) for query in queries]
+
+    def find_by_ids(self, collection: str, document_ids: list):
+        with self._lock:
+            documents = self.documents[collection]
+            return [copy_document(documents[document_id]) for document_id in document_ids
+                    if document_id in documents]
+
+    def get(self, collection: str, document_id: ObjectId, projection: dict = None):
+        with self._lock:
+            document = self.documents[collection].get(document_id)
+            return copy_document(document, projection) if document else None
+
+    def update_book(self, book_id: ObjectId, values: dict, expected: dict = None):
+        with self._lock:
+            previous = self.documents["books"].get(book_id)
+            if previous is None or any(previous.get(field, MISSING) != value
+                                       for field, value in (expected or {}).items()):
+                return None
+            holder = self.indexes["ISBN"].get(values.get("ISBN"))
+            if holder and book_id not in holder:
+                raise DuplicateIsbnError(values["ISBN"])
+            updated = dict(previous, **values)
+            self._unindex(previous)
+            self.documents["books"][book_id] = updated  # replaced in place, the books stay in '_id' order
+            self._index(updated)
+            self._dirty = True
+            return copy_document(previous)
+
+    def claim_books(self, book_ids: list, owner: str, lease: float):
+        return list(book_ids)  # a single process works on the data
+
+    def delete_book(self, book_id: ObjectId, ratings_projection: dict = None):
+        with self._lock:
+            if book_id not in self.documents["books"]:
+                return None, None
+            book = self._remove_book(book_id)
+            ratings = self.documents["ratings"].pop(book_id, None)
+            self.eligible.pop(book_id, None)
+            self._dirty = True
+            return book, copy_document(ratings, ratings_projection) if ratings else None
+
+    def export(self, collection: str, since: datetime = None):
+        after = ObjectId.from_datetime(since) if since else None
+        with self._lock:
+            documents = [copy_document(document) for document_id, document in self.documents[collection].items()
+                         if after is None or document_id >= after]
+        return iter(documents)
+
+    def add_rating(self, book_id: ObjectId, rate: int, max_values: int = None):
+        updated = self.add_ratings({book_id: [rate]}, max_values)
+        return updated[0] if updated else None
+
+    def add_ratings(self, ratings: dict, max_values: int = None):
+        updated = []
+        with self._lock:
+            for book_id, rates in ratings.items():
+                document = self.documents["ratings"].get(book_id)
+                if document is None:
+                    continue
+                document["count"] = document.get("count", 0) + len(rates)
+                document["sum"] = document.get("sum", 0) + sum(rates)
+                histogram = document.setdefault("histogram", {})
+                for rate in rates:
+                    histogram[str(int(rate))] = histogram.get(str(int(rate)), 0) + 1
+                if max_values is None or max_values > 0:
+                    values = document.setdefault("values", [])
+                    values.extend(rates)
+                    if max_values is not None:
+                        del values[:-max_values]
+                updated.append(copy_document(document, {"count": 1, "sum": 1, "title": 1}))
+            self._dirty = True
+        return updated
+
+    def set_rating_average(self, book_id: ObjectId, count: int, average: float, eligible: bool):
+        with self._lock:
+            document = self.documents["ratings"].get(book_id)
+            if document is None or document.get("count") != count:
+                return
+            document["average"] = average
+            document["eligible"] = eligible
+            if eligible:
+                self.eligible[book_id] = None
+            else:
+                self.eligible.pop(book_id, None)
+            self._dirty = True
+
+    def set_rating_averages(self, averages: list):
+        with self._lock:
+            for book_id, count, average, eligible in averages:
+                self.set_rating_average(book_id, count, average, eligible)
+
+    def backfill_rating_aggregates(self, min_ratings: int):
+        updated = 0
+        with self._lock:
+            for document_id, document in self.documents["ratings"].items():
+                if "count" not in document:
+                    document.update(rating_aggregates(document.get("values", [])))
+                    updated += 1
+                if "eligible" not in document:
+                    document["eligible"] = document["count"] >= min_ratings
+                    updated += 1
+                if document["eligible"]:
+                    self.eligible[document_id] = None
+            self._dirty = self._dirty or updated > 0
+        return updated
+
+    def top(self, k: int):
+        with self._lock:
+            ratings = self.documents["ratings"]
+            top_ratings = heapq.nlargest(k, (ratings[document_id] for document_id in self.eligible),
+                                         key=lambda document: document.get("average", 0))
+            return [copy_document(document) for document in top_ratings]
+
+    def aggregate_facets(self):
+        counters = defaultdict(lambda: defaultdict(int))  # (facet, value) -> counter fields
+        with self._lock:
+            for book_id, book in self.documents["books"].items():
+                counters[("genre", book.get("genre"))]["count"] += 1
+                counters[("publisher", book.get("publisher"))]["count"] += 1
+                published_date = book.get("publishedDate")
+                if isinstance(published_date, str) and re.match(YEAR_DATE_PATTERN, published_date):
+                    counters[("year", published_date[:4])]["count"] += 1
+                ratings = self.documents["ratings"].get(book_id)
+                genre = counters[("genre", book.get("genre"))]
+                genre["rating_sum"] += ratings.get("sum", 0) if ratings else 0
+                genre["rating_count"] += ratings.get("count", 0) if ratings else 0
+        return [dict(fields, facet=facet, value=value) for (facet, value), fields in counters.items()]
+
+    def get_facet_counters(self):
+        with self._lock:
+            return [dict(counter) for counter in self.facet_counters.values()
+                    if counter["count"] > 0 or counter["rating_count"] > 0]
+
+    def has_facet_counters(self):
+        return bool(self.facet_counters)
+
+    def mark_facet_counters_built(self):
+        pass  # a single process writes, the counters of an empty catalog are rebuilt on start at no cost
+
+    def apply_facet_deltas(self, deltas: dict):
+        with self._lock:
+            for (facet, value), increments in deltas.items():
+                counter = self.facet_counters.setdefault(
+                    f"{facet}:{value}", facet_counter({"facet": facet, "value": value, "count": 0}))
+                for field, increment in increments.items():
+                    counter[field] = counter.get(field, 0) + increment
+            self._dirty = True
+
+    def replace_facet_counters(self, counters: list):
+        with self._lock:
+            self.facet_counters = {f"{counter['facet']}:{counter['value']}": facet_counter(counter)
+                                   for counter in counters}
+            self._dirty = True
+
+    def stats(self):
+        return {"engine": "memory", "books": len(self.documents["books"]), "ratings": len(self.documents["ratings"]),
+                "eligible": len(self.eligible), "last_snapshot": self.last_snapshot}
+
+    def _candidates(self, collection: str, query: dict):
+        """
+        Select the documents that may match a query: the one with the queried '_id', those in the index entry
+        of the first indexed field of the query, or else every document. Must be called holding the lock.
+        """
+        documents = self.documents[collection]
+        if "_id" in query:
+            document = documents.get(query["_id"])
+            return [document] if document else []
+        if collection == "books":
+            for field in self.INDEXED_FIELDS:
+                if field in query:
+                    ids = self.indexes[field].get(query[field], {})
+                    return sorted((documents[document_id] for document_id in ids), key=lambda book: book["_id"])
+        return list(documents.values())
+
+    def _put_book(self, book: dict):
+        """
+        Store a new book and add it to the indexes. Must be called holding the lock.
+        """
+        self.documents["books"][book["_id"]] = book
+        self._index(book)
+        self._dirty = True
+
+    def _put_ratings(self, document: dict):
+        """
+        Store a ratings document. Must be called holding the lock.
+        """
+        self.documents["ratings"][document["_id"]] = document
+        if document.get("eligible"):
+            self.eligible[document["_id"]] = None
+        self._dirty = True
+
+    def _remove_book(self, book_id: ObjectId):
+        """
+        Remove a book and its index entries. Must be called holding the lock.
+        """
+        book = self.documents["books"].pop(book_id)
+        self._unindex(book)
+        return book
+
+    def _index(self, book: dict):
+        for field in self.INDEXED_FIELDS:
+            self.indexes[field][book.get(field)][book["_id"]] = None
+
+    def _unindex(self, book: dict):
+        for field in self.INDEXED_FIELDS:
+            entry = self.indexes[field].get(book.get(field))
+            if entry is not None:
+                entry.pop(book["_id"], None)
+                if not entry:
+                    del self.indexes[field][book.get(field)]
+
+    def save_snapshot(self):
+        """
+        Save every document to the snapshot file, atomically so a crash never leaves a partial snapshot.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            documents = [{"collection": collection, "document": copy_document(document)}
+                         for collection, documents in self.documents.items() for document in documents.values()]
+            documents += [{"collection": "facet_counts", "document": dict(counter)}
+                          for counter in self.facet_counters.values()]
+            self._dirty = False
+        temporary = f"{self.snapshot_path}.tmp"
+        with open(temporary, "wb") as f:
+            for document in documents:
+                f.write(BSON.encode(document))
+        os.replace(temporary, self.snapshot_path)
+        self.last_snapshot = datetime.utcnow().isoformat()
+
+    def load_snapshot(self):
+        """
+        Replace the data with the content of the snapshot file.
+        """
+        loaded = {"books": [], "ratings": [], "facet_counts": []}
+        with open(self.snapshot_path, "rb") as f:
+            for entry in decode_file_iter(f):
+                loaded[entry["collection"]].append(entry["document"])
+        with self._lock:
+            self.documents = {"books": {}, "ratings": {}}
+            self.indexes = {field: defaultdict(dict) for field in self.INDEXED_FIELDS}
+            self.eligible = {}
+            for book in sorted(loaded["books"], key=lambda book: book["_id"]):
+                self._put_book(book)
+            for document in sorted(loaded["ratings"], key=lambda document: document["_id"]):
+                self._put_ratings(document)
+            self.facet_counters = {counter["_id"]: counter for counter in loaded["facet_counts"]}
+            self._dirty = False
+        logger.info("Loaded %d books and %d ratings from %s", len(loaded["books"]), len(loaded["ratings"]),
+                    self.snapshot_path)
+
+    def _snapshot_periodically(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                self.save_snapshot()
+            except OSError as e:
+                logger.error("Could not save the snapshot to %s: %s", self.snapshot_path, e)
+
+
+RATINGS_BOOK_FIELDS = ("_id", "title")  # the fields a ratings document shares with its book
+MISSING = object()  # the value of the fields a document does not have, equal to no query value
+
+
+def copy_document(document: dict, projection: dict = None):
+    """
+    Copy a document deep enough that changing the copy, or its lists and sub-documents, leaves the stored one intact.
+
+    Args:
+        document (dict): The document.
+        projection (dict): The fields to copy as {field: 1}, '_id' is always copied. All fields if None.
+
+    Returns:
+        dict: The copy.
+    """
+    fields = document if projection is None else [field for field in ("_id", *projection) if field in document]
+    copy = {}
+    for field in fields:
+        value = document[field]
+        copy[field] = value.copy() if isinstance(value, (dict, list)) else value
+    return copy
+
+
+def rating_aggregates(values: list):
+    """
+    Compute the aggregate fields of a ratings document from its rating values.
+
+    Args:
+        values (list): The rating values.
+
+    Returns:
+        dict: The 'count', 'sum', 'histogram' and 'average' fields.
+    """
+    histogram = {str(star): 0 for star in range(1, 6)}
+    for value in values:
+        histogram[str(int(value))] += 1
+    return {"count": len(values), "sum": sum(values), "histogram": histogram,
+            "average": sum(values) / len(values) if values else 0}
+
+
+def rating_update(rates: list, max_values: int = None, prefix: str = ""):
+    """
+    Build the Mongo update adding ratings to the running aggregates and recent values of a ratings document.
+
+    Args:
+        rates (list): The rating values, in the order they were given.
+        max_values (int): How many of the most recent values to keep, 0 for none and None for all of them.
+        prefix (str): The path of the ratings fields in the updated document, e.g. 'ratings.' when embedded.
+
+    Returns:
+        dict: The update.
+    """
+    increments = {f"{prefix}count": len(rates), f"{prefix}sum": sum(rates)}
+    for rate in rates:
+        field = f"{prefix}histogram.{int(rate)}"
+        increments[field] = increments.get(field, 0) + 1
+    update = {"$inc": increments}
+    if max_values is None:
+        update["$push"] = {f"{prefix}values": {"$each": rates}}
+    elif max_values > 0:  # keep only the most recent values
+        update["$push"] = {f"{prefix}values": {"$each": rates, "$slice": -max_values}}
+    return update
+
+
+def embed_ratings(book: dict, ratings: dict):
+    """
+    Build the document of a book with its ratings embedded, from the book and its ratings document.
+    """
+    return dict(book, ratings={field: value for field, value in ratings.items() if field not in RATINGS_BOOK_FIELDS})
+
+
+def ratings_view(book: dict):
+    """
+    Build the ratings document of a book with embedded ratings, in the shape of the 'ratings' collection.
+    """
+    document = {field: book[field] for field in RATINGS_BOOK_FIELDS if field in book}
+    document.update(book.get("ratings", {}))
+    return document
+
+
+def ratings_query(query: dict):
+    """
+    Convert a query on ratings documents to a query on books with embedded ratings.
+    """
+    return {field if field in RATINGS_BOOK_FIELDS else f"ratings.{field}": value for field, value in query.items()}
+
+
+def ratings_projection(projection: dict = None):
+    """
+    Convert a projection of ratings documents to a projection of books with embedded ratings, all of the ratings
+    fields if None.
+    """
+    if projection is None:
+        return {"title": 1, "ratings": 1}
+    return {field if field in RATINGS_BOOK_FIELDS else f"ratings.{field}": value for field, value in projection.items()}
+
+
+def facet_counter(counter: dict):
+    """
+    Build a stored facet counter from a counter returned by aggregate_facets.
+    """
+    return {"_id": f"{counter['facet']}:{counter['value']}", "facet": counter["facet"], "value": counter["value"],
+            "count": counter["count"], "rating_sum": counter.get("rating_sum", 0),
+            "rating_count": counter.get("rating_count", 0)}
@@ -0,0 +1,135 @@
+import re
+from flask import request
+
+GENRES = frozenset(["Fiction", "Children", "Biography", "Science", "Science Fiction", "Fantasy", "Other"])
+PUBLISH_DATE_PATTERN = re.compile(r"^\d{4}(-\d{2}-\d{2})?$")  # yyyy-mm-dd or yyyy
+RATING_VALUES = frozenset([1, 2, 3, 4, 5])
+# the fields GET /books and GET /ratings can filter on
+BOOK_QUERY_FIELDS = frozenset(["title", "authors", "ISBN", "publisher", "publishDate", "publishedDate", "genre",
+                               "enrichment", "id", "_id"])
+ISBN_LENGTH = 13
+JSON_CONTENT_TYPE_ERROR = "Content-Type must be application/json"
+
+
+def validate_title(title):
+    """
+    Validate that the title is a string and not empty.
+
+    Args:
+        title (str): The title of the book to validate.
+
+    Returns:
+        bool: True if valid, False otherwise.
+    """
+    return isinstance(title, str) and len(title) > 0
+
+
+def validate_genre(genre):
+    """
+    Validate genre against the preset set of valid genres.
+
+    Args:
+        genre (str): The genre to validate.
+
+    Returns:
+        bool: True if the genre is valid, False otherwise.
+    """
+    return isinstance(genre, str) and genre in GENRES
+
+
+def validate_publish_date(date):
+    """
+    Validate publish date against the pattern yyyy-mm-dd or yyyy.
+
+    Args:
+        date (str): The publishing date string to validate.
+
+    Returns:
+        bool: True if the date matches the pattern, False otherwise.
+    """
+    return PUBLISH_DATE_PATTERN.match(date) is not None
+
+
+def validate_isbn_format(isbn):
+    """
+    Validate that the ISBN is a string of exactly 13 characters.
+
+    Args:
+        isbn (str): The ISBN to validate.
+
+    Returns:
+        bool: True if valid, False otherwise.
+    """
+    return isinstance(isbn, str) and len(isbn) == ISBN_LENGTH
+
+
+def validate_rating(rate):
+    """
+    Validate that a rating is a whole number between 1 and 5.
+
+    Args:
+        rate (float): The rating value.
+
+    Returns:
+        bool: True if valid, False otherwise.
+    """
+    return rate in RATING_VALUES  # 4.0 equals 4, 4.5 equals no rating value
+
+
+class RequestSchema:
+    """
+    The fields of a JSON request body and their types, built once at import and checked on every request.
+    Every field is required. Values are converted to their type as Flask-RESTful's request parser did,
+    so a number is accepted as a string field, and a JSON null is kept as None for the domain validation to reject.
+    """
+
+    def __init__(self, message: str, **fields):
+        """
+        Args:
+            message (str): The error message of a 422 response.
+            fields (type): The type of each field, by field name.
+        """
+        self.message = message
+        self.fields = tuple(fields.items())
+
+    def parse(self):
+        """
+        Parse the JSON body of the current request.
+
+        Returns:
+            tuple: The converted field values and None, or None and the error response, 415 if the body is not
+            JSON and 422 if it is malformed, not an object, or has a missing or unconvertible field.
+        """
+        if request.mimetype != "application/json":
+            return None, ({"message": JSON_CONTENT_TYPE_ERROR}, 415)
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return None, ({"message": self.message}, 422)
+        values = {}
+        for field, field_type in self.fields:
+            if field not in body:
+                return None, ({"message": self.message}, 422)
+            value = body[field]
+            try:
+                values[field] = None if value is None else field_type(value)
+            except (TypeError, ValueError):
+                return None, ({"message": self.message}, 422)
+        return values, None
+
+
+def json_body():
+    """
+    Get the JSON body of the current request, for the endpoints whose body is not a fixed set of fields.
+
+    Returns:
+        tuple: The parsed body, None if it is malformed, and None, or None and the 415 error response.
+    """
+    if request.mimetype != "application/json":
+        return None, ({"message": JSON_CONTENT_TYPE_ERROR}, 415)
+    return request.get_json(silent=True), None
+
+
+BOOK_SCHEMA = RequestSchema("Bad query POST format", title=str, ISBN=str, genre=str)
+BOOK_UPDATE_SCHEMA = RequestSchema("Incorrect PUT format", title=str, authors=str, ISBN=str, publisher=str,
+                                   publishedDate=str, genre=str)
+RATING_SCHEMA = RequestSchema("Bad query POST format", value=float)
@@ -0,0 +1,33 @@
+# Production server settings for 'gunicorn --config gunicorn.conf.py run:app'
+import glob
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '80')}"
+
+# Pre-fork workers, each serving requests on a pool of threads
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+# inherited by the workers, so the app knows whether other processes write behind its in-process caches
+os.environ["BOOKS_WORKERS"] = str(workers)
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+# The app is imported by each worker after the fork, so every worker creates its own MongoClient.
+# PyMongo clients are not fork-safe, keep this off.
+preload_app = False
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG", "-")
+errorlog = "-"
+
+
+def on_starting(server):
+    """
+    Remove the metrics files of a previous run, each worker of this run writes its own to METRICS_DIR.
+    """
+    metrics_dir = os.environ.get("METRICS_DIR")
+    if metrics_dir:
+        for path in glob.glob(os.path.join(metrics_dir, "metrics-*.json*")):
+            os.remove(path)
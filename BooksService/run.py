@@ -1,24 +1,132 @@
+import logging
+import os
 from flask_pymongo import PyMongo
 from flask import Flask
 from flask_restful import Api
+from Admission import AdmissionControl, MemoryTokenBuckets, MongoTokenBuckets, admission_options
 from BooksCollection import *
-from BooksAPI import Books, BooksId, Ratings, RatingsId, RatingsIdValues, Top  # Import resources
+from Cache import ResponseCache
+from CacheSync import ChangeListener
+from JsonEncoding import output_json
+from BooksAPI import Books, BooksBulk, BooksExport, BooksFacets, BooksId, BooksQueryBatch, BooksSearch, Ratings, \
+    RatingsBulk, RatingsExport, RatingsId, RatingsIdValues, Top, Stats, Metrics  # Import resources
+from GoogleBooksClient import GoogleBooksClient, google_books_client_options
+from Instrumentation import MetricsRegistry, instrument_app
+from MongoConfig import PoolStats, mongo_client_options, read_preference
+from MongoListeners import CommandDurations, SlowQueryLogger
+from Storage import EmbeddedMongoStorage, MemoryStorage, MongoStorage
+
+logging.basicConfig(level=logging.INFO)
 
 app = Flask(__name__)  # initialize Flask
 api = Api(app)  # create API
+api.representations['application/json'] = output_json  # serializes ObjectId and uses orjson when installed
+
+# Set METRICS_DIR under a multi-worker server so /metrics merges the totals of every worker
+metrics = MetricsRegistry(directory=os.environ.get("METRICS_DIR") or None)
+instrument_app(app, metrics)
+metrics.instrument_class(BooksCollection)
+
+storage_engine = os.environ.get("BOOKS_STORAGE", "mongo")
+stats_sources = {}
+if storage_engine == "memory":
+    # single-process deployments and tests, the data lives in the process and optionally in a snapshot file
+    snapshot_interval = float(os.environ.get("BOOKS_SNAPSHOT_INTERVAL", 60)) or None
+    storage = MemoryStorage(snapshot_path=os.environ.get("BOOKS_SNAPSHOT_PATH") or None,
+                            snapshot_interval=snapshot_interval)
+elif storage_engine == "mongo":
+    # Use Docker service name for MongoDB by default, e.g. MONGO_URI=mongodb://localhost:27017/AppDB to run locally
+    app.config["MONGO_URI"] = os.environ.get("MONGO_URI", "mongodb://mongodb:27017/AppDB")
+    slow_query_ms = int(os.environ.get("MONGO_SLOW_QUERY_MS", 100))
+    client_options = mongo_client_options()
+    pool_stats = PoolStats(client_options.get("maxPoolSize", 100))
+    mongo = PyMongo(app, event_listeners=[SlowQueryLogger(slow_query_ms), pool_stats, CommandDurations(metrics)],
+                    **client_options)
+    # 'embedded' keeps the ratings in the book documents, convert existing data with migrations/embed_ratings.py
+    ratings_layout = os.environ.get("BOOKS_RATINGS_LAYOUT", "collection")
+    if ratings_layout == "embedded":
+        storage = EmbeddedMongoStorage(mongo.db, read_preference=read_preference())
+    elif ratings_layout == "collection":
+        # transactions need a replica set
+        storage = MongoStorage(mongo.db, read_preference=read_preference(),
+                               transactions=os.environ.get("MONGO_TRANSACTIONS") == "true")
+    else:
+        raise ValueError(f"BOOKS_RATINGS_LAYOUT must be collection or embedded, got {ratings_layout}")
+    stats_sources["mongo_pool"] = pool_stats.stats
+else:
+    raise ValueError(f"BOOKS_STORAGE must be mongo or memory, got {storage_engine}")
+default_page_size = int(os.environ.get("BOOKS_DEFAULT_PAGE_SIZE", 0)) or None  # unset returns every book
+# The in-process caches only see the writes of their own process, unless cache sync applies those of the others,
+# so it is on by default with Mongo. gunicorn.conf.py sets BOOKS_WORKERS, several replicas also need cache sync.
+cache_sync = os.environ.get("BOOKS_CACHE_SYNC", "auto" if storage_engine == "mongo" else "off")
+unsynced_workers = storage_engine == "mongo" and cache_sync == "off" and int(os.environ.get("BOOKS_WORKERS", 1)) > 1
+if unsynced_workers:
+    logging.error("BOOKS_CACHE_SYNC is off with several workers, the response cache, ETags and search index "
+                  "are disabled")
+response_cache = ResponseCache(max_size=0 if unsynced_workers else int(os.environ.get("BOOKS_CACHE_SIZE", 2048)),
+                               ttl=float(os.environ.get("BOOKS_CACHE_TTL", 60)))
+google_books = GoogleBooksClient(**google_books_client_options())
+books_collection = BooksCollection(storage, default_page_size=default_page_size, response_cache=response_cache,
+                                   facet_counters=os.environ.get("BOOKS_FACET_COUNTERS") == "true",
+                                   google_books=google_books,
+                                   async_enrichment=os.environ.get("BOOKS_ASYNC_ENRICHMENT") == "true",
+                                   enrichment_workers=int(os.environ.get("BOOKS_ENRICHMENT_WORKERS",
+                                                                         BooksCollection.ENRICHMENT_WORKERS)),
+                                   entity_tags=not unsynced_workers, search_index=not unsynced_workers)
+# Keep the caches of several replicas, or workers, coherent: auto, watch (change streams) or poll
+if cache_sync != "off" and storage_engine == "mongo":
+    books_collection.cache_sync = ChangeListener(mongo.db, books_collection, mode=cache_sync,
+                                                 poll_interval=float(os.environ.get("BOOKS_CACHE_SYNC_INTERVAL", 1)))
+    books_collection.cache_sync.start()  # before any write, so the polling mode publishes every one
+    stats_sources["cache_sync"] = books_collection.cache_sync.stats
+elif cache_sync != "off":
+    logging.warning("BOOKS_CACHE_SYNC is ignored with in-memory storage, which runs a single process")
+books_collection.ensure_indexes()
+books_collection.backfill_rating_aggregates()
+books_collection.ensure_facet_counters()
+stats_sources.update(isbn_cache=books_collection.isbn_cache.stats, response_cache=response_cache.stats,
+                     search_index=books_collection.search_index.stats, storage=storage.stats,
+                     google_books=google_books.stats)
+if books_collection.enrichment is not None:
+    # also picks up the books of a worker that stopped mid-enrichment, once their claims expire
+    books_collection.enrichment.resume_periodically(books_collection.resume_enrichment,
+                                                    BooksCollection.ENRICHMENT_LEASE)
+    stats_sources["enrichment"] = books_collection.enrichment.stats
+
+# Admission control: per-endpoint concurrency limits with bounded queues, and per-client rate limiting
+# whose buckets are kept by each process (memory) or shared through Mongo (mongo)
+concurrency_limits, bucket_options = admission_options()
+token_buckets = None
+if bucket_options and os.environ.get("BOOKS_RATE_LIMIT_STORE", "memory") == "mongo" and storage_engine == "mongo":
+    token_buckets = MongoTokenBuckets(mongo.db.rate_limits, **bucket_options)
+    token_buckets.ensure_indexes()
+elif bucket_options:
+    if os.environ.get("BOOKS_RATE_LIMIT_STORE", "memory") != "memory":
+        logging.warning("BOOKS_RATE_LIMIT_STORE is ignored with in-memory storage, buckets are kept in memory")
+    token_buckets = MemoryTokenBuckets(**bucket_options)
+admission = AdmissionControl(concurrency_limits, token_buckets,
+                             client_header=os.environ.get("BOOKS_RATE_LIMIT_CLIENT_HEADER") or None)
+admission.install(app)  # after instrument_app, so rejected requests are counted in the request metrics
+stats_sources["admission"] = admission.stats
 
-app.config["MONGO_URI"] = "mongodb://mongodb:27017/AppDB"  # Use Docker service name for MongoDB
-# app.config["MONGO_URI"] = "mongodb://localhost:27017/AppDB"  # Use Docker service name for MongoDB
-mongo = PyMongo(app)
-books_collection = BooksCollection(mongo.db)
+# Resources are registered at import time so WSGI servers serving 'run:app' get the full API
+api.add_resource(Books, '/books', resource_class_args=[books_collection])
+api.add_resource(BooksBulk, '/books/bulk', resource_class_args=[books_collection])
+api.add_resource(BooksExport, '/books/export', resource_class_args=[books_collection])
+api.add_resource(BooksQueryBatch, '/books/query-batch', resource_class_args=[books_collection])
+api.add_resource(BooksFacets, '/books/facets', resource_class_args=[books_collection])
+api.add_resource(BooksSearch, '/books/search', resource_class_args=[books_collection])
+api.add_resource(BooksId, '/books/<string:book_id>', resource_class_args=[books_collection])
+api.add_resource(RatingsIdValues, '/ratings/<string:book_id>/values', resource_class_args=[books_collection])
+api.add_resource(Top, '/top', resource_class_args=[books_collection])
+api.add_resource(RatingsId, '/ratings/<string:book_id>', resource_class_args=[books_collection])
+api.add_resource(Ratings, '/ratings', resource_class_args=[books_collection])
+api.add_resource(RatingsExport, '/ratings/export', resource_class_args=[books_collection])
+api.add_resource(RatingsBulk, '/ratings/bulk', resource_class_args=[books_collection])
+api.add_resource(Stats, '/stats', resource_class_args=[stats_sources])
+api.add_resource(Metrics, '/metrics', resource_class_args=[metrics, stats_sources])
 
 
 if __name__ == "__main__":
-    api.add_resource(Books, '/books', resource_class_args=[books_collection])
-    api.add_resource(BooksId, '/books/<string:book_id>', resource_class_args=[books_collection])
-    api.add_resource(RatingsIdValues, '/ratings/<string:book_id>/values', resource_class_args=[books_collection])
-    api.add_resource(Top, '/top', resource_class_args=[books_collection])
-    api.add_resource(RatingsId, '/ratings/<string:book_id>', resource_class_args=[books_collection])
-    api.add_resource(Ratings, '/ratings', resource_class_args=[books_collection])
-
-    app.run(host='0.0.0.0', port=80, debug=True)
+    # Development server, production runs under gunicorn with gunicorn.conf.py
+    app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 80)), debug=os.environ.get("FLASK_DEBUG") == "true")
@@ -0,0 +1,61 @@
+"""
+Microbenchmark of the GET /books serialization path.
+
+Compares the previous path, converting every document's '_id' to a string and serializing with
+Flask-RESTful's default json.dumps representation, with the JsonEncoding representation that
+serializes ObjectId natively.
+
+Usage: python benchmarks/bench_serialization.py [--documents 10000] [--repeat 20]
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import timeit
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "BooksService"))
+import JsonEncoding  # noqa: E402
+
+
+def make_books(count):
+    return [{"_id": ObjectId(), "title": f"Book {i}", "authors": "Mark Twain and Charles Dudley Warner",
+             "ISBN": f"{9780000000000 + i}", "publisher": "Harper & Brothers", "publishedDate": "1873-01-01",
+             "genre": "Fiction"} for i in range(count)]
+
+
+def convert_id_to_string(book):
+    if '_id' in book:
+        book['_id'] = str(book['_id'])
+    return book
+
+
+def old_path(books):
+    return json.dumps([convert_id_to_string(book) for book in books]).encode()
+
+
+def new_path(books):
+    return JsonEncoding.dumps(books)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    books = make_books(args.documents)
+    # the old path converts the documents in place, give each run its own fresh documents
+    copies = [copy.deepcopy(books) for _ in range(args.repeat)]
+    old_time = min(timeit.repeat(lambda: old_path(copies.pop()), number=1, repeat=args.repeat))
+    new_time = min(timeit.repeat(lambda: new_path(books), number=1, repeat=args.repeat))
+
+    encoder = "orjson" if JsonEncoding.orjson is not None else "json"
+    print(f"{args.documents} documents, best of {args.repeat}")
+    print(f"convert_id_to_string + json.dumps: {old_time * 1000:8.2f} ms")
+    print(f"JsonEncoding.dumps ({encoder}):     {new_time * 1000:8.2f} ms  ({old_time / new_time:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
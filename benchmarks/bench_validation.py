@@ -0,0 +1,67 @@
+"""
+Microbenchmark of the per-request validation of PUT /books/{id}, POST /books and POST /ratings/{id}/values.
+
+Compares the previous path, building a Flask-RESTful RequestParser on every request, checking the genre and
+query fields against lists and matching an uncompiled date pattern, with the Validation schemas and sets built
+once at import.
+
+Usage: python benchmarks/bench_validation.py [--requests 20000] [--repeat 5]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+from flask import Flask
+from flask_restful import reqparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "BooksService"))
+import Validation  # noqa: E402
+
+OLD_GENRES = ["Fiction", "Children", "Biography", "Science", "Science Fiction", "Fantasy", "Other"]
+OLD_BOOK_FIELDS = ["title", "authors", "ISBN", "publisher", "publishDate", "publishedDate", "genre", "enrichment", "id",
+                   "_id"]
+PUT_BODY = {"title": "Adventures of Huckleberry Finn", "authors": "Mark Twain", "ISBN": "9780520343641",
+            "publisher": "University of California Press", "publishedDate": "2003-01-01", "genre": "Science Fiction"}
+QUERY = {"genre": "Science Fiction", "authors": "Mark Twain", "publishedDate": "2003-01-01"}
+
+
+def old_path():
+    parser = reqparse.RequestParser()
+    for field in PUT_BODY:
+        parser.add_argument(field, type=str, required=True, location='json')
+    args = parser.parse_args()
+    valid = args["genre"] in OLD_GENRES and bool(re.match(r'^\d{4}(-\d{2}-\d{2})?$', args["publishedDate"]))
+    return valid and all(field in OLD_BOOK_FIELDS for field in QUERY) and QUERY["genre"] in OLD_GENRES
+
+
+def new_path():
+    args, _ = Validation.BOOK_UPDATE_SCHEMA.parse()
+    valid = Validation.validate_genre(args["genre"]) and Validation.validate_publish_date(args["publishedDate"])
+    return valid and all(field in Validation.BOOK_QUERY_FIELDS for field in QUERY) \
+        and Validation.validate_genre(QUERY["genre"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    with app.test_request_context("/books/0", method="PUT", data=json.dumps(PUT_BODY),
+                                  content_type="application/json"):
+        assert old_path() and new_path()
+        old_time = min(timeit.repeat(old_path, number=args.requests, repeat=args.repeat))
+        new_time = min(timeit.repeat(new_path, number=args.requests, repeat=args.repeat))
+
+    per_request = 1e6 / args.requests
+    print(f"{args.requests} PUT /books/{{id}} validations, best of {args.repeat}")
+    print(f"RequestParser per request + lists + re.match: {old_time * per_request:7.2f} us/request")
+    print(f"Validation schemas + frozensets + compiled:   {new_time * per_request:7.2f} us/request  "
+          f"({old_time / new_time:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
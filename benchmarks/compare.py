@@ -0,0 +1,49 @@
+"""
+Compare two load test result files, e.g. from two commits, and flag latency and throughput regressions.
+
+Usage: python benchmarks/compare.py BASELINE.json CANDIDATE.json [--threshold 10]
+Exits with status 1 if any operation's p95 latency grew, or its throughput dropped, by more than the threshold percent.
+"""
+import argparse
+import json
+import sys
+
+
+def change(before, after):
+    return 100.0 * (after - before) / before if before else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    print(f"baseline {baseline['commit']} ({baseline['timestamp']}) -> candidate {candidate['commit']} "
+          f"({candidate['timestamp']})")
+    print(f"{'operation':<14}{'p50 ms':>20}{'p95 ms':>20}{'p99 ms':>20}{'rps':>20}")
+    regressions = []
+    rows = [(operation, stats, candidate["operations"][operation])
+            for operation, stats in baseline["operations"].items() if operation in candidate["operations"]]
+    rows.append(("TOTAL", baseline["total"], candidate["total"]))
+    for operation, before, after in rows:
+        cells = [f"{before[key]:7.2f}>{after[key]:7.2f}{change(before[key], after[key]):+4.0f}%"
+                 for key in ("p50_ms", "p95_ms", "p99_ms", "rps")]
+        print(f"{operation:<14}" + "".join(f"{cell:>20}" for cell in cells[:3]) + f"{cells[3]:>20}")
+        if change(before["p95_ms"], after["p95_ms"]) > args.threshold \
+                or change(before["rps"], after["rps"]) < -args.threshold:
+            regressions.append(operation)
+
+    if regressions:
+        print(f"Regressions over {args.threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Offline stand-in for the Google Books volumes API, for benchmarks.
+
+Answers GET /books/v1/volumes?q=isbn:<ISBN> with a deterministic volume for any ISBN,
+and with no items for ISBNs starting with '000'. An optional delay emulates upstream latency.
+
+Usage: python benchmarks/google_books_stub.py [--port 8099] [--delay-ms 0]
+Then run the service with GOOGLE_BOOKS_URL=http://localhost:8099/books/v1/volumes
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def volume(isbn):
+    number = int(isbn[-4:]) if isbn[-4:].isdigit() else 0
+    return {"totalItems": 1, "items": [{"volumeInfo": {
+        "title": f"Stub Book {isbn}",
+        "authors": [f"Author {number % 97}", f"Coauthor {number % 13}"][:1 + number % 2],
+        "publisher": f"Publisher {number % 11}",
+        "publishedDate": f"{1900 + number % 120}-{1 + number % 12:02d}-{1 + number % 28:02d}"}}]}
+
+
+class GoogleBooksStubHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query).get("q", [""])[0]
+        if url.path != "/books/v1/volumes" or not query.startswith("isbn:"):
+            self.send_error(404)
+            return
+        isbn = query[len("isbn:"):]
+        if self.delay:
+            time.sleep(self.delay)
+        body = json.dumps({"totalItems": 0} if isbn.startswith("000") else volume(isbn)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client timed out before the delayed response
+
+    def log_message(self, format, *args):
+        pass  # keep benchmark output readable
+
+
+def start_stub(port=0, delay_ms=0):
+    """
+    Start the stub server on a background thread.
+
+    Args:
+        port (int): The port to listen on, 0 for any free port.
+        delay_ms (float): Latency added to every response, in milliseconds.
+
+    Returns:
+        tuple: The server and the volumes API URL to set as GOOGLE_BOOKS_URL.
+    """
+    handler = type("Handler", (GoogleBooksStubHandler,), {"delay": delay_ms / 1000})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/books/v1/volumes"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--delay-ms", type=float, default=0)
+    args = parser.parse_args()
+    server, url = start_stub(args.port, args.delay_ms)
+    print(f"Google Books stub listening, set GOOGLE_BOOKS_URL={url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
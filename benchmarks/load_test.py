@@ -0,0 +1,308 @@
+"""
+Load test of every BooksService resource, runnable fully offline.
+
+Starts a Google Books stub, serves the app in-process on a threaded WSGI server (or targets a running deployment
+with --base-url), seeds N books and M ratings, then drives a weighted mix of reads and writes from concurrent
+clients. Reports p50/p95/p99 latency and requests per second per operation and saves them as JSON, so runs on
+different commits can be compared with benchmarks/compare.py.
+
+The in-process app stores its data either in a local mongod (--mongo-uri) or, with --in-memory, in process memory.
+
+Usage:
+    python benchmarks/load_test.py --in-memory --books 1000 --ratings 5000 --duration 30 --concurrency 16
+    python benchmarks/load_test.py --mongo-uri mongodb://localhost:27017/BooksBench
+    python benchmarks/load_test.py --base-url http://localhost:5001 --skip-seed
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.join(BENCHMARKS_DIR, "..", "BooksService")
+GENRES = ["Fiction", "Children", "Biography", "Science", "Science Fiction", "Fantasy", "Other"]
+
+# operation -> weight in the default mix, reads dominate as in production
+DEFAULT_MIX = {
+    "get_book": 20, "list_genre": 10, "list_page": 8, "get_ratings": 10, "list_ratings": 4, "top": 10,
+    "search": 8, "facets": 3, "query_batch": 3, "create_book": 5, "update_book": 4, "rate_book": 12,
+    "delete_book": 2,
+}
+
+
+def start_app(mongo_uri, in_memory):
+    """
+    Import the service and serve it on a threaded WSGI server on a background thread.
+
+    Args:
+        mongo_uri (str): The Mongo URI the service connects to.
+        in_memory (bool): Whether to use the in-memory storage instead of a Mongo server.
+
+    Returns:
+        str: The base URL of the service.
+    """
+    os.environ["MONGO_URI"] = mongo_uri
+    if in_memory:
+        os.environ["BOOKS_STORAGE"] = "memory"
+    sys.path.insert(0, SERVICE_DIR)
+    import run
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no access log line per request
+
+    server = make_server("127.0.0.1", 0, run.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+class Workload:
+    """
+    The state shared by the benchmark clients: the known book IDs and a source of unique ISBNs.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.book_ids = []
+        self.created_ids = []  # books created during the run, the only ones the workload deletes
+        self._isbn_counter = random.randrange(10 ** 9)
+        self._lock = threading.Lock()
+
+    def next_isbn(self):
+        with self._lock:
+            self._isbn_counter += 1
+            return f"978{self._isbn_counter % 10 ** 10:010d}"
+
+    def random_book_id(self):
+        return random.choice(self.book_ids)
+
+    def new_book(self):
+        return {"title": f"Bench Book {random.randrange(10 ** 6)}", "ISBN": self.next_isbn(),
+                "genre": random.choice(GENRES)}
+
+    # Every operation takes a requests session and returns the response
+
+    def get_book(self, session):
+        return session.get(f"{self.base_url}/books/{self.random_book_id()}")
+
+    def list_genre(self, session):
+        return session.get(f"{self.base_url}/books", params={"genre": random.choice(GENRES)})
+
+    def list_page(self, session):
+        return session.get(f"{self.base_url}/books", params={"limit": 50, "fields": "title,ISBN"})
+
+    def get_ratings(self, session):
+        return session.get(f"{self.base_url}/ratings/{self.random_book_id()}")
+
+    def list_ratings(self, session):
+        return session.get(f"{self.base_url}/ratings", params={"limit": 50})
+
+    def top(self, session):
+        return session.get(f"{self.base_url}/top")
+
+    def search(self, session):
+        return session.get(f"{self.base_url}/books/search", params={"q": f"author {random.randrange(97)}"})
+
+    def facets(self, session):
+        return session.get(f"{self.base_url}/books/facets")
+
+    def query_batch(self, session):
+        queries = [f"?genre={genre}" for genre in random.sample(GENRES, 3)] + [{"genre": random.choice(GENRES)}]
+        return session.post(f"{self.base_url}/books/query-batch", json=queries)
+
+    def create_book(self, session):
+        response = session.post(f"{self.base_url}/books", json=self.new_book())
+        if response.status_code == 201:
+            with self._lock:
+                self.created_ids.append(response.json()["ID"])
+        return response
+
+    def update_book(self, session):
+        book = dict(self.new_book(), authors="Bench Author", publisher="Bench Publisher", publishedDate="2000")
+        return session.put(f"{self.base_url}/books/{self.random_book_id()}", json=book)
+
+    def rate_book(self, session):
+        return session.post(f"{self.base_url}/ratings/{self.random_book_id()}/values",
+                            json={"value": random.randint(1, 5)})
+
+    def rate_books(self, session):
+        entries = [{"book_id": self.random_book_id(), "value": random.randint(1, 5)} for _ in range(50)]
+        return session.post(f"{self.base_url}/ratings/bulk", json=entries)
+
+    def delete_book(self, session):
+        with self._lock:
+            book_id = self.created_ids.pop() if self.created_ids else None
+        if book_id is None:
+            return self.create_book(session)  # nothing to delete yet
+        return session.delete(f"{self.base_url}/books/{book_id}")
+
+
+def seed(workload, books, ratings, concurrency):
+    """
+    Create the books through POST /books/bulk and rate them through POST /ratings/bulk.
+
+    Args:
+        workload (Workload): The workload, whose book IDs are filled in.
+        books (int): The number of books to create.
+        ratings (int): The number of ratings to post.
+        concurrency (int): The number of concurrent clients posting ratings batches.
+    """
+    session = requests.Session()
+    for start in range(0, books, 1000):
+        entries = [workload.new_book() for _ in range(min(1000, books - start))]
+        response = session.post(f"{workload.base_url}/books/bulk", json=entries)
+        response.raise_for_status()
+        workload.book_ids.extend(result["ID"] for result in response.json()["results"] if result["status"] == 201)
+    if not workload.book_ids:
+        workload.book_ids = [book["_id"] for book in session.get(f"{workload.base_url}/books").json()]
+
+    def rate(start):
+        entries = [{"book_id": workload.random_book_id(), "value": random.randint(1, 5)}
+                   for _ in range(min(1000, ratings - start))]
+        session.post(f"{workload.base_url}/ratings/bulk", json=entries).raise_for_status()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(rate, range(0, ratings, 1000)))
+
+
+def run_clients(workload, mix, duration, concurrency):
+    """
+    Run the weighted operation mix from concurrent clients for a fixed duration.
+
+    Args:
+        workload (Workload): The workload.
+        mix (dict): Operation name -> weight.
+        duration (float): The run duration in seconds.
+        concurrency (int): The number of concurrent clients.
+
+    Returns:
+        dict: Operation name -> list of (latency in seconds, status code or None on connection errors).
+    """
+    operations, weights = zip(*mix.items())
+    samples = defaultdict(list)
+    samples_lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        session = requests.Session()
+        local = defaultdict(list)
+        while time.monotonic() < deadline:
+            operation = random.choices(operations, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = getattr(workload, operation)(session).status_code
+            except requests.RequestException:
+                status = None
+            local[operation].append((time.perf_counter() - start, status))
+        with samples_lock:
+            for operation, values in local.items():
+                samples[operation].extend(values)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(values, duration):
+    latencies = sorted(latency for latency, _ in values)
+    statuses = defaultdict(int)
+    for _, status in values:
+        statuses[str(status)] += 1
+    errors = sum(count for status, count in statuses.items() if status == "None" or status.startswith("5"))
+    return {"count": len(values), "errors": errors, "rps": len(values) / duration,
+            "mean_ms": 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+            "p50_ms": 1000 * percentile(latencies, 0.50), "p95_ms": 1000 * percentile(latencies, 0.95),
+            "p99_ms": 1000 * percentile(latencies, 0.99), "max_ms": 1000 * latencies[-1] if latencies else 0.0,
+            "statuses": dict(statuses)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARKS_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--base-url", help="benchmark a running deployment instead of an in-process app")
+    target.add_argument("--in-memory", action="store_true", help="use the in-memory storage of the in-process app")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/BooksBench")
+    parser.add_argument("--books", type=int, default=1000)
+    parser.add_argument("--ratings", type=int, default=5000)
+    parser.add_argument("--skip-seed", action="store_true", help="use the books already in the db")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--google-delay-ms", type=float, default=0, help="latency of the Google Books stub")
+    parser.add_argument("--mix", type=json.loads, default=DEFAULT_MIX,
+                        help='operation weights as JSON, e.g. \'{"get_book": 1, "rate_book": 1}\'')
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--output", help="result file, benchmarks/results/<time>-<commit>.json by default")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from google_books_stub import start_stub
+    _, google_books_url = start_stub(delay_ms=args.google_delay_ms)
+    os.environ["GOOGLE_BOOKS_URL"] = google_books_url
+    base_url = args.base_url or start_app(args.mongo_uri, args.in_memory)
+
+    workload = Workload(base_url)
+    if args.skip_seed:
+        workload.book_ids = [book["_id"] for book in requests.get(f"{base_url}/books").json()]
+    else:
+        print(f"Seeding {args.books} books and {args.ratings} ratings")
+        seed(workload, args.books, args.ratings, args.concurrency)
+    if not workload.book_ids:
+        sys.exit("No books to benchmark against")
+
+    if args.warmup:
+        run_clients(workload, args.mix, args.warmup, args.concurrency)
+    print(f"Running {args.concurrency} clients for {args.duration}s against {base_url}")
+    samples = run_clients(workload, args.mix, args.duration, args.concurrency)
+
+    operations = {operation: summarize(values, args.duration) for operation, values in sorted(samples.items())}
+    result = {"commit": git_commit(), "timestamp": datetime.now(timezone.utc).isoformat(),
+              "config": {key: value for key, value in vars(args).items() if key != "output"},
+              "operations": operations,
+              "total": summarize([value for values in samples.values() for value in values], args.duration)}
+
+    print(f"{'operation':<14}{'count':>8}{'errors':>8}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for operation, stats in list(operations.items()) + [("TOTAL", result["total"])]:
+        print(f"{operation:<14}{stats['count']:>8}{stats['errors']:>8}{stats['rps']:>9.1f}"
+              f"{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}")
+
+    output = args.output or os.path.join(
+        BENCHMARKS_DIR, "results", f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{result['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
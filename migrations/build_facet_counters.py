@@ -0,0 +1,52 @@
+"""
+Builds the facet counters of GET /books/facets, kept by BOOKS_FACET_COUNTERS=true, from the books and ratings.
+
+Run it once before enabling the counters on an existing catalog, or to recount after the service ran with them
+disabled. A catalog without books needs no build, the service starts its counters empty. Stop the service, or
+every write to it, while building, and restart it afterwards: the counts of the writes made meanwhile would be lost,
+and the workers that started before the build aggregate the facets on every read until restarted. Rerun it after
+an interruption.
+
+Usage:
+    python migrations/build_facet_counters.py --mongo-uri mongodb://localhost:27017/books [--ratings-layout embedded]
+"""
+import argparse
+import os
+import sys
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "BooksService"))
+from Storage import EmbeddedMongoStorage, MongoStorage  # noqa: E402
+
+
+def build(db, embedded_ratings=False):
+    """
+    Replace the facet counters with counts aggregated over the books and ratings.
+
+    Args:
+        db: The Mongo database of the service.
+        embedded_ratings (bool): Whether the ratings are embedded in the books, BOOKS_RATINGS_LAYOUT=embedded.
+
+    Returns:
+        dict: The number of counters written.
+    """
+    storage = (EmbeddedMongoStorage if embedded_ratings else MongoStorage)(db)
+    counters = storage.aggregate_facets()
+    storage.replace_facet_counters(counters)
+    return {"counters": len(counters)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-uri", required=True, help="the URI of the service's database")
+    parser.add_argument("--ratings-layout", choices=["collection", "embedded"], default="collection",
+                        help="the BOOKS_RATINGS_LAYOUT of the service")
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo_uri).get_default_database()
+    result = build(db, embedded_ratings=args.ratings_layout == "embedded")
+    print(", ".join(f"{key}: {value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
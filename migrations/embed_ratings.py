@@ -0,0 +1,105 @@
+"""
+One-time migration between the two ratings layouts of the books service.
+
+By default copies every document of the 'ratings' collection into its book, under 'ratings', as read and written
+by BOOKS_RATINGS_LAYOUT=embedded. Books without a ratings document get empty ratings, and ratings documents
+without a book are skipped. With --reverse, rebuilds the 'ratings' collection from the embedded ratings and
+removes them from the books. Both directions are idempotent, rerun them after an interruption.
+
+Stop the service, or every write to it, while migrating, and restart it with the matching BOOKS_RATINGS_LAYOUT.
+
+Usage:
+    python migrations/embed_ratings.py --mongo-uri mongodb://localhost:27017/books [--drop]
+    python migrations/embed_ratings.py --mongo-uri mongodb://localhost:27017/books --reverse [--drop]
+"""
+import argparse
+import os
+import sys
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "BooksService"))
+from Storage import embed_ratings, ratings_view  # noqa: E402
+
+BATCH_SIZE = 1000
+EMPTY_RATINGS = {"values": [], "average": 0, "count": 0, "sum": 0,
+                 "histogram": {str(star): 0 for star in range(1, 6)}, "eligible": False}
+
+
+def write_batches(collection, requests, batch_size=BATCH_SIZE):
+    """
+    Run bulk write requests in batches.
+
+    Returns:
+        int: The number of documents matched by the requests.
+    """
+    matched, batch = 0, []
+    for request in requests:
+        batch.append(request)
+        if len(batch) == batch_size:
+            result = collection.bulk_write(batch, ordered=False)
+            matched += result.matched_count + result.upserted_count
+            batch = []
+    if batch:
+        result = collection.bulk_write(batch, ordered=False)
+        matched += result.matched_count + result.upserted_count
+    return matched
+
+
+def embed(db, drop=False, batch_size=BATCH_SIZE):
+    """
+    Copy the ratings documents into their books.
+
+    Args:
+        db: The Mongo database of the service.
+        drop (bool): Whether to drop the 'ratings' collection afterwards.
+        batch_size (int): The number of books updated per round trip.
+
+    Returns:
+        dict: The number of ratings documents embedded and skipped, and of books given empty ratings.
+    """
+    total = db.ratings.estimated_document_count()
+    # books embedded by a previous run are left as they are
+    embedded = write_batches(db.books, (UpdateOne({"_id": document["_id"], "ratings": {"$exists": False}},
+                                                  {"$set": {"ratings": embed_ratings({}, document)["ratings"]}})
+                                        for document in db.ratings.find()), batch_size)
+    empty = db.books.update_many({"ratings": {"$exists": False}}, {"$set": {"ratings": EMPTY_RATINGS}}).modified_count
+    if drop:
+        db.ratings.drop()
+    return {"embedded": embedded, "skipped": total - embedded, "empty": empty}
+
+
+def unembed(db, drop=False, batch_size=BATCH_SIZE):
+    """
+    Rebuild the ratings documents from the ratings embedded in the books.
+
+    Args:
+        db: The Mongo database of the service.
+        drop (bool): Whether to remove the embedded ratings from the books afterwards.
+        batch_size (int): The number of ratings documents written per round trip.
+
+    Returns:
+        dict: The number of ratings documents written, and of books their ratings were removed from.
+    """
+    books = db.books.find({"ratings": {"$exists": True}}, {"title": 1, "ratings": 1})
+    written = write_batches(db.ratings, (ReplaceOne({"_id": book["_id"]}, ratings_view(book), upsert=True)
+                                         for book in books), batch_size)
+    removed = db.books.update_many({"ratings": {"$exists": True}}, {"$unset": {"ratings": ""}}).modified_count \
+        if drop else 0
+    return {"written": written, "removed": removed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-uri", required=True, help="the URI of the service's database")
+    parser.add_argument("--reverse", action="store_true", help="move the ratings back to the 'ratings' collection")
+    parser.add_argument("--drop", action="store_true", help="remove the ratings from the previous layout")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo_uri).get_default_database()
+    result = (unembed if args.reverse else embed)(db, drop=args.drop, batch_size=args.batch_size)
+    print(", ".join(f"{key}: {value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "BooksService"))
+
+from Admission import AdmissionControl, ConcurrencyLimiter, MemoryTokenBuckets, MongoTokenBuckets, TokenBuckets, \
+    admission_options  # noqa: E402
+
+
+def make_app(admission, release):
+    """
+    An app whose slow endpoint waits until 'release' is set, and a fast one.
+    """
+    app = Flask(__name__)
+    admission.install(app)
+
+    @app.route("/slow", methods=["POST"])
+    def slow():
+        release.wait(5)
+        return {"message": "done"}, 201
+
+    @app.route("/fast")
+    def fast():
+        return {"message": "done"}, 200
+
+    @app.route("/metrics")
+    def metrics():
+        return "", 200
+
+    return app
+
+
+def eventually(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_concurrency_limit_queues_then_rejects():
+    limiter = ConcurrencyLimiter(max_concurrency=1, max_queued=1, queue_timeout=5)
+    release = threading.Event()
+    app = make_app(AdmissionControl({"POST /slow": limiter}), release)
+    statuses = []
+
+    def post():
+        statuses.append(app.test_client().post("/slow").status_code)
+
+    threads = [threading.Thread(target=post) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    assert eventually(lambda: limiter.stats()["queue_depth"] == 1)
+
+    response = app.test_client().post("/slow")  # one running, one queued
+    assert response.status_code == 503 and response.headers["Retry-After"] == "1"
+    assert app.test_client().get("/fast").status_code == 200  # other endpoints are not limited
+
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert statuses == [201, 201]
+    stats = limiter.stats()
+    assert stats["admitted"] == 2 and stats["rejected_queue_full"] == 1 and stats["in_flight"] == 0
+
+
+def test_queued_request_times_out():
+    limiter = ConcurrencyLimiter(max_concurrency=1, max_queued=1, queue_timeout=0.05)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    limiter.release()
+    assert limiter.acquire()
+    assert limiter.stats()["rejected_timeout"] == 1
+
+
+def test_rate_limit_per_client():
+    app = make_app(AdmissionControl(buckets=MemoryTokenBuckets(rate=0.5, capacity=2),
+                                    client_header="X-Forwarded-For"), threading.Event())
+    client = app.test_client()
+    first = {"X-Forwarded-For": "10.0.0.1, 10.0.0.254"}
+    assert [client.get("/fast", headers=first).status_code for _ in range(2)] == [200, 200]
+    response = client.get("/fast", headers=first)
+    assert response.status_code == 429 and response.headers["Retry-After"] == "2"
+    assert client.get("/fast", headers={"X-Forwarded-For": "10.0.0.2"}).status_code == 200
+    assert client.get("/metrics", headers=first).status_code == 200  # monitoring is never limited
+
+
+def test_mongo_token_buckets_are_shared():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().books_test.rate_limits
+    workers = [MongoTokenBuckets(collection, rate=0.001, capacity=3) for _ in range(2)]
+    workers[0].ensure_indexes()
+    allowed = [workers[attempt % 2].take("10.0.0.1")[0] for attempt in range(4)]
+    assert allowed == [True, True, True, False]
+    assert workers[0].take("10.0.0.2")[0]
+
+
+def test_admission_options():
+    limits, buckets = admission_options({"BOOKS_CONCURRENCY_LIMITS": '{"POST /books": [2, 4]}',
+                                         "BOOKS_QUEUE_TIMEOUT": "0.5", "BOOKS_RATE_LIMIT": "10"})
+    assert limits["POST /books"].stats()["max_queued"] == 4 and limits["POST /books"].queue_timeout == 0.5
+    assert buckets == {"rate": 10.0, "capacity": 10.0}
+    assert admission_options({}) == ({}, None)
+
+
+def test_token_buckets_need_a_store():
+    with pytest.raises(TypeError):
+        TokenBuckets(rate=1, capacity=1)
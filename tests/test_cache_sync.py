@@ -0,0 +1,235 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "BooksService"))
+
+from BooksCollection import BooksCollection  # noqa: E402
+from CacheSync import ChangeListener  # noqa: E402
+from Storage import EmbeddedMongoStorage, MongoStorage  # noqa: E402
+
+GOOGLE_DATA = {"authors": ["Mark Twain"], "publisher": "University of California Press", "publishedDate": "2003-01-01"}
+BOOK = {"title": "Adventures of Huckleberry Finn", "ISBN": "9780520343641", "genre": "Fiction"}
+# A single-node replica set for the change stream tests, e.g. mongodb://localhost:27017/?replicaSet=rs0
+REPLSET_URI = os.environ.get("MONGO_REPLSET_URI")
+
+
+@pytest.fixture(autouse=True)
+def google_books(monkeypatch):
+    monkeypatch.setattr(BooksCollection, "get_book_google_data", staticmethod(lambda isbn: (dict(GOOGLE_DATA), 200)))
+
+
+def replicas(db, mode, storage_class=MongoStorage):
+    """
+    Two service replicas sharing a db, each with its own caches and change listener.
+    """
+    collections = []
+    for _ in range(2):
+        books_collection = BooksCollection(storage_class(db))
+        books_collection.cache_sync = ChangeListener(db, books_collection, mode=mode, poll_interval=0.1)
+        books_collection.cache_sync.start(background=mode == ChangeListener.WATCH)
+        collections.append(books_collection)
+    return collections
+
+
+def eventually(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def put_values(book_id, title):
+    return {"title": title, "authors": "Mark Twain", "ISBN": BOOK["ISBN"], "publisher": "Penguin",
+            "publishedDate": "1884", "genre": "Fiction", "id": book_id}
+
+
+@pytest.fixture
+def polling():
+    mongomock = pytest.importorskip("mongomock")
+    return replicas(mongomock.MongoClient().books_test, ChangeListener.POLL)
+
+
+def test_poll_applies_writes_of_other_replicas(polling):
+    writer, reader = polling
+    book_id, _ = writer.insert_book(BOOK["title"], BOOK["ISBN"], BOOK["genre"])
+    assert reader.cache_sync.poll() == 1
+    assert reader.get_book({"genre": "Fiction"})[0][0]["title"] == BOOK["title"]  # cached listing
+    assert reader.search_books("huckleberry")[0][0]["title"] == BOOK["title"]  # built search index
+    tag = reader.versions.etag("books", book_id)
+
+    writer.update_book(put_values(book_id, "Huck Finn"))
+    assert reader.get_book({"genre": "Fiction"})[0][0]["title"] == BOOK["title"]  # stale until the next poll
+    assert reader.cache_sync.poll() == 1
+    assert reader.get_book({"genre": "Fiction"})[0][0]["title"] == "Huck Finn"
+    assert reader.get_book_by_id(book_id)[0]["title"] == "Huck Finn"
+    assert reader.search_books("huckleberry")[0] == []
+    assert reader.versions.etag("books", book_id) != tag
+
+    for value in (5, 4, 5):
+        reader.get_top()  # cached between the ratings
+        writer.rate_book(book_id, value)
+        reader.cache_sync.poll()
+    assert reader.get_top()[0][0]["average"] == pytest.approx(14 / 3)
+
+    writer.delete_book(book_id)
+    reader.cache_sync.poll()
+    assert reader.get_book_by_id(book_id)[1] == 404
+    assert reader.get_top()[0] == []
+
+
+def test_poll_skips_own_writes_and_recovers_from_gaps(polling):
+    writer, reader = polling
+    writer.insert_book(BOOK["title"], BOOK["ISBN"], BOOK["genre"])
+    assert writer.cache_sync.poll() == 1
+    assert writer.cache_sync.stats()["changes"] == 0
+
+    reader.cache_sync.poll()
+    reader.cache_sync.gap_timeout = 0
+    reader.cache_sync.counter_collection.update_one({"_id": ChangeListener.COUNTER_ID}, {"$inc": {"version": 1}})
+    reader.cache_sync.poll()  # the missing version is noticed
+    reader.cache_sync.poll()  # and given up on, every cache is dropped
+    stats = reader.cache_sync.stats()
+    assert stats["full_invalidations"] == 1 and stats["version"] == 2
+
+
+def test_poll_only_drops_the_listings_of_the_written_books(polling):
+    from bson import ObjectId
+    writer, reader = polling
+    book_id, _ = writer.insert_book(BOOK["title"], BOOK["ISBN"], BOOK["genre"])
+    other_id, _ = writer.insert_book("The Hobbit", "9780261103344", "Fantasy")
+    reader.cache_sync.poll()
+    for query in ({"title": BOOK["title"]}, {"title": "Huck Finn"}, {"genre": "Fiction"}, {"genre": "Fantasy"}):
+        reader.get_book(dict(query))  # cached
+
+    writer.storage.collections["books"].delete_one({"_id": ObjectId(other_id)})  # behind the caches
+    writer.update_book(put_values(book_id, "Huck Finn"))
+    reader.cache_sync.poll()
+    assert reader.get_book({"title": BOOK["title"]})[0] == []  # held the book
+    assert reader.get_book({"title": "Huck Finn"})[0][0]["title"] == "Huck Finn"  # matches it now
+    assert reader.get_book({"genre": "Fiction"})[0][0]["title"] == "Huck Finn"
+    assert reader.get_book({"genre": "Fantasy"})[0][0]["title"] == "The Hobbit"  # still cached
+
+
+def test_change_stream_ratings_of_embedded_books_keep_the_book_listings():
+    mongomock = pytest.importorskip("mongomock")
+    from bson import ObjectId, Timestamp
+    db = mongomock.MongoClient().books_test
+    listener = ChangeListener(db, BooksCollection(EmbeddedMongoStorage(db)), mode=ChangeListener.WATCH)
+    books_collection = listener.books_collection
+    book_id, _ = books_collection.insert_book(BOOK["title"], BOOK["ISBN"], BOOK["genre"])
+    books_collection.versions.follow("epoch", 0)
+    assert books_collection.get_book({"genre": "Fiction"})[0] != []  # cached
+    books_tag = books_collection.versions.etag("books", book_id)
+
+    db.books.delete_many({})  # behind the caches
+    listener.apply_event({"operationType": "update", "ns": {"coll": "books"}, "documentKey": {"_id": ObjectId(book_id)},
+                          "clusterTime": Timestamp(1700000000, 1),
+                          "updateDescription": {"updatedFields": {"ratings.count": 1, "ratings.sum": 5},
+                                                "removedFields": []}})
+    assert books_collection.get_book({"genre": "Fiction"})[0] != []
+    assert books_collection.versions.etag("books", book_id) == books_tag
+    assert books_collection.versions.etag("ratings", book_id) is not None
+
+
+def test_poll_workers_issue_the_same_entity_tags(polling):
+    writer, reader = polling
+
+    def tags(books_collection, book_id):
+        versions = books_collection.versions
+        return versions.etag("books"), versions.etag("books", book_id), versions.etag("ratings", book_id)
+
+    book_id, _ = writer.insert_book(BOOK["title"], BOOK["ISBN"], BOOK["genre"])
+    assert tags(writer, book_id) == (None, None, None)  # untagged until the shared version is known
+    for books_collection in polling:
+        books_collection.cache_sync.poll()
+    assert None not in tags(writer, book_id) and tags(writer, book_id) == tags(reader, book_id)
+
+    late = replicas(writer.cache_sync.db, ChangeListener.POLL)[0]  # replays the changes after the floor
+    assert tags(late, book_id) == tags(reader, book_id)
+    before = tags(reader, book_id)
+    writer.update_book(put_values(book_id, "Huck Finn"))
+    for books_collection in (writer, reader, late):
+        books_collection.cache_sync.poll()
+    assert tags(writer, book_id) == tags(reader, book_id) == tags(late, book_id)
+    assert tags(reader, book_id)[:2] != before[:2] and tags(reader, book_id)[2] == before[2]
+
+    writer.cache_sync.changes_collection.delete_many({})  # expired, a new process raises the floor
+    newest = replicas(writer.cache_sync.db, ChangeListener.POLL)[0]
+    assert tags(newest, book_id) != tags(reader, book_id)
+    for books_collection in (writer, reader, late):
+        books_collection.cache_sync.poll()
+    assert tags(writer, book_id) == tags(reader, book_id) == tags(late, book_id) == tags(newest, book_id)
+
+
+def test_change_stream_events_give_the_same_entity_tags():
+    mongomock = pytest.importorskip("mongomock")
+    from bson import ObjectId, Timestamp
+    db = mongomock.MongoClient().books_test
+    listeners = [ChangeListener(db, BooksCollection(MongoStorage(db)), mode=ChangeListener.WATCH) for _ in range(2)]
+    book_id, other_id = ObjectId(), ObjectId()
+    events = [{"operationType": "update", "ns": {"coll": "books"}, "documentKey": {"_id": book_id},
+               "clusterTime": Timestamp(1700000000, 1)},
+              {"operationType": "delete", "ns": {"coll": "books"}, "documentKey": {"_id": other_id},
+               "clusterTime": Timestamp(1700000000, 2)}]
+
+    def tags(listener):
+        versions = listener.books_collection.versions
+        return versions.etag("books"), versions.etag("books", book_id), versions.etag("books", other_id)
+
+    for listener in listeners:
+        listener.books_collection.versions.follow("epoch", 0)
+        listener.books_collection.versions.bump("books", book_id)  # written by this process
+        assert tags(listener)[:2] == (None, None)
+        for event in events:
+            listener.apply_event(event)
+    assert None not in tags(listeners[0]) and tags(listeners[0]) == tags(listeners[1])
+
+    before = tags(listeners[0])
+    floor_event = {"operationType": "update", "ns": {"coll": "cache_sync"}, "documentKey": {"_id": "watch"},
+                   "clusterTime": Timestamp(1700000000, 4),
+                   "fullDocument": {"_id": "watch", "floor": Timestamp(1700000000, 3), "epoch": "epoch"}}
+    listeners[0].apply_event(floor_event)
+    assert tags(listeners[0])[1] not in before and tags(listeners[0]) != tags(listeners[1])
+    listeners[1].apply_event(floor_event)
+    assert tags(listeners[0]) == tags(listeners[1])
+
+
+def test_poll_applies_title_changes_to_embedded_ratings():
+    mongomock = pytest.importorskip("mongomock")
+    writer, reader = replicas(mongomock.MongoClient().books_test, ChangeListener.POLL, EmbeddedMongoStorage)
+    book_id, _ = writer.insert_book(BOOK["title"], BOOK["ISBN"], BOOK["genre"])
+    for value in (5, 4, 5):
+        writer.rate_book(book_id, value)
+    reader.cache_sync.poll()
+    assert reader.get_book_ratings_by_id(book_id)[0]["title"] == BOOK["title"]  # cached
+    assert reader.get_top()[0][0]["title"] == BOOK["title"]
+    tag = reader.versions.etag("ratings", book_id)
+
+    writer.update_book(put_values(book_id, "Huck Finn"))
+    reader.cache_sync.poll()
+    assert reader.get_book_ratings_by_id(book_id)[0]["title"] == "Huck Finn"
+    assert reader.get_top()[0][0]["title"] == "Huck Finn"
+    assert reader.versions.etag("ratings", book_id) != tag
+
+
+@pytest.mark.skipif(not REPLSET_URI, reason="MONGO_REPLSET_URI is not set")
+def test_change_stream_applies_writes_of_other_replicas():
+    from pymongo import MongoClient
+    client = MongoClient(REPLSET_URI)
+    client.drop_database("books_cache_sync_test")
+    writer, reader = replicas(client.books_cache_sync_test, ChangeListener.WATCH)
+    try:
+        book_id, _ = writer.insert_book(BOOK["title"], BOOK["ISBN"], BOOK["genre"])
+        assert eventually(lambda: reader.get_book({"genre": "Fiction"})[0] != [])
+        writer.update_book(put_values(book_id, "Huck Finn"))
+        assert eventually(lambda: reader.get_book({"genre": "Fiction"})[0][0]["title"] == "Huck Finn")
+        assert eventually(lambda: reader.search_books("huckleberry")[0] == [])
+        writer.delete_book(book_id)
+        assert eventually(lambda: reader.get_book_by_id(book_id)[1] == 404)
+    finally:
+        for books_collection in (writer, reader):
+            books_collection.cache_sync.stop()
+        client.drop_database("books_cache_sync_test")
@@ -0,0 +1,154 @@
+import os
+import sys
+import threading
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "BooksService"))
+
+import GoogleBooksClient as google_books_client  # noqa: E402
+from GoogleBooksClient import CircuitBreaker, GoogleBooksClient  # noqa: E402
+
+VOLUMES = {"totalItems": 1, "items": [{"volumeInfo": {"authors": ["Mark Twain"], "publisher": "Penguin",
+                                                      "publishedDate": "1884"}}]}
+
+
+class StubResponse:
+    def __init__(self, status_code=200, body=VOLUMES):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class Clock:
+    """
+    A monotonic clock the tests move forward by hand.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(google_books_client.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def make_client(responses, **options):
+    """
+    A client whose requests get the given responses in turn, an exception instance is raised instead.
+    """
+    client = GoogleBooksClient(**dict({"backoff": 0}, **options))
+    calls = []
+
+    def get(url, params=None, timeout=None):
+        calls.append(params)
+        response = responses[min(len(calls), len(responses)) - 1]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    client.session.get = get
+    client.calls = calls
+    return client
+
+
+def test_breaker_states(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    assert breaker.allow() and breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow()
+
+    clock.now += 30
+    assert breaker.allow() and breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()  # a single trial call
+    breaker.record_failure()  # the trial failed, open for another reset timeout
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow()
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+    assert breaker.stats() == {"state": "closed", "consecutive_failures": 0, "opened": 2}
+
+
+def test_lookup_results_and_breaker(clock):
+    client = make_client([StubResponse(503)], retries=0, failure_threshold=2, reset_timeout=30)
+    for _ in range(2):
+        assert client.lookup("9780520343641")[1] == 503
+    assert client.lookup("9780520343641") == ({"error": "Google Books API is unavailable, circuit breaker open"},
+                                              503)
+    assert len(client.calls) == 2  # failed fast, without a request
+
+    clock.now += 30
+    client.session.get = lambda url, params=None, timeout=None: StubResponse()
+    assert client.lookup("9780520343641") == ({"authors": ["Mark Twain"], "publisher": "Penguin",
+                                               "publishedDate": "1884"}, 200)
+    client.session.get = lambda url, params=None, timeout=None: StubResponse(body={"totalItems": 0})
+    assert client.lookup("0000000000000")[1] == 400  # an unknown ISBN is not an upstream failure
+    assert client.breaker.state == CircuitBreaker.CLOSED
+    assert client.stats()["short_circuited"] == 1
+
+
+def test_trial_call_without_a_slot_does_not_stick_half_open(clock):
+    client = make_client([StubResponse(503)], retries=0, failure_threshold=1, reset_timeout=30,
+                         max_concurrency=1, acquire_timeout=0.01)
+    assert client.lookup("9780520343641")[1] == 503
+    clock.now += 30
+    client._slots.acquire()  # every slot is busy during the trial call
+    assert client.lookup("9780520343641") == ({"error": "too many concurrent Google Books API lookups"}, 503)
+    assert client.breaker.state == CircuitBreaker.OPEN
+    client._slots.release()
+
+    client.session.get = lambda url, params=None, timeout=None: StubResponse()
+    assert client.lookup("9780520343641")[1] == 200  # the next call makes the trial
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_retries_are_bounded_with_capped_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(google_books_client.time, "sleep", sleeps.append)
+    client = make_client([requests.exceptions.ConnectTimeout("timed out")], retries=3, max_backoff=0.5)
+    client.backoff = 0.2
+    assert client.lookup("9780520343641")[1] == 503
+    assert len(client.calls) == 4 and len(sleeps) == 3
+    for attempt, seconds in enumerate(sleeps, start=1):  # full jitter below the capped exponential backoff
+        assert 0 <= seconds <= min(0.5, 0.2 * 2 ** (attempt - 1))
+    assert client.stats()["retries"] == 3 and client.stats()["timeouts"] == 4
+
+    retried = make_client([StubResponse(500), StubResponse(404)], retries=3)
+    assert retried.lookup("9780520343641")[1] == 503
+    assert len(retried.calls) == 2  # a non-retryable status ends the retries
+
+
+def test_concurrent_lookups_are_bounded():
+    started, release = threading.Event(), threading.Event()
+
+    def slow_get(url, params=None, timeout=None):
+        started.set()
+        release.wait(5)
+        return StubResponse()
+
+    client = make_client([StubResponse()], max_concurrency=1, acquire_timeout=0.05)
+    client.session.get = slow_get
+    results = []
+    thread = threading.Thread(target=lambda: results.append(client.lookup("9780520343641")[1]))
+    thread.start()
+    assert started.wait(5)
+    assert client.stats()["in_flight"] == 1
+    assert client.lookup("9780385050784")[1] == 503  # no slot within the acquire timeout
+    release.set()
+    thread.join()
+    assert results == [200]
+    stats = client.stats()
+    assert stats["rejected_busy"] == 1 and stats["in_flight"] == 0
+    assert client.breaker.state == CircuitBreaker.CLOSED  # busy is not an upstream failure
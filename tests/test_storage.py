@@ -0,0 +1,387 @@
+import os
+import sys
+import time
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "BooksService"))
+
+from BooksCollection import BooksCollection  # noqa: E402
+from Cache import ResponseCache, VersionTracker  # noqa: E402
+from Storage import EmbeddedMongoStorage, MemoryStorage, MongoStorage  # noqa: E402
+
+GOOGLE_DATA = {"authors": ["Mark Twain"], "publisher": "University of California Press", "publishedDate": "2003-01-01"}
+
+books = [
+    {"title": "Adventures of Huckleberry Finn", "ISBN": "9780520343641", "genre": "Fiction"},
+    {"title": "The Best of Isaac Asimov", "ISBN": "9780385050784", "genre": "Science Fiction"},
+    {"title": "Fear No Evil", "ISBN": "9780394558783", "genre": "Biography"},
+    {"title": "I, Robot", "ISBN": "9780553294385", "genre": "Science Fiction"},
+]
+
+
+def mongo_storage(storage_class=MongoStorage):
+    mongomock = pytest.importorskip("mongomock")
+    return storage_class(mongomock.MongoClient().books_test)
+
+
+def google_lookup(isbn):
+    if isbn.startswith("000"):
+        return {"error": BooksCollection.GOOGLE_NO_ITEMS_ERROR}, 400
+    return dict(GOOGLE_DATA), 200
+
+
+@pytest.fixture
+def google_books(monkeypatch):
+    monkeypatch.setattr(BooksCollection, "get_book_google_data", staticmethod(google_lookup))
+
+
+@pytest.fixture(params=["memory", "mongo", "embedded"])
+def backend(request, google_books):
+    return request.param
+
+
+def make_collection(backend, **options):
+    if backend == "memory":
+        storage = MemoryStorage()
+    else:
+        storage = mongo_storage(EmbeddedMongoStorage if backend == "embedded" else MongoStorage)
+    books_collection = BooksCollection(storage, facet_counters=True, **options)
+    books_collection.ensure_indexes()
+    return books_collection
+
+
+@pytest.fixture
+def collection(backend):
+    return make_collection(backend)
+
+
+def insert(collection, book):
+    book_id, status = collection.insert_book(book["title"], book["ISBN"], book["genre"])
+    assert status == 201
+    return book_id
+
+
+def test_insert_and_get(collection):
+    book_id = insert(collection, books[0])
+    book, status = collection.get_book_by_id(book_id)
+    assert status == 200
+    assert book["title"] == books[0]["title"]
+    assert book["authors"] == "Mark Twain"
+    ratings, status = collection.get_book_ratings_by_id(book_id)
+    assert status == 200
+    assert ratings["values"] == [] and ratings["count"] == 0
+
+
+def test_duplicate_isbn_rejected(collection):
+    insert(collection, books[0])
+    assert collection.insert_book("Another title", books[0]["ISBN"], "Fiction")[1] == 422
+
+
+def test_insert_books(collection):
+    insert(collection, books[0])
+    results, created = collection.insert_books(books + [dict(books[1], title="Copy")])
+    assert created == 3
+    assert [result["status"] for result in results] == [422, 201, 201, 201, 422]
+
+
+def test_query_and_pagination(collection):
+    ids = [insert(collection, book) for book in books]
+    page, status = collection.get_book({"genre": "Science Fiction"})
+    assert status == 200
+    assert sorted(book["ISBN"] for book in page) == [books[1]["ISBN"], books[3]["ISBN"]]
+    assert collection.get_book({"ISBN": books[2]["ISBN"]})[0][0]["title"] == books[2]["title"]
+    assert collection.get_book({"genre": "Jokes"})[1] == 422
+
+    first, _ = collection.get_book({}, limit=3)
+    second, _ = collection.get_book({}, limit=3, after=collection.next_cursor(first, 3))
+    assert [str(book["_id"]) for book in first + second] == ids
+    assert collection.get_book({}, fields=["title"])[0][0].keys() == {"_id", "title"}
+
+
+def test_books_batch(collection):
+    for book in books:
+        insert(collection, book)
+    results = collection.get_books_batch([{"genre": "Science Fiction"}, {"ISBN": books[2]["ISBN"]},
+                                          {"genre": "Fantasy"}, {"genre": "Jokes"}])
+    assert sorted(book["ISBN"] for book in results[0][0]) == [books[1]["ISBN"], books[3]["ISBN"]]
+    assert [book["title"] for book in results[1][0]] == [books[2]["title"]]
+    assert [status for _, status in results] == [200, 200, 200, 422] and results[2][0] == []
+    assert len(collection.get_books_batch([{}, {"genre": "Fiction"}])[0][0]) == 4
+
+
+def test_batch_is_narrowed_before_its_facets(google_books, monkeypatch):
+    collection = make_collection("mongo")
+    insert(collection, books[0])
+    reader = collection.storage.readers["books"]
+    pipelines = []
+
+    def aggregate(pipeline, **options):
+        pipelines.append(pipeline)
+        return type(reader).aggregate(reader, pipeline, **options)
+
+    monkeypatch.setattr(reader, "aggregate", aggregate)
+    assert collection.get_books_batch([{"genre": "Fiction"}, {"genre": "Biography"}])[0][0] != []
+    assert pipelines[0][0] == {"$match": {"$or": [{"genre": "Fiction"}, {"genre": "Biography"}]}}
+
+
+def test_update_book(collection):
+    book_id = insert(collection, books[0])
+    values = {"title": "Huck Finn", "authors": "Mark Twain", "ISBN": books[0]["ISBN"], "publisher": "Penguin",
+              "publishedDate": "1884", "genre": "Children", "id": book_id}
+    assert collection.update_book(dict(values)) == (book_id, 200)
+    assert collection.get_book_by_id(book_id)[0]["genre"] == "Children"
+    assert collection.get_book({"genre": "Fiction"})[0] == []
+    assert len(collection.get_book({"genre": "Children"})[0]) == 1
+    assert collection.update_book(dict(values, id="0123456789abcdef01234567"))[1] == 404
+
+
+def test_delete_book(collection):
+    book_id = insert(collection, books[0])
+    assert collection.delete_book(book_id) == (book_id, 200)
+    assert collection.get_book_by_id(book_id)[1] == 404
+    assert collection.get_book_ratings_by_id(book_id)[1] == 404
+    assert collection.delete_book(book_id)[1] == 404
+
+
+def test_ratings_and_top(collection):
+    ids = [insert(collection, book) for book in books]
+    for book_id, values in zip(ids, [[5, 4, 5], [3, 3, 3], [5, 5], [4, 4, 5, 5]]):
+        for value in values:
+            assert collection.rate_book(book_id, value)[2] == 201
+    assert collection.rate_book(ids[0], 6)[2] == 422
+    assert collection.rate_book("0123456789abcdef01234567", 5)[2] == 404
+
+    ratings, _ = collection.get_book_ratings_by_id(ids[0])
+    assert ratings["values"] == [5, 4, 5]
+    assert ratings["average"] == pytest.approx(14 / 3)
+    top, _ = collection.get_top(2)
+    assert [str(ratings["_id"]) for ratings in top] == [ids[0], ids[3]]  # the third book has too few ratings
+
+
+def test_rate_books(collection):
+    ids = [insert(collection, book) for book in books]
+    collection.get_top()  # cached before the batch
+    entries = [{"book_id": ids[0], "value": 5}, {"book_id": ids[1], "value": 3}, {"book_id": ids[0], "value": 4},
+               {"book_id": ids[0], "value": "5"}, {"book_id": ids[1], "value": 6}, {"book_id": "not an id", "value": 4},
+               {"book_id": "0123456789abcdef01234567", "value": 4}, {"value": 4}]
+    results, rated = collection.rate_books(entries)
+    assert rated == 4
+    assert [result["status"] for result in results] == [201, 201, 201, 201, 422, 404, 404, 422]
+    assert results[3]["average"] == pytest.approx(14 / 3)
+
+    ratings, _ = collection.get_book_ratings_by_id(ids[0])
+    assert ratings["values"] == [5, 4, 5]
+    assert ratings["histogram"]["5"] == 2
+    assert ratings["average"] == pytest.approx(14 / 3)
+    assert [str(ratings["_id"]) for ratings in collection.get_top()[0]] == [ids[0]]
+    assert collection.get_facets()[0]["average_rating_by_genre"] == {"Fiction": pytest.approx(14 / 3),
+                                                                     "Science Fiction": 3}
+
+
+def test_facets(collection):
+    ids = [insert(collection, book) for book in books]
+    collection.rate_book(ids[1], 4)
+    collection.delete_book(ids[3])
+    facets, _ = collection.get_facets()
+    assert facets["genre"] == {"Fiction": 1, "Science Fiction": 1, "Biography": 1}
+    assert facets["year"] == {"2003": 3}
+    assert facets["average_rating_by_genre"] == {"Science Fiction": 4}
+
+
+def test_unsynced_workers_read_writes_of_others(google_books):
+    mongomock = pytest.importorskip("mongomock")
+    db = mongomock.MongoClient().books_test
+    writer, reader = (BooksCollection(MongoStorage(db), response_cache=ResponseCache(max_size=0), entity_tags=False,
+                                      search_index=False) for _ in range(2))
+    assert reader.search_books("huckleberry")[0] == []
+    book_id = insert(writer, books[0])
+    assert reader.get_book_by_id(book_id)[1] == 200
+    assert reader.get_book({"genre": "Fiction"})[0] != []
+    assert [str(book["_id"]) for book in reader.search_books("huckleberry")[0]] == [book_id]
+    writer.delete_book(book_id)
+    assert reader.get_book_by_id(book_id)[1] == 404
+    assert reader.get_book({"genre": "Fiction"})[0] == []
+    assert reader.response_cache.stats()["size"] == 0
+    assert reader.search_index.stats()["books"] == 0
+
+
+def test_version_tracker_forgets_old_documents():
+    versions = VersionTracker(max_documents=2)
+    tags = {}
+    for document_id in ("a", "b", "a", "c", "d"):
+        tags.setdefault(document_id, []).append(versions.etag("books", document_id))
+        versions.bump("books", document_id)
+    assert len(versions._documents) == 2
+    for document_id, previous in tags.items():  # tags issued before a write never match again
+        assert versions.etag("books", document_id) not in previous
+    assert VersionTracker(enabled=False).etag("books", "a") is None
+
+
+def test_memory_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(BooksCollection, "get_book_google_data", staticmethod(lambda isbn: (dict(GOOGLE_DATA), 200)))
+    path = str(tmp_path / "books.bson")
+    collection = BooksCollection(MemoryStorage(snapshot_path=path))
+    book_id = insert(collection, books[0])
+    collection.rate_book(book_id, 5)
+    collection.storage.save_snapshot()
+
+    restored = BooksCollection(MemoryStorage(snapshot_path=path))
+    assert restored.get_book({"ISBN": books[0]["ISBN"]})[0][0]["title"] == books[0]["title"]
+    assert restored.get_book_ratings_by_id(book_id)[0]["values"] == [5]
+
+
+def wait_for_enrichment(collection, timeout=5):
+    deadline = time.monotonic() + timeout
+    while collection.enrichment.stats()["queued"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_async_enrichment(backend):
+    collection = make_collection(backend, async_enrichment=True)
+    book_id = insert(collection, books[0])
+    unknown_id = insert(collection, {"title": "No such book", "ISBN": "0000001111111", "genre": "Biography"})
+    wait_for_enrichment(collection)
+
+    book, _ = collection.get_book_by_id(book_id)
+    assert book["enrichment"] == "enriched"
+    assert book["authors"] == "Mark Twain"
+    assert collection.get_book_by_id(unknown_id)[0]["enrichment"] == "failed"
+    assert collection.get_facets()[0]["year"] == {"2003": 1}
+
+
+def test_put_before_enrichment_wins(backend, monkeypatch):
+    collection = make_collection(backend, async_enrichment=True)
+    monkeypatch.setattr(collection.enrichment, "submit", lambda book_id, attempt=1: None)  # keep the book pending
+    book_id = insert(collection, books[0])
+    assert collection.get_book_by_id(book_id)[0]["enrichment"] == "pending"
+    values = {"title": "Huck Finn", "authors": "Twain", "ISBN": books[0]["ISBN"], "publisher": "Penguin",
+              "publishedDate": "1884", "genre": "Fiction", "id": book_id}
+    assert collection.update_book(values)[1] == 200
+    assert collection.enrich_book(book_id) is True
+    book, _ = collection.get_book_by_id(book_id)
+    assert (book["authors"], book["enrichment"]) == ("Twain", "manual")
+
+
+def test_embedded_ratings_keep_their_shape(google_books):
+    split, embedded = make_collection("mongo"), make_collection("embedded")
+    for collection in (split, embedded):
+        book_id = insert(collection, books[0])
+        collection.rate_book(book_id, 4)
+    split_ratings = split.get_book_ratings({})[0][0]
+    embedded_ratings = embedded.get_book_ratings({})[0][0]
+    assert embedded_ratings.keys() == split_ratings.keys()
+    assert {key: value for key, value in embedded_ratings.items() if key != "_id"} == \
+        {key: value for key, value in split_ratings.items() if key != "_id"}
+    assert "ratings" not in embedded.get_book({})[0][0]
+    assert embedded.get_book({}, fields=["title"])[0][0].keys() == {"_id", "title"}
+
+
+def test_embedded_ratings_follow_the_title(google_books):
+    collection = make_collection("embedded")
+    book_id = insert(collection, books[0])
+    for value in (5, 4, 5):
+        collection.rate_book(book_id, value)
+    assert collection.get_book_ratings_by_id(book_id)[0]["title"] == books[0]["title"]  # cached
+    assert collection.get_book_ratings({"title": books[0]["title"]})[0] != []
+    assert collection.get_top()[0][0]["title"] == books[0]["title"]
+    tag = collection.versions.etag("ratings", book_id)
+
+    values = {"title": "Huck Finn", "authors": "Twain", "ISBN": books[0]["ISBN"], "publisher": "Penguin",
+              "publishedDate": "1884", "genre": "Fiction", "id": book_id}
+    assert collection.update_book(values)[1] == 200
+    assert collection.get_book_ratings_by_id(book_id)[0]["title"] == "Huck Finn"
+    assert collection.get_book_ratings({"title": books[0]["title"]})[0] == []
+    assert collection.get_top()[0][0]["title"] == "Huck Finn"
+    assert collection.versions.etag("ratings", book_id) != tag
+
+
+def test_embed_ratings_migration(google_books):
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "migrations"))
+    import embed_ratings
+    collection = make_collection("mongo")
+    ids = [insert(collection, book) for book in books[:2]]
+    for value in (5, 4, 5):
+        collection.rate_book(ids[0], value)
+    db = collection.storage.client.books_test
+    db.ratings.delete_one({"_id": collection.storage.get("books", ObjectId(ids[1]))["_id"]})  # a book without ratings
+
+    assert embed_ratings.embed(db, drop=True) == {"embedded": 1, "skipped": 0, "empty": 1}
+    migrated = BooksCollection(EmbeddedMongoStorage(db))
+    assert migrated.get_book_ratings_by_id(ids[0])[0]["values"] == [5, 4, 5]
+    assert [str(ratings["_id"]) for ratings in migrated.get_top(1)[0]] == [ids[0]]
+    assert migrated.get_book_ratings_by_id(ids[1])[0]["count"] == 0
+
+    assert embed_ratings.unembed(db, drop=True) == {"written": 2, "removed": 2}
+    assert collection.get_book_ratings_by_id(ids[0])[0]["average"] == pytest.approx(14 / 3)
+
+
+def test_facet_counters_start_once_for_every_worker(google_books, monkeypatch):
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "migrations"))
+    import build_facet_counters
+    mongomock = pytest.importorskip("mongomock")
+    db = mongomock.MongoClient().books_test
+    workers = [BooksCollection(MongoStorage(db), facet_counters=True) for _ in range(2)]
+    for worker in workers:  # a new catalog starts with empty counters in every worker
+        worker.ensure_facet_counters()
+    insert(workers[0], books[0])
+    workers[1].ensure_facet_counters()  # started after the first write, the counter is kept
+    assert all(worker.facet_counters for worker in workers)
+    assert workers[1].get_facets()[0]["genre"] == {"Fiction": 1}
+
+    db.facet_counts.drop()  # an existing catalog without counters
+    insert(workers[0], books[1])
+    late = BooksCollection(MongoStorage(db), facet_counters=True)
+    late.ensure_facet_counters()
+    assert not late.facet_counters  # aggregated on every read until the migration
+
+    # mongomock has no $substrBytes, count the books as the aggregation would
+    memory = MemoryStorage()
+    memory.insert_books(list(db.books.find()), list(db.ratings.find()))
+    monkeypatch.setattr(MongoStorage, "aggregate_facets", lambda self: memory.aggregate_facets())
+    assert build_facet_counters.build(db) == {"counters": 4}
+    assert build_facet_counters.build(db) == {"counters": 4}  # reruns replace the counters
+    restarted = BooksCollection(MongoStorage(db), facet_counters=True)
+    restarted.ensure_facet_counters()
+    assert restarted.facet_counters
+    assert restarted.get_facets()[0]["genre"] == {"Fiction": 1, "Science Fiction": 1}
+
+
+def test_pending_books_are_resumed_by_one_worker(google_books):
+    mongomock = pytest.importorskip("mongomock")
+    db = mongomock.MongoClient().books_test
+    book = BooksCollection.build_book_document(books[0]["title"], books[0]["ISBN"], books[0]["genre"], None)
+    book["_id"] = ObjectId()
+    MongoStorage(db).insert_book(book, BooksCollection.build_ratings_document(book["_id"], book["title"]))
+
+    workers = [BooksCollection(MongoStorage(db), async_enrichment=True) for _ in range(3)]
+    workers[0].ensure_indexes()
+    assert [worker.resume_enrichment() for worker in workers] == [1, 0, 0]
+    wait_for_enrichment(workers[0])
+    assert workers[1].get_book_by_id(str(book["_id"]))[0]["enrichment"] == "enriched"
+
+    db.book_claims.update_many({}, {"$set": {"expires_at": datetime.utcnow()}})  # the claims of a stopped worker
+    db.books.update_one({"_id": book["_id"]}, {"$set": {"enrichment": "pending"}})
+    workers[2].enrichment.resume_periodically(workers[2].resume_enrichment, 0.05)  # no restart needed
+    deadline = time.monotonic() + 5
+    while db.books.find_one({"_id": book["_id"]})["enrichment"] == "pending" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    workers[2].enrichment.stop()
+    assert db.books.find_one({"_id": book["_id"]})["enrichment"] == "enriched"
+    assert workers[2].enrichment.stats()["submitted"] == 1
+
+
+def test_enrichment_raising_on_its_last_attempt_fails_the_book(backend, monkeypatch):
+    collection = make_collection(backend, async_enrichment=True)
+    collection.enrichment.max_attempts = 1
+
+    def lookup(isbn):
+        raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(collection, "lookup_book_google_data", lookup)
+    book_id = insert(collection, books[0])
+    wait_for_enrichment(collection)
+    assert collection.get_book_by_id(book_id)[0]["enrichment"] == "failed"
+    assert collection.enrichment.stats()["errors"] == 1